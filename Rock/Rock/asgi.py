@@ -12,5 +12,15 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Rock.settings')
+# Serve the hot endpoints from Room/async_views.py under ASGI.
+os.environ.setdefault('ASYNC_VIEWS', '1')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from Room.realtime import with_room_events  # noqa: E402  (needs apps loaded)
+from Room.search import get_song_search  # noqa: E402
+
+# Build the song search index now rather than in the first search.
+get_song_search().warm()
+
+application = with_room_events(django_application)
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Rock.settings')
 
 application = get_wsgi_application()
+
+from Room.search import get_song_search  # noqa: E402  (needs apps loaded)
+
+# Build the song search index now rather than in the first search.
+get_song_search().warm()
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Room, Song, RoomSong, Vote, User
+from .models import Membership, Room, Song, RoomSong, Vote, User
 
 
 @admin.register(User)
@@ -9,13 +9,19 @@ class UserAdmin(admin.ModelAdmin):
     ordering = ("id",)
 
 
+class MembershipInline(admin.TabularInline):
+    model = Membership
+    extra = 0
+    raw_id_fields = ("user",)
+
+
 @admin.register(Room)
 class RoomAdmin(admin.ModelAdmin):
     list_display = ("id", "room_code", "host", "created_at")
     search_fields = ("room_code", "host__username")
     list_filter = ("created_at",)
     readonly_fields = ("room_code", "created_at")
-    filter_horizontal = ("members",)
+    inlines = (MembershipInline,)
 
 
 @admin.register(Song)
@@ -34,11 +40,12 @@ class RoomSongAdmin(admin.ModelAdmin):
         "added_by",
         "created_at",
         "played_at",
+        "vote_count",
     )
     list_filter = ("room", "played_at")
     search_fields = ("song__title", "room__room_code")
     ordering = ("-created_at",)
-    readonly_fields = ("created_at",)
+    readonly_fields = ("created_at", "vote_count")
 
 
 @admin.register(Vote)
@@ -0,0 +1,181 @@
+"""
+Async versions of the polling and I/O-bound endpoints.
+
+With ASYNC_VIEWS on (the default when serving through Rock/asgi.py) the
+URLs of DetailRoom, RoomSongs, NowPlaying, VoteToggle and SongAdd route
+here instead of to the DRF views in views.py. Responses are the same.
+
+DRF's APIView only runs sync handlers, so AsyncAPIView covers the part
+of it these endpoints use: JWT authentication (CachedJWTAuthentication), IsAuthenticated, JSON
+request bodies, and DRF's rendering and error bodies. Reads go through
+the async ORM and the caches' async methods. A write that needs a
+transaction (a vote toggle, queueing a song) is a single sync_to_async
+call into the helper the sync view uses. SongAdd awaits the oEmbed lookup
+(MetadataResolver.aresolve) rather than holding a thread while YouTube
+answers.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import APIException, NotAuthenticated, ParseError
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.renderers import JSONRenderer
+from rest_framework.views import exception_handler
+
+from .authentication import CachedJWTAuthentication
+from .ingest import placeholder_defaults
+from .membership import aget_room_id, aget_user_room
+from .metadata import MetadataUnavailable, VideoNotFound, get_resolver
+from .models import RoomSong, Song
+from .ranking import aqueue_for
+from .search import index_songs
+from .serializer import RoomSerializer, UrlExtractSerializer
+from .views import (
+    anow_playing,
+    enqueue_song,
+    not_modified,
+    ready_defaults,
+    room_etag,
+    toggle_vote,
+    voter_room_id,
+    wants_async_ingest,
+    with_etag,
+)
+from .votebuffer import get_vote_buffer
+
+
+def render(data, status=200):
+    return HttpResponse(JSONRenderer().render(data), status=status, content_type="application/json")
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncAPIView(View):
+    """An async View that authenticates like the project's DRF views."""
+
+    authenticator = CachedJWTAuthentication()
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            request.user = await self.authenticate(request)
+            return await super().dispatch(request, *args, **kwargs)
+        except APIException as exc:
+            return self.handle_exception(request, exc)
+
+    async def authenticate(self, request):
+        header = self.authenticator.get_header(request)
+        raw_token = self.authenticator.get_raw_token(header) if header else None
+        if raw_token is None:
+            raise NotAuthenticated()
+        token = self.authenticator.get_validated_token(raw_token)
+        return await self.authenticator.aget_user(token, fresh=request.method not in SAFE_METHODS)
+
+    def handle_exception(self, request, exc):
+        response = exception_handler(exc, {"view": self, "request": request})
+        rendered = render(response.data, response.status_code)
+        if response.status_code == 401:
+            rendered["WWW-Authenticate"] = self.authenticator.authenticate_header(request)
+        return rendered
+
+    def parse(self, request):
+        if not request.body:
+            return {}
+        if request.content_type != "application/json":
+            return request.POST
+        try:
+            return json.loads(request.body)
+        except ValueError as exc:
+            raise ParseError(f"JSON parse error - {exc}")
+
+
+class DetailRoom(AsyncAPIView):
+    async def get(self, request):
+        room = await aget_user_room(request)
+        if not room:
+            return render({"error": "Not in a room"}, status=400)
+
+        return render(RoomSerializer(room, context={"request": request}).data)
+
+
+class RoomSongs(AsyncAPIView):
+    async def get(self, request):
+        room = await aget_user_room(request)
+        if not room:
+            return render({"error": "Not in room"}, status=400)
+
+        etag = room_etag(room)
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+
+        return with_etag(render(await aqueue_for(room, request.user)), etag)
+
+
+class NowPlaying(AsyncAPIView):
+    async def get(self, request):
+        room = await aget_user_room(request)
+        if not room:
+            return render({"detail": "User not in a room"}, status=400)
+
+        etag = room_etag(room)
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+
+        return with_etag(render(await anow_playing(room)), etag)
+
+
+class VoteToggle(AsyncAPIView):
+    async def post(self, request, room_song_id):
+        buffer = get_vote_buffer()
+        if buffer is not None:
+            room_id = await sync_to_async(buffer.room_of)(room_song_id)
+            if room_id is None:
+                return render({"error": "Song not found"}, status=404)
+            if room_id != await aget_room_id(request):
+                return render({"error": "Forbidden"}, status=403)
+            action, vote_count = await sync_to_async(buffer.toggle)(room_song_id, request.user.pk)
+            return render({"action": action, "vote_count": vote_count})
+
+        room_id = await voter_room_id(room_song_id, request.user).afirst()
+        if room_id is None:
+            if await RoomSong.objects.filter(pk=room_song_id).aexists():
+                return render({"error": "Forbidden"}, status=403)
+            return render({"error": "Song not found"}, status=404)
+
+        action, vote_count = await sync_to_async(toggle_vote)(room_song_id, room_id, request.user)
+        return render({"action": action, "vote_count": vote_count})
+
+
+class SongAdd(AsyncAPIView):
+    async def post(self, request):
+        data = self.parse(request)
+        serializer = UrlExtractSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        video_id = serializer.video_id
+
+        room = await aget_user_room(request)
+        if not room:
+            return render({"error": "Not in a room"}, status=400)
+
+        song = await Song.objects.filter(video_id=video_id).afirst()
+        if song is None or song.status == Song.Status.FAILED:
+            if wants_async_ingest(data):
+                defaults = placeholder_defaults(video_id)
+            else:
+                try:
+                    meta = await get_resolver().aresolve(video_id)
+                except VideoNotFound:
+                    return render({"error": "Invalid YouTube video"}, status=400)
+                except MetadataUnavailable:
+                    return render({"error": "YouTube is unavailable, try again"}, status=503)
+                defaults = ready_defaults(meta)
+            song, _ = await Song.objects.aupdate_or_create(video_id=video_id, defaults=defaults)
+            if song.status == Song.Status.READY:
+                index_songs([(song.pk, song.title)])
+
+        body, status = await sync_to_async(enqueue_song)(room, song, request.user)
+        return render(body, status=status)
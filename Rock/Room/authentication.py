@@ -0,0 +1,86 @@
+"""
+JWT authentication without a user query per request.
+
+CachedJWTAuthentication verifies the token like simplejwt's
+JWTAuthentication, but keeps the User it resolves in Django's cache for
+AUTH_PRINCIPAL_CACHE_TTL seconds. Polling listeners then authenticate
+without touching the database. Saving or deleting a user (deactivation,
+password change, ...) drops the cached principal through the signals in
+signals.py, but with the default per-process cache only in the worker
+that saved it, and bulk `.update()` calls bypass the signals entirely.
+So, as with membership, only reads (GET, HEAD, OPTIONS) trust the cached
+principal. Writes load the user afresh, so a deactivated user or a
+token from before a password change is refused at once; reads notice
+within the TTL.
+
+The room a user is in is not part of the principal. membership.py caches
+it separately and forgets it when the user joins or leaves a room.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+
+def cache_key(user_id):
+    return f"rock:principal:{user_id}"
+
+
+def cache_ttl():
+    return getattr(settings, "AUTH_PRINCIPAL_CACHE_TTL", 60)
+
+
+def forget_principals(user_ids):
+    cache.delete_many([cache_key(user_id) for user_id in user_ids])
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    def authenticate(self, request):
+        header = self.get_header(request)
+        raw_token = self.get_raw_token(header) if header else None
+        if raw_token is None:
+            return None
+        validated_token = self.get_validated_token(raw_token)
+        return self.get_user(validated_token, fresh=request.method not in SAFE_METHODS), validated_token
+
+    def get_user(self, validated_token, fresh=False):
+        key = cache_key(self.user_id(validated_token))
+        user = None if fresh else cache.get(key)
+        if user is None:
+            user = super().get_user(validated_token)
+            cache.set(key, user, cache_ttl())
+            return user
+        self.check(user, validated_token)
+        return user
+
+    async def aget_user(self, validated_token, fresh=False):
+        key = cache_key(self.user_id(validated_token))
+        user = None if fresh else await cache.aget(key)
+        if user is None:
+            user = await sync_to_async(super().get_user)(validated_token)
+            await cache.aset(key, user, cache_ttl())
+            return user
+        self.check(user, validated_token)
+        return user
+
+    def user_id(self, validated_token):
+        try:
+            return validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_("Token contained no recognizable user identification")) from e
+
+    def check(self, user, validated_token):
+        # The checks simplejwt runs after loading the user; the revocation
+        # claim differs per token, so it is checked on every hit.
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(
+                    _("The user's password has been changed."), code="password_changed"
+                )
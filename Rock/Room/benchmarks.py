@@ -0,0 +1,207 @@
+"""
+Helpers shared by the bench_* management commands.
+
+Most benchmarks seed their data inside a transaction that is rolled back
+when the run finishes (rolled_back()). Those that need committed data,
+because they serve it to other processes or measure commits,
+seed with seed_scale() and remove it again with drop_scale(prefix). Pick a
+prefix no real username or video id starts with before pointing them at a
+development database.
+"""
+import asyncio
+import os
+import random
+import statistics
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Membership, Room, RoomSong, Song, User, Vote
+from .roomcodes import get_code_allocator
+
+
+class Rollback(Exception):
+    pass
+
+
+@contextmanager
+def rolled_back():
+    try:
+        with transaction.atomic():
+            yield
+            raise Rollback
+    except Rollback:
+        pass
+
+
+def summarize(samples):
+    """Latency summary in milliseconds for a list of durations in seconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 4),
+        "p50_ms": round(pct(50), 4),
+        "p95_ms": round(pct(95), 4),
+        "p99_ms": round(pct(99), 4),
+    }
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def seed_room(songs, members=1, played_fraction=0.0, max_votes=50, prefix="bench", rng=None):
+    """Create a room with `songs` queue entries and return it."""
+    rng = rng or random.Random(0)
+    users = User.objects.bulk_create(
+        User(username=f"{prefix}-user-{i}") for i in range(max(members, 1))
+    )
+    room = Room.objects.create(host=users[0])
+    room.members.add(*users)
+
+    catalog = Song.objects.bulk_create(
+        Song(
+            title=f"{prefix} song {i}",
+            video_id=f"{prefix[:4]}{i:07d}",
+            thumbnail=f"https://i.ytimg.com/vi/{prefix}{i}/hqdefault.jpg",
+        )
+        for i in range(songs)
+    )
+    now = timezone.now()
+    RoomSong.objects.bulk_create(
+        RoomSong(
+            room=room,
+            song=song,
+            added_by=users[i % len(users)],
+            vote_count=rng.randint(0, max_votes),
+            played_at=(
+                now - timedelta(seconds=rng.randint(0, 500))
+                if rng.random() < played_fraction else None
+            ),
+        )
+        for i, song in enumerate(catalog)
+    )
+    return room
+
+
+class StubOEmbedTransport:
+    """
+    Answers oEmbed lookups locally, after STUB_OEMBED_LATENCY seconds, so
+    SongAdd can be load-tested without calling YouTube. Select it with
+    YOUTUBE_OEMBED_TRANSPORT=Room.benchmarks.StubOEmbedTransport.
+    """
+
+    def __init__(self, latency=None):
+        self.latency = float(os.environ.get("STUB_OEMBED_LATENCY", 0)) if latency is None else latency
+
+    def __call__(self, video_id):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.document(video_id)
+
+    def document(self, video_id):
+        return {
+            "title": f"Stub video {video_id}",
+            "thumbnail_url": f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg",
+        }
+
+
+class AsyncStubOEmbedTransport(StubOEmbedTransport):
+    """StubOEmbedTransport for async views (YOUTUBE_OEMBED_ASYNC_TRANSPORT)."""
+
+    async def __call__(self, video_id):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.document(video_id)
+
+
+def video_id(prefix, n):
+    """An 11-character id, as SongAdd's URL pattern requires."""
+    return f"{prefix}{n:0{11 - len(prefix)}d}"
+
+
+def seed_scale(rooms, members, songs, votes_per_member, prefix, rng=None, batch_size=5000):
+    """
+    Commit `rooms` rooms with `members` members each (the first one hosts)
+    and a queue of `songs` songs, plus random votes. Returns
+    {room_id: {"host": user_id, "members": [user_ids], "songs": [room_song_ids]}}.
+    Remove it again with drop_scale(prefix).
+    """
+    rng = rng or random.Random(0)
+    users = User.objects.bulk_create(
+        (User(username=f"{prefix}-{i}", password="!") for i in range(rooms * members)),
+        batch_size=batch_size,
+    )
+
+    codes = get_code_allocator().take(rooms)
+    created = Room.objects.bulk_create(
+        Room(room_code=codes[r], host=users[r * members]) for r in range(rooms)
+    )
+    Membership.objects.bulk_create(
+        (
+            Membership(room=room, user=users[r * members + m])
+            for r, room in enumerate(created) for m in range(members)
+        ),
+        batch_size=batch_size,
+    )
+
+    catalog = Song.objects.bulk_create(
+        (
+            Song(
+                title=f"{prefix} song {i}",
+                video_id=video_id(prefix, i),
+                thumbnail=f"https://i.ytimg.com/vi/{video_id(prefix, i)}/hqdefault.jpg",
+            )
+            for i in range(songs)
+        ),
+        batch_size=batch_size,
+    )
+
+    layout = {}
+    for r, room in enumerate(created):
+        room_members = users[r * members:(r + 1) * members]
+        picks = [
+            (member, song)
+            for member in room_members
+            for song in rng.sample(range(songs), min(votes_per_member, songs))
+        ]
+        counts = [0] * songs
+        for _, song in picks:
+            counts[song] += 1
+        queue = RoomSong.objects.bulk_create(
+            (
+                RoomSong(room=room, song=song, added_by=room_members[i % members], vote_count=counts[i])
+                for i, song in enumerate(catalog)
+            ),
+            batch_size=batch_size,
+        )
+        Vote.objects.bulk_create(
+            (Vote(room_song=queue[song], user=member) for member, song in picks),
+            batch_size=batch_size,
+        )
+        layout[room.id] = {
+            "host": room_members[0].id,
+            "members": [member.id for member in room_members],
+            "songs": [room_song.id for room_song in queue],
+        }
+    return layout
+
+
+def drop_scale(prefix):
+    """Delete what seed_scale(prefix=prefix) committed."""
+    users = User.objects.filter(username__startswith=f"{prefix}-")
+    Room.objects.filter(host__in=users).delete()
+    users.delete()
+    songs = Song.objects.filter(video_id__startswith=prefix).values_list("pk", "video_id")
+    Song.objects.filter(pk__in=[pk for pk, video in songs if video[len(prefix):].isdigit()]).delete()
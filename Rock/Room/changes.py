@@ -0,0 +1,96 @@
+"""
+Per-room queue change log.
+
+Every queue, vote or playback change bumps Room.version and logs the ids of
+the RoomSongs it touched under the new version. Clients keep the version as
+a cursor and ask for the entries changed since then, which costs O(changes)
+instead of O(queue). The log only keeps the last QUEUE_CHANGE_RETENTION
+versions of each room; older cursors get a full snapshot instead. Every
+bump also invalidates the room's cached reads (roomcache.py).
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .models import QueueChange, Room
+from .roomcache import get_room_cache
+
+
+PRUNE_EVERY = 100
+
+_unlogged = ContextVar("rock_unlogged", default=False)
+
+
+def retention():
+    return getattr(settings, "QUEUE_CHANGE_RETENTION", 1000)
+
+
+@contextmanager
+def unlogged():
+    """
+    Deletes in this block are not logged: for rows no client can still
+    see, like songs compacted out of the queue long after they played.
+    """
+    token = _unlogged.set(True)
+    try:
+        yield
+    finally:
+        _unlogged.reset(token)
+
+
+def is_unlogged():
+    return _unlogged.get()
+
+
+def record_changes(room_id, room_song_ids):
+    """Bump the room's version and log the touched entries. Returns it."""
+    room_song_ids = set(room_song_ids)
+    if not room_song_ids:
+        return None
+
+    # No savepoint: callers write the entries in the same transaction and
+    # cannot keep them without the log.
+    with transaction.atomic(savepoint=False):
+        # The UPDATE holds the room row until commit, so versions are
+        # handed out in commit order.
+        if not Room.objects.filter(pk=room_id).update(version=F("version") + 1):
+            return None
+        version = Room.objects.filter(pk=room_id).values_list("version", flat=True).get()
+        QueueChange.objects.bulk_create(
+            QueueChange(room_id=room_id, version=version, room_song_id=room_song_id)
+            for room_song_id in room_song_ids
+        )
+        if version % PRUNE_EVERY == 0:
+            QueueChange.objects.filter(
+                room_id=room_id, version__lte=version - retention()
+            ).delete()
+        get_room_cache().invalidate_on_commit(room_id)
+    return version
+
+
+def changed_since(room, since):
+    """
+    Ids of the entries changed after version `since` up to room.version, or
+    None when the log cannot answer that and a snapshot is needed.
+    """
+    if since == room.version:
+        return set()
+    if since < 0 or since > room.version:
+        return None
+
+    versions, room_song_ids = set(), set()
+    rows = QueueChange.objects.filter(
+        room=room, version__gt=since, version__lte=room.version
+    ).values_list("version", "room_song_id")
+    for version, room_song_id in rows:
+        versions.add(version)
+        room_song_ids.add(room_song_id)
+
+    # Each version logs at least one entry, so a missing first version
+    # means that part of the log has been pruned.
+    if min(versions, default=None) != since + 1:
+        return None
+    return room_song_ids
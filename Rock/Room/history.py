@@ -0,0 +1,72 @@
+"""
+Play history and compaction.
+
+RoomSong holds a room's live queue, but a played row used to stay there
+for the room's lifetime. Every play is now appended to PlayHistory
+(room, song, played_at) by playback.play_next. A played RoomSong only
+matters while it can still come back: replayed after its cooldown, or
+re-queued with its votes. compact_queue deletes played rows older than
+PLAY_HISTORY['QUEUE_RETENTION'] in batches, so the hot table follows the
+live queue. The room's current song is never removed. Adding a
+compacted song again simply creates a fresh row.
+
+Those rows left every client's view when they were played, so the
+deletes skip the change log (changes.unlogged). prune_history drops
+plays older than PLAY_HISTORY['RETENTION'], if set. Run both with
+`manage.py compact_play_history`.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .changes import unlogged
+from .models import PlayHistory, Room, RoomSong
+
+
+def config():
+    return {
+        "QUEUE_RETENTION": 6 * 60 * 60,
+        "RETENTION": None,
+        "BATCH_SIZE": 1000,
+        **getattr(settings, "PLAY_HISTORY", {}),
+    }
+
+
+def recent_plays(room, limit=50):
+    return (
+        PlayHistory.objects
+        .filter(room=room)
+        .order_by("-played_at")
+        .values_list("song__video_id", "song__title", "played_at")[:limit]
+    )
+
+
+def compact_queue(older_than, batch_size, now=None):
+    """Delete rows played before `older_than` ago. Yields each batch's size."""
+    cutoff = (now or timezone.now()) - timedelta(seconds=older_than)
+    stale = RoomSong.objects.filter(played_at__lt=cutoff).exclude(
+        pk__in=Room.objects.filter(now_playing__isnull=False).values("now_playing_id")
+    )
+    while True:
+        with transaction.atomic(), unlogged():
+            ids = list(stale.values_list("pk", flat=True)[:batch_size])
+            if not ids:
+                return
+            # Re-checked in the DELETE: a song re-queued since is live again.
+            _, deleted = stale.filter(pk__in=ids).delete()
+        yield deleted.get(RoomSong._meta.label, 0)
+
+
+def prune_history(older_than, batch_size, now=None):
+    """Delete plays before `older_than` ago. Yields each batch's size."""
+    cutoff = (now or timezone.now()) - timedelta(seconds=older_than)
+    while True:
+        ids = list(
+            PlayHistory.objects.filter(played_at__lt=cutoff).values_list("pk", flat=True)[:batch_size]
+        )
+        if not ids:
+            return
+        PlayHistory.objects.filter(pk__in=ids).delete()
+        yield len(ids)
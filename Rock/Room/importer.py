@@ -0,0 +1,202 @@
+"""
+Set-based playlist import.
+
+Applies SongAdd's rules to a whole batch of video ids with a fixed number of
+queries: known songs are loaded with one `video_id__in` lookup, missing songs
+and queue entries are inserted with `bulk_create(ignore_conflicts=True)`.
+Metadata for unknown songs is fetched before the import's transaction opens,
+so the oEmbed round trips never hold the database's write lock.
+"""
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .changes import record_changes
+from .ingest import get_ingest_queue, placeholder_defaults
+from .metadata import MetadataUnavailable, VideoMetadata, get_resolver
+from .models import RoomSong, Song, Vote
+from .realtime import broadcast
+from .search import index_songs
+
+
+COOLDOWN = timedelta(minutes=10)
+
+UNAVAILABLE = {"status": "error", "error": "YouTube is unavailable, try again", "retryable": True}
+# A song or queue entry that changed under the import.
+CONFLICT = {"status": "error", "error": "Song could not be queued, try again", "retryable": True}
+
+
+def fetch_metadata(video_ids, ingest_async):
+    """
+    Return ({video_id: Song fields}, {video_id: error}) for the ids without a
+    usable song. Runs outside any transaction.
+    """
+    statuses = dict(Song.objects.filter(video_id__in=video_ids).values_list("video_id", "status"))
+    missing = [
+        video_id for video_id in video_ids
+        if statuses.get(video_id, Song.Status.FAILED) == Song.Status.FAILED
+    ]
+    if not missing:
+        return {}, {}
+    if ingest_async:
+        return {video_id: placeholder_defaults(video_id) for video_id in missing}, {}
+
+    fields, errors = {}, {}
+    for video_id, meta in get_resolver().resolve_many(missing).items():
+        if isinstance(meta, VideoMetadata):
+            fields[video_id] = {
+                "title": meta.title,
+                "thumbnail": meta.thumbnail,
+                "duration": meta.duration,
+                "status": Song.Status.READY,
+            }
+        else:
+            errors[video_id] = meta
+    return fields, errors
+
+
+def save_songs(video_ids, fields):
+    """Write the fetched `fields` and return {video_id: Song} for the ids."""
+    songs = {song.video_id: song for song in Song.objects.filter(video_id__in=video_ids)}
+    # A song another request fixed since the fetch keeps its row.
+    retried = [
+        songs[video_id] for video_id in fields
+        if video_id in songs and songs[video_id].status == Song.Status.FAILED
+    ]
+    for song in retried:
+        for name, value in fields[song.video_id].items():
+            setattr(song, name, value)
+    Song.objects.bulk_update(retried, ["title", "thumbnail", "duration", "status"])
+
+    Song.objects.bulk_create(
+        [Song(video_id=video_id, **values) for video_id, values in fields.items() if video_id not in songs],
+        ignore_conflicts=True,
+    )
+    songs.update(
+        (song.video_id, song)
+        for song in Song.objects.filter(video_id__in=[v for v in fields if v not in songs])
+    )
+    index_songs(
+        (songs[video_id].pk, songs[video_id].title) for video_id in fields
+        if video_id in songs and songs[video_id].status == Song.Status.READY
+    )
+    return songs
+
+
+def add_votes(room_songs, user):
+    """Vote for each entry; returns the ones that gained a vote."""
+    try:
+        with transaction.atomic():
+            Vote.objects.bulk_create([Vote(room_song=rs, user=user) for rs in room_songs])
+    except IntegrityError:
+        # A concurrent request cast one of these votes. One at a time, the
+        # Vote signals count exactly the rows inserted here.
+        added = []
+        for rs in room_songs:
+            try:
+                with transaction.atomic():
+                    Vote.objects.create(room_song=rs, user=user)
+            except IntegrityError:
+                continue
+            added.append(rs)
+        return added
+
+    # bulk_create skips the Vote signals, so the counters are bumped here.
+    RoomSong.objects.filter(pk__in=[rs.id for rs in room_songs]).update(
+        vote_count=F("vote_count") + 1
+    )
+    return room_songs
+
+
+def import_songs(room, user, items, ingest_async=False):
+    """
+    Import (input, video_id) pairs into the room's queue. Returns one result
+    dict per input, in order.
+    """
+    video_ids = list(dict.fromkeys(video_id for _, video_id in items if video_id))
+    fields, errors = fetch_metadata(video_ids, ingest_async)
+    with transaction.atomic():
+        songs = save_songs(video_ids, fields)
+
+        queued = {
+            rs.song_id: rs
+            for rs in RoomSong.objects.filter(room=room, song__in=songs.values())
+        }
+        already_voted = set(
+            Vote.objects
+            .filter(user=user, room_song__in=queued.values())
+            .values_list("room_song_id", flat=True)
+        )
+
+        now = timezone.now()
+        outcome = {}
+        votes, requeue, create = [], [], []
+        for video_id in video_ids:
+            if video_id in errors:
+                if isinstance(errors[video_id], MetadataUnavailable):
+                    outcome[video_id] = UNAVAILABLE
+                else:
+                    outcome[video_id] = {"status": "error", "error": "Invalid YouTube video"}
+                continue
+            song = songs.get(video_id)
+            if song is None:
+                continue  # deleted since the fetch; reported below
+            room_song = queued.get(song.id)
+            if room_song is None:
+                create.append(song)
+            elif room_song.played_at is None:
+                if room_song.id not in already_voted:
+                    votes.append(room_song)
+                outcome[video_id] = {"status": "voted", "room_song_id": room_song.id}
+            elif now - room_song.played_at < COOLDOWN:
+                outcome[video_id] = {"status": "cooldown", "error": "Song cooldown active (10 min)"}
+            else:
+                requeue.append(room_song)
+                outcome[video_id] = {"status": "requeued", "room_song_id": room_song.id}
+
+        votes = add_votes(votes, user) if votes else []
+        RoomSong.objects.filter(pk__in=[rs.id for rs in requeue]).update(played_at=None)
+        RoomSong.objects.bulk_create(
+            [RoomSong(room=room, song=song, added_by=user) for song in create],
+            ignore_conflicts=True,
+        )
+        created = RoomSong.objects.filter(
+            room=room, song__in=create, played_at__isnull=True
+        ).values_list("id", "song__video_id")
+
+        for room_song_id, video_id in created:
+            outcome[video_id] = {"status": "added", "room_song_id": room_song_id}
+
+        if created or requeue or votes:
+            # The bulk writes above bypass the signals that log changes.
+            record_changes(
+                room.id,
+                [rs.id for rs in votes + requeue] + [room_song_id for room_song_id, _ in created],
+            )
+            broadcast(room.id, "queue.imported", {
+                "added": len(created),
+                "requeued": len(requeue),
+                "voted": len(votes),
+            })
+
+    pending = [
+        video_id for video_id, result in outcome.items()
+        if result["status"] == "added" and songs[video_id].status == Song.Status.PENDING
+    ]
+    jobs = {job.video_id: job.id for job in get_ingest_queue().submit_many(pending, room.id)}
+
+    results, seen = [], set()
+    for item, video_id in items:
+        if video_id is None:
+            result = {"status": "invalid", "error": "Invalid YouTube URL"}
+        elif video_id in seen:
+            result = {"status": "duplicate"}
+        else:
+            result = dict(outcome.get(video_id, CONFLICT))
+            if video_id in jobs:
+                result["job_id"] = jobs[video_id]
+        seen.add(video_id)
+        results.append({"input": item, "video_id": video_id, **result})
+    return results
@@ -0,0 +1,221 @@
+"""
+Background metadata ingest for songs added in async mode.
+
+SongAdd inserts a placeholder Song and its RoomSong straight away and hands
+the video id to the ingest queue, whose worker pool fetches the title and
+thumbnail. Transient upstream failures are retried with exponential backoff;
+songs that cannot be resolved are marked failed, dropped from the queues they
+were added to, and reported to those rooms.
+
+Jobs live only in the process that accepted them. Placeholders whose job
+died with its process (a restart or a crash) are picked up by recover():
+the queue runs it when a process first uses it, and `manage.py
+recover_ingest` runs it on demand. Only songs whose newest placeholder is
+older than RECOVER_AFTER seconds count as abandoned, so a job still
+running in another process is not duplicated.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from datetime import timedelta
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .metadata import MetadataUnavailable, VideoNotFound, get_resolver
+
+
+THUMBNAIL_URL = "https://i.ytimg.com/vi/{}/hqdefault.jpg"
+
+
+def placeholder_defaults(video_id):
+    from .models import Song
+
+    return {
+        "title": video_id,
+        "thumbnail": THUMBNAIL_URL.format(video_id),
+        "status": Song.Status.PENDING,
+    }
+
+
+class ImmediateExecutor:
+    """Runs jobs inline; lets tests exercise ingest without worker threads."""
+
+    inline = True
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as exc:
+            future.set_exception(exc)
+        return future
+
+
+@dataclass
+class IngestJob:
+    video_id: str
+    room_ids: list = field(default_factory=list)
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = "pending"
+    attempts: int = 0
+    error: str = None
+
+    def as_dict(self):
+        return asdict(self)
+
+
+class IngestQueue:
+    def __init__(self, resolver=None, executor=None, max_workers=4, max_attempts=3,
+                 backoff=1.0, history=1000, sleep=time.sleep):
+        self.resolver = resolver
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="song-ingest"
+        )
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.history = history
+        self.sleep = sleep
+        self._jobs = OrderedDict()
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def submit(self, video_id, room_id):
+        """Queue a metadata fetch; joins the running job for the same video."""
+        return self._submit(video_id, [room_id])
+
+    def _submit(self, video_id, room_ids):
+        with self._lock:
+            job = self._active.get(video_id)
+            if job is not None:
+                job.room_ids.extend(room_id for room_id in room_ids if room_id not in job.room_ids)
+                return job
+            job = IngestJob(video_id=video_id, room_ids=list(room_ids))
+            self._active[video_id] = job
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.history:
+                self._jobs.popitem(last=False)
+        self.executor.submit(self._run, job)
+        return job
+
+    def submit_many(self, video_ids, room_id):
+        # The executor's worker count bounds how many fetches run at once.
+        return [self.submit(video_id, room_id) for video_id in video_ids]
+
+    def recover(self, stale_after=0):
+        """
+        Resubmit pending songs without a job in this process whose newest
+        placeholder is more than `stale_after` seconds old. Returns the jobs.
+        """
+        from .models import RoomSong, Song
+
+        songs = Song.objects.filter(status=Song.Status.PENDING)
+        if stale_after:
+            cutoff = timezone.now() - timedelta(seconds=stale_after)
+            songs = songs.exclude(room_songs__created_at__gt=cutoff)
+        with self._lock:
+            video_ids = set(songs.values_list("video_id", flat=True)) - set(self._active)
+        rooms = defaultdict(list)
+        for video_id, room_id in RoomSong.objects.filter(
+            song__video_id__in=video_ids, played_at__isnull=True
+        ).values_list("song__video_id", "room_id"):
+            rooms[video_id].append(room_id)
+        return [self._submit(video_id, rooms[video_id]) for video_id in sorted(video_ids)]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job):
+        try:
+            self._process(job)
+        finally:
+            with self._lock:
+                self._active.pop(job.video_id, None)
+            if not getattr(self.executor, "inline", False):
+                # Worker threads own their connection; inline jobs share
+                # the caller's and must leave it open.
+                close_old_connections()
+
+    def _process(self, job):
+        resolver = self.resolver or get_resolver()
+        while True:
+            job.attempts += 1
+            try:
+                meta = resolver.resolve(job.video_id)
+            except VideoNotFound:
+                return self._fail(job, "Invalid YouTube video")
+            except MetadataUnavailable as exc:
+                if job.attempts >= self.max_attempts:
+                    return self._fail(job, f"YouTube is unavailable: {exc}")
+                self.sleep(self.backoff * 2 ** (job.attempts - 1))
+                continue
+            return self._complete(job, meta)
+
+    def _complete(self, job, meta):
+        from .changes import record_changes
+        from .models import RoomSong, Song
+        from .realtime import broadcast
+        from .search import index_songs
+
+        songs = Song.objects.filter(video_id=job.video_id)
+        songs.update(
+            title=meta.title,
+            thumbnail=meta.thumbnail,
+            duration=meta.duration,
+            status=Song.Status.READY,
+        )
+        index_songs((song_id, meta.title) for song_id in songs.values_list("pk", flat=True))
+        job.status = "ready"
+        rows = list(RoomSong.objects.filter(
+            song__video_id=job.video_id, room_id__in=job.room_ids
+        ).values_list("id", "room_id"))
+        for room_song_id, room_id in rows:
+            record_changes(room_id, [room_song_id])
+        for room_song_id, room_id in rows:
+            broadcast(room_id, "queue.updated", {
+                "room_song_id": room_song_id,
+                "video_id": meta.video_id,
+                "title": meta.title,
+                "thumbnail": meta.thumbnail,
+            })
+
+    def _fail(self, job, error):
+        from .models import RoomSong, Song
+        from .realtime import broadcast
+
+        job.status = "failed"
+        job.error = error
+        Song.objects.filter(video_id=job.video_id).update(status=Song.Status.FAILED)
+
+        placeholders = RoomSong.objects.filter(
+            song__video_id=job.video_id, played_at__isnull=True
+        )
+        rows = list(placeholders.values_list("id", "room_id"))
+        placeholders.delete()
+        for room_song_id, room_id in rows:
+            broadcast(room_id, "queue.failed", {
+                "room_song_id": room_song_id,
+                "video_id": job.video_id,
+                "error": error,
+            })
+
+
+@lru_cache(maxsize=None)
+def get_ingest_queue():
+    config = getattr(settings, "SONG_INGEST", {})
+    executor = config.get("EXECUTOR")
+    queue = IngestQueue(
+        executor=import_string(executor)() if executor else None,
+        max_workers=config.get("MAX_WORKERS", 4),
+        max_attempts=config.get("MAX_ATTEMPTS", 3),
+        backoff=config.get("BACKOFF", 1.0),
+    )
+    queue.recover(config.get("RECOVER_AFTER", 300))
+    return queue
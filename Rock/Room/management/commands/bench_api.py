@@ -0,0 +1,265 @@
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from itertools import count
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from Room.benchmarks import drop_scale, seed_scale, summarize, video_id
+from Room.metadata import get_resolver
+from Room.models import User
+
+
+DEFAULT_MIX = "queue=55,now_playing=25,vote=14,add=5,play_next=1"
+STUB_TRANSPORT = "Room.benchmarks.StubOEmbedTransport"
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ENDPOINTS:
+            raise CommandError(f"Unknown endpoint {name!r}; choose from {', '.join(ENDPOINTS)}")
+        mix[name] = float(weight)
+    return mix
+
+
+# name -> (method, url builder, who sends it)
+ENDPOINTS = {
+    "queue": ("GET", lambda ctx: "/api/songs/queue/", "member"),
+    "now_playing": ("GET", lambda ctx: "/api/songs/now-playing/", "member"),
+    "vote": ("POST", lambda ctx: f"/api/songs/{ctx.rng.choice(ctx.room['songs'])}/vote/", "member"),
+    "add": ("POST", lambda ctx: "/api/songs/add/", "member"),
+    "play_next": ("POST", lambda ctx: "/api/songs/play-next/", "host"),
+}
+
+
+class InProcessClient:
+    def __init__(self):
+        self.client = APIClient(SERVER_NAME="localhost")
+
+    def request(self, method, url, token, body):
+        response = getattr(self.client, method.lower())(
+            url, body, format="json", HTTP_AUTHORIZATION=f"Bearer {token}"
+        )
+        return response.status_code, response.profile.queries
+
+    def close(self):
+        connection.close()
+
+
+class HttpClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def request(self, method, url, token, body):
+        response = self.session.request(
+            method,
+            self.base_url + url,
+            json=body,
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=30,
+        )
+        queries = response.headers.get("X-Query-Count")
+        return response.status_code, int(queries) if queries is not None else None
+
+    def close(self):
+        self.session.close()
+
+
+class Context:
+    def __init__(self, rng, room):
+        self.rng = rng
+        self.room = room
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed synthetic rooms and drive mixed API traffic (queue, now-playing, vote, "
+        "add with a stubbed oEmbed, play-next) in-process or over HTTP. Reports "
+        "p50/p95/p99 latency, throughput and queries per request as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument("--members", type=int, default=20)
+        parser.add_argument("--songs", type=int, default=100)
+        parser.add_argument("--votes-per-member", type=int, default=5)
+        parser.add_argument("--mode", choices=["inprocess", "http"], default="inprocess")
+        parser.add_argument("--url", help="Target an already running server (http mode).")
+        parser.add_argument("--workers", type=int, default=8)
+        parser.add_argument("--duration", type=float, default=10.0, help="Seconds of traffic.")
+        parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Endpoint weights (default {DEFAULT_MIX}).")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--keep", action="store_true", help="Leave the seeded data in place.")
+        parser.add_argument("--output", help="Also write the JSON report to this file.")
+
+    def handle(self, *args, **options):
+        mix = parse_mix(options["mix"])
+        prefix = f"b{uuid.uuid4().hex[:2]}"
+        rng = random.Random(options["seed"])
+
+        started = time.perf_counter()
+        layout = seed_scale(
+            options["rooms"], options["members"], options["songs"],
+            options["votes_per_member"], prefix, rng=rng,
+        )
+        seed_time = time.perf_counter() - started
+        server = None
+        try:
+            tokens = {
+                user.id: str(AccessToken.for_user(user))
+                for user in User.objects.filter(username__startswith=f"{prefix}-")
+            }
+            if options["mode"] == "http":
+                base_url = options["url"]
+                if not base_url:
+                    server, base_url = self.start_server()
+                make_client = lambda: HttpClient(base_url)
+                result = self.drive(layout, tokens, mix, make_client, prefix, options)
+            else:
+                with override_settings(
+                    YOUTUBE_OEMBED={**settings.YOUTUBE_OEMBED, "TRANSPORT": STUB_TRANSPORT}
+                ):
+                    get_resolver.cache_clear()
+                    result = self.drive(layout, tokens, mix, InProcessClient, prefix, options)
+                get_resolver.cache_clear()
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+            if not options["keep"]:
+                drop_scale(prefix)
+
+        report = {
+            "mode": options["mode"],
+            "database": connection.vendor,
+            "scale": {
+                "rooms": options["rooms"],
+                "members": options["members"],
+                "songs": options["songs"],
+                "votes_per_member": options["votes_per_member"],
+                "seed_s": round(seed_time, 2),
+            },
+            "workers": options["workers"],
+            "mix": mix,
+            **result,
+        }
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output)
+        self.stdout.write(output)
+
+    def start_server(self):
+        """Run manage.py runserver with the stub oEmbed transport and query headers."""
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        env = {
+            **os.environ,
+            "YOUTUBE_OEMBED_TRANSPORT": STUB_TRANSPORT,
+            "PROFILING_HEADERS": "1",
+        }
+        server = subprocess.Popen(
+            [sys.executable, str(settings.BASE_DIR / "manage.py"), "runserver", "--noreload", f"127.0.0.1:{port}"],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+                return server, f"http://127.0.0.1:{port}"
+            except OSError:
+                if server.poll() is not None:
+                    break
+                time.sleep(0.2)
+        server.terminate()
+        raise CommandError("The local server did not start")
+
+    def drive(self, layout, tokens, mix, make_client, prefix, options):
+        names, weights = list(mix), list(mix.values())
+        rooms = list(layout.values())
+        samples = defaultdict(list)
+        queries = defaultdict(list)
+        statuses = defaultdict(Counter)
+        lock = threading.Lock()
+        added = count(options["songs"])
+        barrier = threading.Barrier(options["workers"])
+        deadline = []
+
+        def worker(index):
+            rng = random.Random(options["seed"] * 1000 + index)
+            client = make_client()
+            local = []
+            barrier.wait()
+            try:
+                while time.perf_counter() < deadline[0]:
+                    name = rng.choices(names, weights)[0]
+                    method, url_for, sender = ENDPOINTS[name]
+                    room = rng.choice(rooms)
+                    user_id = room["host"] if sender == "host" else rng.choice(room["members"])
+                    body = None
+                    if name == "add":
+                        body = {"url": f"https://www.youtube.com/watch?v={video_id(prefix, next(added))}"}
+                    url = url_for(Context(rng, room))
+
+                    start = time.perf_counter()
+                    try:
+                        status, query_count = client.request(method, url, tokens[user_id], body)
+                    except Exception as exc:
+                        status, query_count = type(exc).__name__, None
+                    local.append((name, time.perf_counter() - start, status, query_count))
+            finally:
+                client.close()
+            with lock:
+                for name, elapsed, status, query_count in local:
+                    samples[name].append(elapsed)
+                    statuses[name][str(status)] += 1
+                    if query_count is not None:
+                        queries[name].append(query_count)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(options["workers"])]
+        started = time.perf_counter()
+        deadline.append(started + options["duration"])
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        total = sum(len(values) for values in samples.values())
+        endpoints = {}
+        for name in names:
+            endpoints[name] = {
+                **summarize(samples[name]),
+                "throughput_rps": round(len(samples[name]) / elapsed, 1),
+                "queries_per_request": (
+                    round(sum(queries[name]) / len(queries[name]), 2) if queries[name] else None
+                ),
+                "max_queries": max(queries[name], default=None),
+                "statuses": dict(statuses[name]),
+            }
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "requests": total,
+            "throughput_rps": round(total / elapsed, 1),
+            "latency": summarize([s for values in samples.values() for s in values]),
+            "endpoints": endpoints,
+        }
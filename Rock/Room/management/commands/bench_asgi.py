@@ -0,0 +1,206 @@
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from Room.benchmarks import drop_scale, seed_scale, summarize, video_id
+from Room.models import User
+
+
+VARIANTS = {"sync": "0", "async": "1"}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the sync DRF views with Room/async_views.py under Django's ASGI "
+        "handler: many pollers revalidating now-playing and the queue with "
+        "If-None-Match while a few clients add songs behind a slow (stubbed) oEmbed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument("--members", type=int, default=50)
+        parser.add_argument("--songs", type=int, default=50)
+        parser.add_argument("--pollers", type=int, default=100)
+        parser.add_argument("--adders", type=int, default=8)
+        parser.add_argument("--think", type=float, default=1.0, help="Seconds between a poller's requests.")
+        parser.add_argument("--oembed-latency", type=float, default=0.5)
+        parser.add_argument("--duration", type=float, default=10.0)
+        parser.add_argument("--variant", choices=sorted(VARIANTS), help="Run one variant in this process.")
+        parser.add_argument("--layout", help="Seeded layout to drive; set by the parent run.")
+        parser.add_argument("--json", action="store_true")
+
+    def handle(self, *args, **options):
+        if options["layout"]:
+            with open(options["layout"]) as f:
+                layout = json.load(f)
+            self.stdout.write(json.dumps(asyncio.run(self.drive(layout, options))))
+            return
+
+        prefix = f"a{uuid.uuid4().hex[:2]}"
+        layout = seed_scale(options["rooms"], options["members"], options["songs"], 2, prefix)
+        report = {}
+        try:
+            tokens = {
+                str(user.id): str(AccessToken.for_user(user))
+                for user in User.objects.filter(username__startswith=f"{prefix}-")
+            }
+            with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+                json.dump({"prefix": prefix, "rooms": list(layout.values()), "tokens": tokens}, f)
+            try:
+                variants = [options["variant"]] if options["variant"] else list(VARIANTS)
+                for variant in variants:
+                    report[variant] = self.run_variant(variant, f.name, options)
+            finally:
+                os.unlink(f.name)
+        finally:
+            drop_scale(prefix)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        for variant, result in report.items():
+            self.stdout.write(f"{variant}: {json.dumps(result)}")
+
+    def run_variant(self, variant, layout_path, options):
+        # URL routing is fixed when Room.urls is imported, so each variant
+        # gets a fresh process.
+        env = {
+            **os.environ,
+            "ASYNC_VIEWS": VARIANTS[variant],
+            "YOUTUBE_OEMBED_TRANSPORT": "Room.benchmarks.StubOEmbedTransport",
+            "YOUTUBE_OEMBED_ASYNC_TRANSPORT": "Room.benchmarks.AsyncStubOEmbedTransport",
+            "STUB_OEMBED_LATENCY": str(options["oembed_latency"]),
+        }
+        command = [
+            sys.executable, str(settings.BASE_DIR / "manage.py"), "bench_asgi",
+            "--layout", layout_path,
+            "--variant", variant,
+        ]
+        for name in ("pollers", "adders", "think", "duration"):
+            command += [f"--{name}", str(options[name])]
+        result = subprocess.run(command, env=env, capture_output=True, text=True)
+        if result.returncode:
+            raise CommandError(f"{variant} run failed:\n{result.stderr}")
+        return json.loads(result.stdout)
+
+    async def drive(self, layout, options):
+        from Rock.asgi import application
+
+        rooms, tokens = layout["rooms"], layout["tokens"]
+        deadline = time.perf_counter() + options["duration"]
+        samples = {"poll": [], "add": []}
+        statuses = {"poll": Counter(), "add": Counter()}
+        added = iter(range(10**6, 10**7))
+
+        async def poller(index):
+            rng = random.Random(index)
+            room = rng.choice(rooms)
+            token = tokens[str(rng.choice(room["members"]))]
+            etags = {}
+            while time.perf_counter() < deadline:
+                path = rng.choice(["/api/songs/now-playing/", "/api/songs/queue/"])
+                start = time.perf_counter()
+                status, headers = await asgi_request(application, "GET", path, token, etag=etags.get(path))
+                samples["poll"].append(time.perf_counter() - start)
+                statuses["poll"][status] += 1
+                if "etag" in headers:
+                    etags[path] = headers["etag"]
+                await asyncio.sleep(options["think"] * rng.uniform(0.5, 1.5))
+
+        async def adder(index):
+            # Adders share one busy room; the other rooms' pollers stay idle (304s).
+            rng = random.Random(-index)
+            room = rooms[0]
+            while time.perf_counter() < deadline:
+                token = tokens[str(rng.choice(room["members"]))]
+                body = {"url": f"https://youtu.be/{video_id(layout['prefix'], next(added))}"}
+                start = time.perf_counter()
+                status, _ = await asgi_request(application, "POST", "/api/songs/add/", token, body=body)
+                samples["add"].append(time.perf_counter() - start)
+                statuses["add"][status] += 1
+
+        threads = []
+
+        async def sample_threads():
+            while time.perf_counter() < deadline:
+                threads.append(threading.active_count())
+                await asyncio.sleep(0.05)
+
+        started = time.perf_counter()
+        await asyncio.gather(
+            sample_threads(),
+            *(poller(i) for i in range(options["pollers"])),
+            *(adder(i) for i in range(options["adders"])),
+        )
+        elapsed = time.perf_counter() - started
+        return {
+            "async_views": settings.ASYNC_VIEWS,
+            "elapsed_s": round(elapsed, 3),
+            "peak_threads": max(threads),
+            **{
+                kind: {
+                    **summarize(samples[kind]),
+                    "throughput_rps": round(len(samples[kind]) / elapsed, 1),
+                    "statuses": {str(code): n for code, n in statuses[kind].items()},
+                }
+                for kind in samples
+            },
+        }
+
+
+async def asgi_request(application, method, path, token, body=None, etag=None):
+    """One request through the ASGI application. Returns (status, headers)."""
+    headers = [
+        (b"host", b"localhost"),
+        (b"authorization", f"Bearer {token}".encode()),
+    ]
+    payload = b""
+    if body is not None:
+        payload = json.dumps(body).encode()
+        headers.append((b"content-type", b"application/json"))
+        headers.append((b"content-length", str(len(payload)).encode()))
+    if etag:
+        headers.append((b"if-none-match", etag.encode()))
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": headers,
+        "client": ("127.0.0.1", 0),
+        "server": ("localhost", 80),
+    }
+    messages = [{"type": "http.request", "body": payload, "more_body": False}]
+    response = {}
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Future()  # no disconnect; cancelled once the response is sent
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {
+                name.decode().lower(): value.decode() for name, value in message["headers"]
+            }
+
+    await application(scope, receive, send)
+    return response["status"], response["headers"]
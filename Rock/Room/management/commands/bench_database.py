@@ -0,0 +1,121 @@
+import json
+import random
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.test import APIClient
+
+from Room.benchmarks import seed_room, summarize
+from Room.models import RoomSong, Song, User
+
+
+def database_profile():
+    profile = {"vendor": connection.vendor}
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            for pragma in ("journal_mode", "synchronous", "busy_timeout", "mmap_size"):
+                profile[pragma] = cursor.execute(f"PRAGMA {pragma}").fetchone()[0]
+        profile["transaction_mode"] = connection.transaction_mode
+    else:
+        profile["conn_max_age"] = connection.settings_dict["CONN_MAX_AGE"]
+        profile["pool"] = connection.settings_dict["OPTIONS"].get("pool")
+    return profile
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test the vote and queue endpoints against the configured database. "
+        "Run once per profile (e.g. SQLITE_PROFILE=default, SQLITE_PROFILE=wal, "
+        "DATABASE_URL=postgres://...) and compare the reports."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=8)
+        parser.add_argument("--requests", type=int, default=200, help="Requests per worker.")
+        parser.add_argument("--songs", type=int, default=200)
+        parser.add_argument("--vote-ratio", type=float, default=0.5)
+        parser.add_argument("--json", action="store_true")
+
+    def handle(self, *args, **options):
+        # Workers use their own connections, so the seed data is committed
+        # (and removed afterwards) rather than rolled back.
+        prefix = f"dbb{uuid.uuid4().hex[:6]}"
+        room = seed_room(options["songs"], members=options["workers"], prefix=prefix)
+        try:
+            report = self.run_load(room, options)
+        finally:
+            users = list(room.members.values_list("pk", flat=True))
+            songs = list(RoomSong.objects.filter(room=room).values_list("song_id", flat=True))
+            room.delete()
+            User.objects.filter(pk__in=users).delete()
+            Song.objects.filter(pk__in=songs).delete()
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        for name, value in report.items():
+            self.stdout.write(f"{name}: {value}")
+
+    def run_load(self, room, options):
+        room_song_ids = list(RoomSong.objects.filter(room=room).values_list("pk", flat=True))
+        members = list(room.members.all())
+        samples = {"vote": [], "queue": []}
+        errors = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(len(members))
+
+        def worker(index, user):
+            rng = random.Random(index)
+            client = APIClient(SERVER_NAME="localhost")
+            client.force_authenticate(user)
+            local = {"vote": [], "queue": []}
+            barrier.wait()
+            try:
+                for _ in range(options["requests"]):
+                    if rng.random() < options["vote_ratio"]:
+                        kind = "vote"
+                        url = f"/api/songs/{rng.choice(room_song_ids)}/vote/"
+                        start = time.perf_counter()
+                        response = client.post(url)
+                    else:
+                        kind = "queue"
+                        start = time.perf_counter()
+                        response = client.get("/api/songs/queue/")
+                    local[kind].append(time.perf_counter() - start)
+                    if response.status_code != 200:
+                        with lock:
+                            errors.append(response.status_code)
+            except Exception as exc:
+                with lock:
+                    errors.append(repr(exc))
+            finally:
+                connection.close()
+            with lock:
+                for kind, values in local.items():
+                    samples[kind].extend(values)
+
+        threads = [
+            threading.Thread(target=worker, args=(i, user)) for i, user in enumerate(members)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        total = sum(len(values) for values in samples.values())
+        return {
+            "database": database_profile(),
+            "workers": len(members),
+            "requests": total,
+            "errors": len(errors),
+            "error_samples": [str(error) for error in errors[:5]],
+            "elapsed_s": round(elapsed, 3),
+            "throughput_rps": round(total / elapsed, 1) if elapsed else None,
+            "vote": summarize(samples["vote"]),
+            "queue": summarize(samples["queue"]),
+        }
@@ -0,0 +1,61 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from Room.benchmarks import rolled_back, seed_room, summarize, timed
+from Room.models import RoomSong
+from Room.playback import pick_next
+
+
+def orm_walk(room):
+    # The selection PlayNextSong used before playback.py: walk the ranked
+    # queue in Python until a song is out of its cooldown.
+    candidates = RoomSong.objects.filter(room=room).order_by("-vote_count", "created_at")
+    for rs in candidates:
+        if rs.can_play_again(10):
+            return rs.id
+    return None
+
+
+class Command(BaseCommand):
+    help = "Compare next-song selection by walking the queue against playback.pick_next."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--songs", type=int, default=10000)
+        parser.add_argument("--picks", type=int, default=100)
+        parser.add_argument(
+            "--played-fraction",
+            type=float,
+            default=0.5,
+            help="Share of songs seeded inside the replay cooldown.",
+        )
+        parser.add_argument("--json", action="store_true")
+
+    def handle(self, *args, **options):
+        with rolled_back():
+            room = seed_room(options["songs"], played_fraction=options["played_fraction"])
+
+            walk_samples, pick_samples = [], []
+            for _ in range(options["picks"]):
+                now = timezone.now()
+                walk_time, expected = timed(orm_walk, room)
+                pick_time, picked = timed(pick_next, room.id, now)
+                if picked != expected:
+                    self.stderr.write(f"Mismatch: the walk picked {expected}, pick_next picked {picked}")
+                walk_samples.append(walk_time)
+                pick_samples.append(pick_time)
+                if picked is None:
+                    break
+                RoomSong.objects.filter(pk=picked).update(played_at=now)
+
+        report = {
+            "songs": options["songs"],
+            "orm_walk": summarize(walk_samples),
+            "pick_next": summarize(pick_samples),
+        }
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        for name, value in report.items():
+            self.stdout.write(f"{name}: {value}")
@@ -0,0 +1,117 @@
+import json
+import random
+import string
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from Room.benchmarks import drop_scale, summarize
+from Room.models import Room, User
+from Room.roomcodes import get_code_allocator
+
+
+ALPHABET = string.ascii_uppercase + string.digits
+
+
+def probed_code(rng):
+    # What Room.generate_code did before Room/roomcodes.py.
+    while True:
+        code = "".join(rng.choices(ALPHABET, k=6))
+        if not Room.objects.filter(room_code=code).exists():
+            return code
+
+
+class Command(BaseCommand):
+    help = (
+        "Room creation throughput with --existing rooms already in the database: "
+        "random codes probed with EXISTS (the old Room.generate_code) against the "
+        "block-reserving allocator. Each room is created and committed in its own "
+        "transaction, as CreateRoom does; the seeded users and rooms are deleted "
+        "afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--existing", type=int, default=1_000_000)
+        parser.add_argument("--create", type=int, default=2000, help="Rooms created per strategy.")
+        parser.add_argument("--batch-size", type=int, default=10_000)
+        parser.add_argument("--json", action="store_true")
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+
+        try:
+            started = time.perf_counter()
+            self.seed(options["existing"], options["batch_size"], rng)
+            seed_time = time.perf_counter() - started
+
+            hosts = User.objects.bulk_create(
+                User(username=f"rc-host-{i}", password="!") for i in range(2 * options["create"])
+            )
+            report = {
+                "existing_rooms": Room.objects.count(),
+                "seed_s": round(seed_time, 2),
+                "probe": self.create_rooms(
+                    hosts[:options["create"]],
+                    lambda host: Room.objects.create(host=host, room_code=probed_code(rng)),
+                ),
+                "allocator": self.create_rooms(
+                    hosts[options["create"]:],
+                    lambda host: Room.objects.create(host=host),
+                ),
+            }
+        finally:
+            drop_scale("rc")
+
+        allocator = get_code_allocator()
+        positions = range(options["create"] * 10)
+        started = time.perf_counter()
+        for position in positions:
+            allocator.code_at(position)
+        report["permutation_codes_per_s"] = round(len(positions) / (time.perf_counter() - started))
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        for name, value in report.items():
+            self.stdout.write(f"{name}: {value}")
+
+    def seed(self, count, batch_size, rng):
+        """`count` rooms with random six-character codes, like existing data."""
+        taken = set(Room.objects.values_list("room_code", flat=True))
+        for offset in range(0, count, batch_size):
+            size = min(batch_size, count - offset)
+            users = User.objects.bulk_create(
+                User(username=f"rc-{offset + i}", password="!") for i in range(size)
+            )
+            codes = []
+            while len(codes) < size:
+                code = "".join(rng.choices(ALPHABET, k=6))
+                if code not in taken:
+                    taken.add(code)
+                    codes.append(code)
+            Room.objects.bulk_create(
+                Room(room_code=code, host=user) for code, user in zip(codes, users)
+            )
+
+    def create_rooms(self, hosts, create):
+        samples = []
+        queries = []
+
+        def count(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            started = time.perf_counter()
+            for host in hosts:
+                start = time.perf_counter()
+                with transaction.atomic():
+                    create(host)
+                samples.append(time.perf_counter() - start)
+            elapsed = time.perf_counter() - started
+        return {
+            **summarize(samples),
+            "rooms_per_s": round(len(hosts) / elapsed, 1),
+            "queries_per_room": round(len(queries) / len(hosts), 3),
+        }
@@ -0,0 +1,89 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Exists, OuterRef
+from rest_framework.renderers import JSONRenderer
+
+from Room.benchmarks import rolled_back, seed_room, summarize, timed
+from Room.models import RoomSong, Vote
+from Room.ranking import QUEUE_COLUMNS, queue_row, voted_ids
+from Room.serializer import RoomSongSerializer
+
+
+def serializer_queue(room, user, select_related=True):
+    # The queue as RoomSongs built it before the lean path.
+    qs = (
+        RoomSong.objects
+        .filter(room=room, played_at__isnull=True)
+        .annotate(has_voted=Exists(Vote.objects.filter(room_song=OuterRef("pk"), user=user)))
+        .order_by("-vote_count", "created_at")
+    )
+    if select_related:
+        qs = qs.select_related("song")
+    return RoomSongSerializer(qs, many=True).data
+
+
+def lean_queue(room, user):
+    rows = (
+        RoomSong.objects
+        .filter(room=room, played_at__isnull=True)
+        .order_by("-vote_count", "created_at")
+        .values_list(*QUEUE_COLUMNS)
+    )
+    voted = voted_ids(room, user)
+    return [queue_row(*row, has_voted=row[0] in voted) for row in rows]
+
+
+class Command(BaseCommand):
+    help = "Compare queue serialization through RoomSongSerializer and the lean .values() path."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument(
+            "--with-n-plus-one",
+            action="store_true",
+            help="Also time the serializer without select_related (slow at 10k).",
+        )
+        parser.add_argument("--json", action="store_true")
+
+    def handle(self, *args, **options):
+        paths = {
+            "serializer": lambda room, user: serializer_queue(room, user),
+            "lean": lean_queue,
+        }
+        if options["with_n_plus_one"]:
+            paths["serializer_n_plus_one"] = lambda room, user: serializer_queue(room, user, False)
+
+        report = {}
+        for size in options["sizes"]:
+            with rolled_back():
+                room = seed_room(size, prefix=f"ser{size}")
+                user = room.host
+                expected = JSONRenderer().render(serializer_queue(room, user))
+
+                results = {}
+                for name, build in paths.items():
+                    samples, queries = [], []
+
+                    def count(execute, *args):
+                        queries.append(None)
+                        return execute(*args)
+
+                    for _ in range(options["repeat"]):
+                        queries.clear()
+                        with connection.execute_wrapper(count):
+                            elapsed, data = timed(build, room, user)
+                        samples.append(elapsed)
+                    if JSONRenderer().render(data) != expected:
+                        self.stderr.write(f"{name} output differs at {size} entries")
+                    results[name] = {**summarize(samples), "queries": len(queries)}
+                report[size] = results
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        for size, results in report.items():
+            for name, value in results.items():
+                self.stdout.write(f"{size} {name}: {value}")
@@ -0,0 +1,130 @@
+import itertools
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from Room.benchmarks import rolled_back, seed_room, summarize, video_id
+from Room.models import RoomSong, Song
+from Room.search import MemorySongSearch, normalize, search_songs
+
+# Syllables spelled like English, so titles have a realistic spread of word prefixes.
+SYLLABLES = [
+    onset + vowel
+    for onset in ["", *"bcdfghjklmnprstvwyz", "ch", "sh", "th", "st", "tr", "br", "gr", "pl"]
+    for vowel in ["a", "e", "i", "o", "u", "ay", "ee", "oo", "ou", "ar", "er", "in", "on"]
+]
+
+class Command(BaseCommand):
+    help = (
+        "Typeahead latency over a catalog of --songs songs: the in-memory prefix "
+        "index against title__icontains. Everything is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--songs", type=int, default=1_000_000)
+        parser.add_argument("--vocabulary", type=int, default=50_000)
+        parser.add_argument("--queued", type=int, default=20_000, help="Songs given votes, for popularity.")
+        parser.add_argument("--queries", type=int, default=2000)
+        parser.add_argument("--scan-queries", type=int, default=50)
+        parser.add_argument("--json", action="store_true")
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        report = {}
+
+        with rolled_back():
+            started = time.perf_counter()
+            titles = self.seed(options, rng)
+            report["seed_s"] = round(time.perf_counter() - started, 1)
+
+            search = MemorySongSearch(refresh_interval=3600, rebuild_interval=None)
+            started = time.perf_counter()
+            index = search.build()
+            report["build_s"] = round(time.perf_counter() - started, 2)
+            report["index_mb"] = round(self.index_size(index) / 2 ** 20, 1)
+
+            queries = self.queries(titles, options["queries"], rng)
+            for length, group in itertools.groupby(sorted(queries, key=len), key=len):
+                report[f"index_{length}_chars"] = self.timed(search.search, list(group))
+            report["index_all"] = self.timed(search.search, queries)
+
+            # With the Song lookup the endpoint adds.
+            report["search_songs"] = self.timed(
+                lambda query, limit: search_songs(query, limit, search), queries[:500]
+            )
+
+            report["icontains"] = self.timed(
+                lambda query, limit: list(
+                    Song.objects.filter(title__icontains=query).values_list("pk", "title")[:200]
+                ),
+                rng.sample(queries, min(options["scan_queries"], len(queries))),
+            )
+            report["stats"] = search.stats()
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        for name, value in report.items():
+            self.stdout.write(f"{name}: {value}")
+
+    def seed(self, options, rng):
+        words = list({
+            "".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))) for _ in range(options["vocabulary"])
+        })
+        # Zipf-like: a few words are everywhere, most are rare.
+        weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+        titles = [
+            " ".join(rng.choices(words, cum_weights=weights, k=rng.randint(2, 5))).title()
+            for _ in range(options["songs"])
+        ]
+        Song.objects.bulk_create(
+            (
+                Song(title=title, video_id=video_id("bq", i), thumbnail="https://i.ytimg.com/x.jpg")
+                for i, title in enumerate(titles)
+            ),
+            batch_size=5000,
+        )
+        if options["queued"]:
+            room = seed_room(0, prefix="bq-room", rng=rng)
+            songs = Song.objects.filter(video_id__startswith="bq").order_by("?")[:options["queued"]]
+            RoomSong.objects.bulk_create(
+                (
+                    RoomSong(room=room, song=song, added_by=room.host, vote_count=rng.randint(0, 100))
+                    for song in songs
+                ),
+                batch_size=5000,
+            )
+        return titles
+
+    def queries(self, titles, count, rng):
+        """What people type: 1 to 12 leading characters of a real title or one of its words."""
+        queries = []
+        while len(queries) < count:
+            text = normalize(rng.choice(titles))
+            if rng.random() < 0.5:
+                text = rng.choice(text.split())
+            queries.append(text[:rng.randint(1, 12)])
+        return queries
+
+    def timed(self, fn, queries):
+        samples = []
+        for query in queries:
+            start = time.perf_counter()
+            fn(query, 10)
+            samples.append(time.perf_counter() - start)
+        return summarize(samples)
+
+    def index_size(self, index):
+        postings = sum(
+            len(array) * array.itemsize + 64
+            for lists in (index.words, index.prefixes) for array in lists.values()
+        )
+        return (
+            len(index.titles)
+            + len(index.offsets) * index.offsets.itemsize
+            + len(index.song_ids) * index.song_ids.itemsize
+            + len(index.popularity) * index.popularity.itemsize
+            + postings
+        )
@@ -0,0 +1,150 @@
+import json
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from Room.benchmarks import rolled_back, summarize, video_id
+from Room.models import Membership, Room, RoomSong, Song, User, Vote
+from Room.roomcodes import get_code_allocator
+from Room.suggestions import Suggester, build_model, refresh_model, require_numpy
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the song suggestion model over --rooms rooms holding --votes votes, "
+        "then time suggestions from the memory-mapped model against counting "
+        "co-occurrences in SQL per request, and an incremental refresh against a "
+        "full rebuild. Everything is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=10_000)
+        parser.add_argument("--members", type=int, default=10)
+        parser.add_argument("--votes", type=int, default=1_000_000)
+        parser.add_argument("--songs", type=int, default=20_000, help="Catalog size.")
+        parser.add_argument("--queue", type=int, default=40, help="Songs per room.")
+        parser.add_argument("--genres", type=int, default=50)
+        parser.add_argument("--queries", type=int, default=1000)
+        parser.add_argument("--sql-queries", type=int, default=50)
+        parser.add_argument("--changed", type=int, default=100, help="Rooms voted in before the refresh.")
+        parser.add_argument("--json", action="store_true")
+
+    def handle(self, *args, **options):
+        require_numpy()
+        rng = random.Random(0)
+        report = {}
+
+        with rolled_back(), tempfile.TemporaryDirectory() as model_dir:
+            path = Path(model_dir) / "suggestions.model"
+            started = time.perf_counter()
+            rooms = self.seed(options, rng)
+            report["seed_s"] = round(time.perf_counter() - started, 1)
+            report["votes"] = Vote.objects.count()
+
+            report["build"] = build_model(path)
+            report["model_mb"] = round(os.path.getsize(path) / 2 ** 20, 1)
+
+            suggester = Suggester(path, reload_interval=60)
+            started = time.perf_counter()
+            suggester.model()
+            report["open_ms"] = round((time.perf_counter() - started) * 1000, 3)
+
+            queues = {
+                room_id: list(RoomSong.objects.filter(room_id=room_id).values_list("song_id", "vote_count"))
+                for room_id in rng.sample(rooms, min(options["queries"], len(rooms)))
+            }
+            samples = []
+            for queue in queues.values():
+                start = time.perf_counter()
+                suggester.suggest(queue, 10)
+                samples.append(time.perf_counter() - start)
+            report["suggest"] = summarize(samples)
+
+            samples = []
+            for room_id in list(queues)[:options["sql_queries"]]:
+                start = time.perf_counter()
+                self.sql_suggestions(room_id)
+                samples.append(time.perf_counter() - start)
+            report["sql_cooccurrence"] = summarize(samples)
+
+            for room_id in rng.sample(rooms, min(options["changed"], len(rooms))):
+                room_song = RoomSong.objects.filter(room_id=room_id).order_by("?").first()
+                Vote.objects.create(room_song=room_song, user=User.objects.create(username=f"bs-late-{room_id}"))
+            report["refresh"] = refresh_model(path)
+            report["rebuild"] = build_model(path.with_name("full.model"))
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        for name, value in report.items():
+            self.stdout.write(f"{name}: {value}")
+
+    def seed(self, options, rng):
+        """Rooms whose queues lean to one genre each, with `votes` votes among their members."""
+        rooms, members, queue = options["rooms"], options["members"], options["queue"]
+        votes_per_member = max(1, min(queue, options["votes"] // (rooms * members)))
+        genre_size = max(queue, options["songs"] // options["genres"])
+
+        users = User.objects.bulk_create(
+            (User(username=f"bs-{i}", password="!") for i in range(rooms * members)), batch_size=5000
+        )
+        codes = get_code_allocator().take(rooms)
+        created = Room.objects.bulk_create(
+            Room(room_code=codes[r], host=users[r * members]) for r in range(rooms)
+        )
+        Membership.objects.bulk_create(
+            (Membership(room=room, user=users[r * members + m]) for r, room in enumerate(created)
+             for m in range(members)),
+            batch_size=5000,
+        )
+        catalog = Song.objects.bulk_create(
+            (
+                Song(title=f"bs song {i}", video_id=video_id("bs", i), thumbnail="https://i.ytimg.com/x.jpg")
+                for i in range(options["songs"])
+            ),
+            batch_size=5000,
+        )
+
+        entries, picks = [], []
+        for r, room in enumerate(created):
+            genre = rng.randrange(options["genres"]) * genre_size
+            songs = set()
+            while len(songs) < queue:
+                if rng.random() < 0.8:
+                    songs.add(catalog[(genre + rng.randrange(genre_size)) % len(catalog)])
+                else:
+                    songs.add(rng.choice(catalog))
+            songs = list(songs)
+            counts = [0] * queue
+            for m in range(members):
+                for i in rng.sample(range(queue), votes_per_member):
+                    counts[i] += 1
+                    picks.append((len(entries) + i, users[r * members + m]))
+            entries.extend(
+                RoomSong(room=room, song=song, added_by=users[r * members], vote_count=counts[i])
+                for i, song in enumerate(songs)
+            )
+        entries = RoomSong.objects.bulk_create(entries, batch_size=5000)
+        Vote.objects.bulk_create(
+            (Vote(room_song=entries[i], user=user) for i, user in picks), batch_size=5000
+        )
+        return [room.id for room in created]
+
+    def sql_suggestions(self, room_id):
+        # What a suggestion request costs without a model: count the songs
+        # of every room sharing a song with this one.
+        queued = RoomSong.objects.filter(room_id=room_id).values("song_id")
+        neighbours = RoomSong.objects.filter(song_id__in=queued).values("room_id")
+        return list(
+            RoomSong.objects
+            .filter(room_id__in=neighbours)
+            .exclude(song_id__in=queued)
+            .values("song_id")
+            .annotate(score=Count("id"))
+            .order_by("-score")[:10]
+        )
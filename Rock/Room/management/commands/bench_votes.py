@@ -0,0 +1,88 @@
+import json
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from Room.benchmarks import rolled_back, seed_room, summarize
+from Room.models import RoomSong, Vote
+from Room.votebuffer import get_vote_buffer
+
+
+class Command(BaseCommand):
+    help = "Compare vote toggle throughput with and without the write-behind vote buffer."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=50)
+        parser.add_argument("--songs", type=int, default=20)
+        parser.add_argument("--toggles", type=int, default=2000)
+        parser.add_argument("--flush-size", type=int, default=500)
+        parser.add_argument("--json", action="store_true")
+
+    def handle(self, *args, **options):
+        report = {}
+        for mode in ("direct", "buffered"):
+            with rolled_back():
+                room = seed_room(options["songs"], members=options["users"], prefix=f"bv{mode}")
+                report[mode] = self.run(room, mode, options)
+
+        report["speedup"] = round(
+            report["buffered"]["throughput_tps"] / report["direct"]["throughput_tps"], 2
+        )
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        for name, value in report.items():
+            self.stdout.write(f"{name}: {value}")
+
+    def run(self, room, mode, options):
+        rng = random.Random(0)
+        room_song_ids = list(RoomSong.objects.filter(room=room).values_list("pk", flat=True))
+        clients = []
+        for user in room.members.all():
+            client = APIClient(SERVER_NAME="localhost")
+            client.force_authenticate(user)
+            client.get("/api/room/detail/")  # warm the membership cache
+            clients.append(client)
+
+        with tempfile.TemporaryDirectory() as journal_dir:
+            config = {
+                "ENABLED": mode == "buffered",
+                "FLUSH_INTERVAL": None,
+                "FLUSH_SIZE": options["flush_size"],
+                "JOURNAL": Path(journal_dir) / "votes.log",
+            }
+            with override_settings(VOTE_BUFFER=config):
+                get_vote_buffer.cache_clear()
+                buffer = get_vote_buffer()
+                samples, flushes = [], []
+                start = time.perf_counter()
+                for i in range(options["toggles"]):
+                    client = rng.choice(clients)
+                    url = f"/api/songs/{rng.choice(room_song_ids)}/vote/"
+                    began = time.perf_counter()
+                    client.post(url)
+                    samples.append(time.perf_counter() - began)
+                    if buffer and (i + 1) % options["flush_size"] == 0:
+                        began = time.perf_counter()
+                        buffer.flush()
+                        flushes.append(time.perf_counter() - began)
+                if buffer:
+                    began = time.perf_counter()
+                    buffer.flush()
+                    flushes.append(time.perf_counter() - began)
+                elapsed = time.perf_counter() - start
+            get_vote_buffer.cache_clear()
+
+        return {
+            "toggles": options["toggles"],
+            "elapsed_s": round(elapsed, 3),
+            "throughput_tps": round(options["toggles"] / elapsed, 1),
+            "request": summarize(samples),
+            "flush": summarize(flushes),
+            "votes_stored": Vote.objects.filter(room_song__room=room).count(),
+        }
@@ -0,0 +1,37 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Room.suggestions import SuggestionsUnavailable, build_model, refresh_model
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the song suggestion model from every room's queue and votes, or with "
+        "--incremental re-count only the rooms that changed since the last build. "
+        "Workers pick up the new file without a restart."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--incremental", action="store_true")
+        parser.add_argument(
+            "--every", type=float, metavar="SECONDS",
+            help="Keep refreshing incrementally, this many seconds apart.",
+        )
+        parser.add_argument("--path", help="Model file (default: SONG_SUGGESTIONS['PATH']).")
+
+    def handle(self, *args, **options):
+        try:
+            if options["every"]:
+                self.stdout.write("Refreshing song suggestions; Ctrl-C to stop.")
+                try:
+                    while True:
+                        self.stdout.write(json.dumps(refresh_model(options["path"])))
+                        time.sleep(options["every"])
+                except KeyboardInterrupt:
+                    return
+            build = refresh_model if options["incremental"] else build_model
+            self.stdout.write(json.dumps(build(options["path"])))
+        except SuggestionsUnavailable as exc:
+            raise CommandError(str(exc))
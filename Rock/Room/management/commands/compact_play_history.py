@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from Room.history import compact_queue, config, prune_history
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete long-played songs from the queue table and, with a retention set, "
+        "old plays from the play history. Works in batches; safe to run while the "
+        "server is up (e.g. from cron)."
+    )
+
+    def add_arguments(self, parser):
+        defaults = config()
+        parser.add_argument(
+            "--queue-retention", type=int, default=defaults["QUEUE_RETENTION"],
+            help="Seconds a played song stays in the queue table.",
+        )
+        parser.add_argument(
+            "--retention", type=int, default=defaults["RETENTION"],
+            help="Seconds of play history to keep (default: all of it).",
+        )
+        parser.add_argument("--batch-size", type=int, default=defaults["BATCH_SIZE"])
+
+    def handle(self, *args, **options):
+        removed = sum(compact_queue(options["queue_retention"], options["batch_size"]))
+        self.stdout.write(self.style.SUCCESS(f"Compacted {removed} played song(s) out of the queue"))
+
+        if options["retention"] is not None:
+            pruned = sum(prune_history(options["retention"], options["batch_size"]))
+            self.stdout.write(self.style.SUCCESS(f"Pruned {pruned} play(s) from the history"))
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from Room.votebuffer import build_vote_buffer
+
+
+class Command(BaseCommand):
+    help = (
+        "Write votes journaled by the vote buffer but never flushed, e.g. after a "
+        "worker crashed. Live workers' journals are left alone. Workers also do "
+        "this on their own when they start."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--journal", help="Journal base path (defaults to VOTE_BUFFER['JOURNAL']).")
+
+    def handle(self, *args, **options):
+        config = dict(getattr(settings, "VOTE_BUFFER", {}), FLUSH_INTERVAL=None)
+        if options["journal"]:
+            config["JOURNAL"] = options["journal"]
+        if not config.get("JOURNAL"):
+            self.stdout.write("No journal configured.")
+            return
+
+        replayed = build_vote_buffer(config).replay()
+        self.stdout.write(self.style.SUCCESS(f"Replayed {replayed} journaled vote(s)"))
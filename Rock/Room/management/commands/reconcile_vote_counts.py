@@ -0,0 +1,52 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+
+from Room.changes import record_changes
+from Room.models import Room, RoomSong, actual_vote_count
+
+
+class Command(BaseCommand):
+    help = "Recompute RoomSong.vote_count from the Vote table and repair drifted counters."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--room", help="Only reconcile the room with this code.")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report drifted counters without writing.",
+        )
+
+    def handle(self, *args, **options):
+        qs = RoomSong.objects.all()
+        if options["room"]:
+            try:
+                qs = qs.filter(room=Room.objects.get(room_code=options["room"]))
+            except Room.DoesNotExist:
+                raise CommandError(f"Room {options['room']} not found")
+
+        drifted = list(
+            qs.annotate(actual=actual_vote_count())
+            .exclude(vote_count=F("actual"))
+            .values_list("pk", flat=True)
+        )
+
+        if options["dry_run"]:
+            self.stdout.write(f"{len(drifted)} drifted counter(s)")
+            return
+
+        batch_size = options["batch_size"]
+        for start in range(0, len(drifted), batch_size):
+            batch = drifted[start:start + batch_size]
+            with transaction.atomic():
+                RoomSong.objects.filter(pk__in=batch).update(vote_count=actual_vote_count())
+                by_room = defaultdict(list)
+                for room_song_id, room_id in RoomSong.objects.filter(pk__in=batch).values_list("id", "room_id"):
+                    by_room[room_id].append(room_song_id)
+                for room_id, room_song_ids in by_room.items():
+                    record_changes(room_id, room_song_ids)
+
+        self.stdout.write(self.style.SUCCESS(f"Repaired {len(drifted)} counter(s)"))
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from Room.ingest import ImmediateExecutor, IngestQueue
+
+
+class Command(BaseCommand):
+    help = (
+        "Fetch metadata for placeholder songs still pending, e.g. because the "
+        "worker that queued them restarted or crashed. Processes also do this "
+        "for songs pending longer than SONG_INGEST['RECOVER_AFTER'] when they "
+        "start their ingest queue."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than",
+            type=float,
+            default=getattr(settings, "SONG_INGEST", {}).get("RECOVER_AFTER", 300),
+            help="Only songs whose newest placeholder is this many seconds old.",
+        )
+
+    def handle(self, *args, **options):
+        config = getattr(settings, "SONG_INGEST", {})
+        queue = IngestQueue(
+            executor=ImmediateExecutor(),
+            max_attempts=config.get("MAX_ATTEMPTS", 3),
+            backoff=config.get("BACKOFF", 1.0),
+        )
+        jobs = queue.recover(options["older_than"])
+        ready = sum(job.status == "ready" for job in jobs)
+        self.stdout.write(self.style.SUCCESS(
+            f"Recovered {len(jobs)} pending song(s): {ready} ready, {len(jobs) - ready} failed"
+        ))
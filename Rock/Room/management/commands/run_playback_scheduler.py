@@ -0,0 +1,31 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from Room.scheduler import get_scheduler
+
+
+class Command(BaseCommand):
+    help = (
+        "Advance rooms to their next song when the current one ends, instead of "
+        "waiting for the host's player. Run one (or, for redundancy, more) per "
+        "deployment; rooms still advance only once per song."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Advance the rooms due now and exit.")
+
+    def handle(self, *args, **options):
+        scheduler = get_scheduler()
+        if options["once"]:
+            scheduler.refresh()
+            scheduler.run_due()
+            self.stdout.write(json.dumps(scheduler.stats()))
+            return
+
+        self.stdout.write("Playback scheduler running; Ctrl-C to stop.")
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(json.dumps(scheduler.stats()))
@@ -0,0 +1,105 @@
+"""
+Resolves which room a user is in.
+
+The answer is memoized on the request and cached across requests in
+Django's cache. Membership changes invalidate it through the signals in
+signals.py, but with the default per-process cache only in the worker
+that made the change; the others may answer from a stale entry for up to
+MEMBERSHIP_CACHE_TTL seconds. So only reads (GET, HEAD, OPTIONS) use the
+cache. Writes such as SongAdd, SongImport, VoteToggle, CreateRoom and
+JoinRoom always ask the database, and refresh the cached answer. The
+Room row is not cached: its version and now_playing
+drive ETags, change cursors and PlayNextSong's compare-and-swap, and a
+copy cached in one worker would miss the others' writes. aget_room_id
+and aget_user_room are the versions for async views.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.permissions import SAFE_METHODS
+
+from .models import Membership, Room
+
+
+NO_ROOM = 0
+
+
+def cache_key(user_id):
+    return f"rock:room-of:{user_id}"
+
+
+def cache_ttl():
+    return getattr(settings, "MEMBERSHIP_CACHE_TTL", 60)
+
+
+def room_id_query(user_id):
+    return Membership.objects.filter(user_id=user_id).values_list("room_id", flat=True)
+
+
+def get_room_id(request):
+    if hasattr(request, "_rock_room_id"):
+        return request._rock_room_id
+
+    user = request.user
+    room_id = cache.get(cache_key(user.pk)) if request.method in SAFE_METHODS else None
+    if room_id is None:
+        room_id = room_id_query(user.pk).first() or NO_ROOM
+        cache.set(cache_key(user.pk), room_id, cache_ttl())
+
+    request._rock_room_id = room_id or None
+    return request._rock_room_id
+
+
+def get_user_room(request):
+    """The Room the requesting user belongs to, or None."""
+    if hasattr(request, "_rock_room"):
+        return request._rock_room
+
+    room_id = get_room_id(request)
+    room = Room.objects.select_related("host").filter(pk=room_id).first() if room_id else None
+    if room_id and room is None:
+        # Cached id of a room that has since been deleted.
+        forget_rooms([request.user.pk])
+        del request._rock_room_id
+        return get_user_room(request)
+
+    request._rock_room = room
+    return room
+
+
+async def aget_room_id(request):
+    if hasattr(request, "_rock_room_id"):
+        return request._rock_room_id
+
+    user = request.user
+    room_id = await cache.aget(cache_key(user.pk)) if request.method in SAFE_METHODS else None
+    if room_id is None:
+        room_id = await room_id_query(user.pk).afirst() or NO_ROOM
+        await cache.aset(cache_key(user.pk), room_id, cache_ttl())
+
+    request._rock_room_id = room_id or None
+    return request._rock_room_id
+
+
+async def aget_user_room(request):
+    if hasattr(request, "_rock_room"):
+        return request._rock_room
+
+    room_id = await aget_room_id(request)
+    room = await Room.objects.select_related("host").filter(pk=room_id).afirst() if room_id else None
+    if room_id and room is None:
+        await cache.adelete(cache_key(request.user.pk))
+        del request._rock_room_id
+        return await aget_user_room(request)
+
+    request._rock_room = room
+    return room
+
+
+def remember_room(request, room):
+    cache.set(cache_key(request.user.pk), room.pk if room else NO_ROOM, cache_ttl())
+    request._rock_room_id = room.pk if room else None
+    request._rock_room = room
+
+
+def forget_rooms(user_ids):
+    cache.delete_many([cache_key(user_id) for user_id in user_ids])
@@ -0,0 +1,456 @@
+"""
+YouTube metadata resolution for songs.
+
+Lookups go through the Song table, then a bounded TTL/LRU cache, and only
+then to the oEmbed endpoint. Concurrent lookups of the same video share a
+single upstream request, and videos YouTube reports as missing are cached
+negatively for a shorter period.
+
+aresolve is the version for async views. It fetches through
+AsyncOEmbedTransport when httpx is installed; without it, or with a custom
+sync TRANSPORT and no ASYNC_TRANSPORT, the fetch runs on a worker thread.
+
+oEmbed has no duration. With an API_KEY configured, each fetch also asks
+the YouTube Data API for it (DurationTransport), which the playback
+scheduler needs. A failed duration lookup leaves it unknown rather than
+failing the song.
+"""
+import asyncio
+import logging
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:  # optional; only used by async lookups
+    httpx = None
+
+
+OEMBED_URL = "https://www.youtube.com/oembed"
+WATCH_URL = "https://www.youtube.com/watch?v={}"
+DATA_API_URL = "https://www.googleapis.com/youtube/v3/videos"
+ISO_DURATION = re.compile(
+    r"^P(?:(?P<days>\d+)D)?(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?(?:(?P<seconds>\d+)S)?)?$"
+)
+
+logger = logging.getLogger(__name__)
+
+
+class VideoNotFound(Exception):
+    pass
+
+
+class MetadataUnavailable(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class VideoMetadata:
+    video_id: str
+    title: str
+    thumbnail: str
+    duration: int = None
+
+
+class OEmbedTransport:
+    """Fetches oEmbed documents over a pooled keep-alive session."""
+
+    def __init__(self, url=OEMBED_URL, timeout=5, pool_size=10):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __call__(self, video_id):
+        try:
+            resp = self.session.get(
+                self.url,
+                params={"url": WATCH_URL.format(video_id), "format": "json"},
+                timeout=self.timeout,
+            )
+        except requests.RequestException as exc:
+            raise MetadataUnavailable(str(exc)) from exc
+        return read_oembed(resp, video_id)
+
+
+class DurationTransport:
+    """Looks up video lengths, in seconds, through the YouTube Data API."""
+
+    def __init__(self, key, url=DATA_API_URL, timeout=5, pool_size=10):
+        self.key = key
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+
+    def __call__(self, video_id):
+        try:
+            resp = self.session.get(
+                self.url,
+                params={"part": "contentDetails", "id": video_id, "key": self.key},
+                timeout=self.timeout,
+            )
+            resp.raise_for_status()
+            items = resp.json().get("items") or []
+        except (requests.RequestException, ValueError) as exc:
+            raise MetadataUnavailable(str(exc)) from exc
+        if not items:
+            return None
+        return parse_duration(items[0]["contentDetails"]["duration"])
+
+
+def parse_duration(value):
+    """Seconds in an ISO 8601 duration such as PT4M13S, or None."""
+    match = ISO_DURATION.match(value or "")
+    if not match:
+        return None
+    parts = {name: int(amount or 0) for name, amount in match.groupdict().items()}
+    return ((parts["days"] * 24 + parts["hours"]) * 60 + parts["minutes"]) * 60 + parts["seconds"]
+
+
+class AsyncOEmbedTransport:
+    """The httpx counterpart of OEmbedTransport, with one client per event loop."""
+
+    def __init__(self, url=OEMBED_URL, timeout=5, pool_size=10):
+        if httpx is None:
+            raise ImproperlyConfigured("AsyncOEmbedTransport needs the httpx package (see requirements-dev.txt)")
+        self.url = url
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._clients = weakref.WeakKeyDictionary()
+
+    def client(self):
+        # httpx pools connections per event loop.
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size,
+                ),
+            )
+        return client
+
+    async def __call__(self, video_id):
+        try:
+            resp = await self.client().get(
+                self.url,
+                params={"url": WATCH_URL.format(video_id), "format": "json"},
+            )
+        except httpx.HTTPError as exc:
+            raise MetadataUnavailable(str(exc)) from exc
+        return read_oembed(resp, video_id)
+
+
+def read_oembed(resp, video_id):
+    if resp.status_code in (400, 401, 403, 404):
+        raise VideoNotFound(video_id)
+    if resp.status_code != 200:
+        raise MetadataUnavailable(f"oEmbed answered {resp.status_code}")
+    try:
+        return resp.json()
+    except ValueError as exc:
+        raise MetadataUnavailable("Malformed oEmbed response") from exc
+
+
+class TTLCache:
+    def __init__(self, maxsize, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= self.clock():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (self.clock() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MetadataResolver:
+    def __init__(self, transport=None, cache_size=10000, ttl=3600, negative_ttl=300,
+                 max_workers=8, clock=time.monotonic, async_transport=None, durations=None):
+        self.transport = transport or OEmbedTransport()
+        self.async_transport = async_transport
+        self.durations = durations
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_workers = max_workers
+        self.cache = TTLCache(cache_size, clock)
+        self._inflight = {}
+        self._ainflight = {}
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(
+            ("cache_hits", "negative_hits", "db_hits", "misses", "coalesced",
+             "fetches", "not_found", "errors", "duration_errors"),
+            0,
+        )
+        self._fetch_seconds = 0.0
+        self._fetch_max = 0.0
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            fetched = stats["fetches"]
+            stats["fetch_mean_ms"] = round(self._fetch_seconds / fetched * 1000, 3) if fetched else 0.0
+            stats["fetch_max_ms"] = round(self._fetch_max * 1000, 3)
+        stats["cache_size"] = len(self.cache)
+        return stats
+
+    def _cached(self, video_id):
+        cached = self.cache.get(video_id)
+        if cached is None:
+            return None
+        if isinstance(cached, VideoNotFound):
+            self._count("negative_hits")
+            raise VideoNotFound(video_id)
+        self._count("cache_hits")
+        return cached
+
+    def resolve(self, video_id):
+        cached = self._cached(video_id)
+        if cached is not None:
+            return cached
+
+        from .models import Song
+
+        row = (
+            Song.objects
+            .filter(video_id=video_id, status=Song.Status.READY)
+            .values_list("title", "thumbnail", "duration")
+            .first()
+        )
+        if row:
+            self._count("db_hits")
+            meta = VideoMetadata(video_id, *row)
+            self.cache.set(video_id, meta, self.ttl)
+            return meta
+
+        self._count("misses")
+        return self._fetch(video_id)
+
+    async def aresolve(self, video_id):
+        cached = self._cached(video_id)
+        if cached is not None:
+            return cached
+
+        from .models import Song
+
+        row = await (
+            Song.objects
+            .filter(video_id=video_id, status=Song.Status.READY)
+            .values_list("title", "thumbnail", "duration")
+            .afirst()
+        )
+        if row:
+            self._count("db_hits")
+            meta = VideoMetadata(video_id, *row)
+            self.cache.set(video_id, meta, self.ttl)
+            return meta
+
+        self._count("misses")
+        if self.async_transport is None:
+            return await sync_to_async(self._fetch, thread_sensitive=False)(video_id)
+        return await self._afetch(video_id)
+
+    def resolve_many(self, video_ids):
+        """
+        Resolve a batch of ids with one Song query and bounded parallel
+        fetches. Returns {video_id: VideoMetadata or exception}.
+        """
+        from .models import Song
+
+        results = {}
+        pending = []
+        for video_id in dict.fromkeys(video_ids):
+            try:
+                cached = self._cached(video_id)
+            except VideoNotFound as exc:
+                results[video_id] = exc
+                continue
+            if cached is not None:
+                results[video_id] = cached
+            else:
+                pending.append(video_id)
+
+        if pending:
+            rows = (
+                Song.objects
+                .filter(video_id__in=pending, status=Song.Status.READY)
+                .values_list("video_id", "title", "thumbnail", "duration")
+            )
+            for video_id, title, thumbnail, duration in rows:
+                meta = VideoMetadata(video_id, title, thumbnail, duration)
+                self.cache.set(video_id, meta, self.ttl)
+                results[video_id] = meta
+                self._count("db_hits")
+            pending = [video_id for video_id in pending if video_id not in results]
+
+        if pending:
+            self._count("misses", len(pending))
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending))) as pool:
+                futures = {video_id: pool.submit(self._fetch, video_id) for video_id in pending}
+            for video_id, future in futures.items():
+                results[video_id] = future.exception() or future.result()
+        return results
+
+    def _fetch(self, video_id):
+        with self._lock:
+            future = self._inflight.get(video_id)
+            leader = future is None
+            if leader:
+                future = self._inflight[video_id] = Future()
+            else:
+                self._counters["coalesced"] += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            meta = self._fetch_upstream(video_id)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(meta)
+            return meta
+        finally:
+            with self._lock:
+                self._inflight.pop(video_id, None)
+
+    async def _afetch(self, video_id):
+        key = (asyncio.get_running_loop(), video_id)
+        task = self._ainflight.get(key)
+        if task is None:
+            task = self._ainflight[key] = asyncio.ensure_future(self._afetch_upstream(video_id))
+            task.add_done_callback(lambda _: self._ainflight.pop(key, None))
+        else:
+            self._count("coalesced")
+        # A cancelled caller must not cancel the fetch others are waiting on.
+        return await asyncio.shield(task)
+
+    def _fetch_upstream(self, video_id):
+        with self._upstream(video_id):
+            doc = self.transport(video_id)
+            meta = VideoMetadata(video_id, doc["title"], doc["thumbnail_url"], self._duration(video_id))
+        self.cache.set(video_id, meta, self.ttl)
+        return meta
+
+    async def _afetch_upstream(self, video_id):
+        with self._upstream(video_id):
+            doc = await self.async_transport(video_id)
+            duration = await sync_to_async(self._duration, thread_sensitive=False)(video_id)
+            meta = VideoMetadata(video_id, doc["title"], doc["thumbnail_url"], duration)
+        self.cache.set(video_id, meta, self.ttl)
+        return meta
+
+    def _duration(self, video_id):
+        if self.durations is None:
+            return None
+        try:
+            return self.durations(video_id)
+        except (MetadataUnavailable, KeyError, TypeError) as exc:
+            self._count("duration_errors")
+            logger.warning("No duration for %s: %s", video_id, exc)
+            return None
+
+    @contextmanager
+    def _upstream(self, video_id):
+        start = time.perf_counter()
+        try:
+            yield
+        except VideoNotFound as exc:
+            self._count("not_found")
+            self.cache.set(video_id, exc, self.negative_ttl)
+            raise
+        except (KeyError, TypeError) as exc:
+            self._count("errors")
+            raise MetadataUnavailable("Incomplete oEmbed response") from exc
+        except MetadataUnavailable:
+            self._count("errors")
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._counters["fetches"] += 1
+                self._fetch_seconds += elapsed
+                self._fetch_max = max(self._fetch_max, elapsed)
+
+
+def build_resolver(config):
+    transport = config.get("TRANSPORT")
+    async_transport = config.get("ASYNC_TRANSPORT")
+    if isinstance(async_transport, str):
+        async_transport = import_string(async_transport)()
+    elif async_transport is None and transport is None and httpx is not None:
+        async_transport = AsyncOEmbedTransport(
+            url=config.get("URL", OEMBED_URL),
+            timeout=config.get("TIMEOUT", 5),
+            pool_size=config.get("POOL_SIZE", 10),
+        )
+    if isinstance(transport, str):
+        transport = import_string(transport)()
+    elif transport is None:
+        transport = OEmbedTransport(
+            url=config.get("URL", OEMBED_URL),
+            timeout=config.get("TIMEOUT", 5),
+            pool_size=config.get("POOL_SIZE", 10),
+        )
+    durations = config.get("DURATIONS")
+    if isinstance(durations, str):
+        durations = import_string(durations)()
+    elif durations is None and config.get("TRANSPORT") is None and config.get("API_KEY"):
+        durations = DurationTransport(config["API_KEY"], timeout=config.get("TIMEOUT", 5))
+    return MetadataResolver(
+        transport=transport,
+        async_transport=async_transport,
+        durations=durations,
+        cache_size=config.get("CACHE_SIZE", 10000),
+        ttl=config.get("CACHE_TTL", 3600),
+        negative_ttl=config.get("NEGATIVE_TTL", 300),
+        max_workers=config.get("MAX_WORKERS", 8),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_resolver():
+    return build_resolver(getattr(settings, "YOUTUBE_OEMBED", {}))
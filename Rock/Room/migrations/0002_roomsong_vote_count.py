@@ -0,0 +1,39 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:24
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_vote_counts(apps, schema_editor):
+    RoomSong = apps.get_model('Room', 'RoomSong')
+    Vote = apps.get_model('Room', 'Vote')
+    counts = (
+        Vote.objects
+        .filter(room_song=OuterRef('pk'))
+        .order_by()
+        .values('room_song')
+        .annotate(total=Count('pk'))
+        .values('total')
+    )
+    RoomSong.objects.update(vote_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Room', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roomsong',
+            name='vote_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_vote_counts, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='roomsong',
+            index=models.Index(fields=['room', 'played_at', '-vote_count', 'created_at'], name='roomsong_queue_rank_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Room', '0002_roomsong_vote_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], default='ready', max_length=10),
+        ),
+    ]
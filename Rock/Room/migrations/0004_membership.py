@@ -0,0 +1,59 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def keep_latest_membership(apps, schema_editor):
+    # Users could end up in several rooms through the old exists()/add()
+    # race; keep their most recent membership before adding the constraint.
+    Membership = apps.get_model('Room', 'Membership')
+    seen = set()
+    stale = []
+    for pk, user_id in Membership.objects.order_by('-pk').values_list('pk', 'user_id'):
+        if user_id in seen:
+            stale.append(pk)
+        seen.add(user_id)
+    Membership.objects.filter(pk__in=stale).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Room', '0003_song_status'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # Adopt the auto-created members table as an explicit through model.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='Membership',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='Room.room')),
+                        ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                    ],
+                    options={
+                        'db_table': 'Room_room_members',
+                        'unique_together': {('room', 'user')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='room',
+                    name='members',
+                    field=models.ManyToManyField(blank=True, related_name='rooms', through='Room.Membership', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+        migrations.RunPython(keep_latest_membership, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='membership',
+            unique_together=set(),
+        ),
+        migrations.AlterField(
+            model_name='membership',
+            name='user',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='membership', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_now_playing(apps, schema_editor):
+    Room = apps.get_model('Room', 'Room')
+    RoomSong = apps.get_model('Room', 'RoomSong')
+    latest = (
+        RoomSong.objects
+        .filter(room=OuterRef('pk'), played_at__isnull=False)
+        .order_by('-played_at')
+        .values('pk')[:1]
+    )
+    Room.objects.update(now_playing=Subquery(latest))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Room', '0004_membership'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='now_playing',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='Room.roomsong'),
+        ),
+        migrations.RunPython(backfill_now_playing, migrations.RunPython.noop),
+    ]
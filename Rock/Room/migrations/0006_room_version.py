@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Room', '0005_room_now_playing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
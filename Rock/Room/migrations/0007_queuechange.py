@@ -0,0 +1,26 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Room', '0006_room_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField()),
+                ('room_song_id', models.BigIntegerField()),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='queue_changes', to='Room.room')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'version'], name='Room_queuec_room_id_412ed4_idx')],
+            },
+        ),
+    ]
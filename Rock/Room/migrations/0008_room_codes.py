@@ -0,0 +1,27 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Room', '0007_queuechange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FreedRoomCode',
+            fields=[
+                ('code', models.CharField(max_length=6, primary_key=True, serialize=False)),
+                ('freed_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RoomCodeSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('next_value', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_history(apps, schema_editor):
+    # The last play of each song is all the queue table remembers.
+    RoomSong = apps.get_model("Room", "RoomSong")
+    PlayHistory = apps.get_model("Room", "PlayHistory")
+    played = RoomSong.objects.filter(played_at__isnull=False).values_list("room_id", "song_id", "played_at")
+    PlayHistory.objects.bulk_create(
+        (PlayHistory(room_id=room_id, song_id=song_id, played_at=played_at)
+         for room_id, song_id, played_at in played.iterator()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Room', '0008_room_codes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlayHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('played_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='roomsong',
+            name='roomsong_queue_rank_idx',
+        ),
+        migrations.AddIndex(
+            model_name='roomsong',
+            index=models.Index(condition=models.Q(('played_at__isnull', True)), fields=['room', '-vote_count', 'created_at'], name='roomsong_unplayed_rank_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='roomsong',
+            index=models.Index(condition=models.Q(('played_at__isnull', False)), fields=['room', '-vote_count', 'created_at'], name='roomsong_played_rank_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='roomsong',
+            index=models.Index(condition=models.Q(('played_at__isnull', False)), fields=['played_at'], name='roomsong_played_at_idx'),
+        ),
+        migrations.AddField(
+            model_name='playhistory',
+            name='room',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='play_history', to='Room.room'),
+        ),
+        migrations.AddField(
+            model_name='playhistory',
+            name='song',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='Room.song'),
+        ),
+        migrations.AddIndex(
+            model_name='playhistory',
+            index=models.Index(fields=['room', '-played_at'], name='Room_playhi_room_id_dc6572_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='playhistory',
+            index=models.Index(fields=['played_at'], name='Room_playhi_played__105cc6_idx'),
+        ),
+        migrations.RunPython(backfill_history, migrations.RunPython.noop),
+    ]
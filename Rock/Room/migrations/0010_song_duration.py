@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Room', '0009_play_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='duration',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations
+
+
+# Only PostgreSQL gets the index (search.PostgresSongSearch); creating the
+# pg_trgm extension needs a role allowed to, e.g. the database owner.
+FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    'CREATE INDEX IF NOT EXISTS song_title_trgm_idx ON "Room_song" USING gin (title gin_trgm_ops)',
+]
+BACKWARD = ["DROP INDEX IF EXISTS song_title_trgm_idx"]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        if schema_editor.connection.vendor != "postgresql":
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Room', '0010_song_duration'),
+    ]
+
+    operations = [
+        migrations.RunPython(run(FORWARD), run(BACKWARD)),
+    ]
@@ -1,10 +1,10 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
 from django.utils import timezone
 from datetime import timedelta
-import random
-import string
 
 
 class User(AbstractUser):
@@ -20,31 +20,81 @@ class Room(models.Model):
     )
     members = models.ManyToManyField(
         settings.AUTH_USER_MODEL,
+        through="Membership",
         related_name="rooms",
         blank=True
     )
     created_at = models.DateTimeField(auto_now_add=True)
+    # Advanced by playback.play_next with a compare-and-swap on this column.
+    now_playing = models.ForeignKey(
+        "RoomSong",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+"
+    )
+    # Bumped by every queue, vote and playback change (changes.py); the
+    # queue and now-playing ETags and the queue change cursor use it.
+    version = models.PositiveBigIntegerField(default=0)
 
     def save(self, *args, **kwargs):
-        if not self.room_code:
-            self.room_code = self.generate_code()
-        super().save(*args, **kwargs)
+        if self.room_code:
+            return super().save(*args, **kwargs)
+
+        from .roomcodes import get_code_allocator
 
-    def generate_code(self):
-        chars = string.ascii_uppercase + string.digits
+        allocator = get_code_allocator()
         while True:
-            code = ''.join(random.choices(chars, k=6))
-            if not Room.objects.filter(room_code=code).exists():
-                return code
+            self.room_code = allocator.allocate()
+            try:
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                # Only a code handed out before the allocator (or by hand)
+                # can collide; anything else is the caller's problem.
+                if not Room.objects.filter(room_code=self.room_code).exists():
+                    self.room_code = ""
+                    raise
 
     def __str__(self):
         return f"Room {self.room_code}"
 
 
+class Membership(models.Model):
+    room = models.ForeignKey(
+        Room,
+        on_delete=models.CASCADE,
+        related_name="memberships"
+    )
+    # One room per user, enforced by the schema.
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="membership"
+    )
+
+    class Meta:
+        db_table = "Room_room_members"
+
+    def __str__(self):
+        return f"{self.user_id} in {self.room_id}"
+
+
 class Song(models.Model):
+    class Status(models.TextChoices):
+        PENDING = "pending"
+        READY = "ready"
+        FAILED = "failed"
+
     title = models.CharField(max_length=250)
     video_id = models.CharField(max_length=50, unique=True)
     thumbnail = models.URLField()
+    # Songs added in async ingest mode start as placeholders until their
+    # metadata has been fetched (see ingest.py).
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.READY)
+    # Seconds; unknown without a YouTube Data API key (metadata.py). The
+    # playback scheduler only advances rooms past songs with a duration.
+    duration = models.PositiveIntegerField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.title} ({self.video_id})"
@@ -67,11 +117,32 @@ class RoomSong(models.Model):
     )
     created_at = models.DateTimeField(auto_now_add=True)
     played_at = models.DateTimeField(null=True, blank=True)
+    # Maintained by the Vote signals in signals.py; repair drift with
+    # `manage.py reconcile_vote_counts`.
+    vote_count = models.PositiveIntegerField(default=0)
 
     class Meta:
         unique_together = ("room", "song")
         indexes = [
             models.Index(fields=["room", "created_at"]),
+            # The live queue in play order; played rows stay out of it.
+            models.Index(
+                fields=["room", "-vote_count", "created_at"],
+                condition=models.Q(played_at__isnull=True),
+                name="roomsong_unplayed_rank_idx",
+            ),
+            # Played rows in the same order, for songs out of their cooldown.
+            models.Index(
+                fields=["room", "-vote_count", "created_at"],
+                condition=models.Q(played_at__isnull=False),
+                name="roomsong_played_rank_idx",
+            ),
+            # Played rows by age, for compaction (history.py).
+            models.Index(
+                fields=["played_at"],
+                condition=models.Q(played_at__isnull=False),
+                name="roomsong_played_at_idx",
+            ),
         ]
 
     def mark_played(self):
@@ -111,3 +182,81 @@ class Vote(models.Model):
 
     def __str__(self):
         return f"Vote: {self.user_id} → {self.room_song_id}"
+
+
+def actual_vote_count():
+    """RoomSong.vote_count recomputed from the Vote table, for annotate() or update()."""
+    counts = (
+        Vote.objects
+        .filter(room_song=OuterRef("pk"))
+        .order_by()
+        .values("room_song")
+        .annotate(total=Count("pk"))
+        .values("total")
+    )
+    return Coalesce(Subquery(counts), 0)
+
+
+class QueueChange(models.Model):
+    """A queue entry touched by the change that moved its room to `version`."""
+    room = models.ForeignKey(
+        Room,
+        on_delete=models.CASCADE,
+        related_name="queue_changes"
+    )
+    version = models.PositiveBigIntegerField()
+    # Not a foreign key: removals are logged after the row is gone.
+    room_song_id = models.BigIntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=["room", "version"])]
+
+    def __str__(self):
+        return f"{self.room_id}@{self.version}: {self.room_song_id}"
+
+
+class PlayHistory(models.Model):
+    """
+    One play of a song in a room, written by playback.play_next. It keeps
+    what RoomSong forgets when a song is replayed or compacted away.
+    """
+    room = models.ForeignKey(
+        Room,
+        on_delete=models.CASCADE,
+        related_name="play_history"
+    )
+    song = models.ForeignKey(
+        Song,
+        on_delete=models.CASCADE,
+        related_name="+"
+    )
+    played_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["room", "-played_at"]),
+            models.Index(fields=["played_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.song_id} in {self.room_id} at {self.played_at:%Y-%m-%d %H:%M}"
+
+
+class RoomCodeSequence(models.Model):
+    """
+    Next unissued position of the room code sequence. Allocators reserve
+    blocks of it (Room/roomcodes.py); there is a single row.
+    """
+    next_value = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"Room codes from {self.next_value}"
+
+
+class FreedRoomCode(models.Model):
+    """The code of a deleted room, reusable once its quarantine is over."""
+    code = models.CharField(max_length=6, primary_key=True)
+    freed_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.code} (freed {self.freed_at:%Y-%m-%d %H:%M})"
@@ -0,0 +1,128 @@
+"""
+Advancing a room to its next song.
+
+play_next runs as one transaction. It locks the room row, selects the best
+eligible song in SQL (unplayed, or played before the cooldown window) and
+moves Room.now_playing with a compare-and-swap against the song the caller
+last saw. Concurrent or repeated "next" requests for the same current song
+therefore advance the room at most once. Each play is also appended to
+PlayHistory; history.py compacts both tables.
+"""
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+
+from django.db import OperationalError, connection, transaction
+from django.utils import timezone
+
+from .changes import record_changes
+from .models import PlayHistory, Room, RoomSong
+from .realtime import broadcast
+
+
+COOLDOWN = timedelta(minutes=10)
+LOCK_RETRIES = 5
+
+
+class NoPlayableSongs(Exception):
+    pass
+
+
+@dataclass
+class PlayResult:
+    room_song: RoomSong
+    advanced: bool
+
+    def as_dict(self):
+        room_song = self.room_song
+        return {
+            "room_song_id": room_song.id if room_song else None,
+            "video_id": room_song.song.video_id if room_song else None,
+            "title": room_song.song.title if room_song else None,
+            "advanced": self.advanced,
+        }
+
+
+def eligible_songs(room_id, now):
+    """
+    The best unplayed song and the best song out of its cooldown, each
+    read through its partial index rather than by scanning the room.
+    """
+    room_songs = RoomSong.objects.filter(room_id=room_id).order_by("-vote_count", "created_at")
+    return (
+        room_songs.filter(played_at__isnull=True),
+        room_songs.filter(played_at__isnull=False, played_at__lt=now - COOLDOWN),
+    )
+
+
+def pick_next(room_id, now):
+    best = None
+    for candidates in eligible_songs(room_id, now):
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        row = candidates.values_list("vote_count", "created_at", "pk").first()
+        if row is not None and (best is None or (-row[0], row[1]) < (-best[0], best[1])):
+            best = row
+    return best[2] if best else None
+
+
+def current_song(room_id):
+    return (
+        RoomSong.objects
+        .select_related("song")
+        .filter(pk=Room.objects.filter(pk=room_id).values("now_playing_id")[:1])
+        .first()
+    )
+
+
+def play_next(room_id, expected):
+    """
+    Advance the room if it is still playing `expected` (a RoomSong id or
+    None). Otherwise leave it alone and report what is playing now.
+    """
+    for attempt in range(LOCK_RETRIES):
+        try:
+            return _play_next(room_id, expected)
+        except OperationalError as exc:
+            # SQLite has no row locks; a competing writer surfaces as
+            # "database is locked" and the whole transaction is retried.
+            if connection.vendor != "sqlite" or "locked" not in str(exc):
+                raise
+            if attempt == LOCK_RETRIES - 1 or connection.in_atomic_block:
+                raise
+            time.sleep(0.02 * (attempt + 1))
+
+
+def _play_next(room_id, expected):
+    with transaction.atomic():
+        current = (
+            Room.objects
+            .select_for_update()
+            .filter(pk=room_id)
+            .values_list("now_playing_id", flat=True)
+            .get()
+        )
+        if current != expected:
+            return PlayResult(current_song(room_id), advanced=False)
+
+        now = timezone.now()
+        next_id = pick_next(room_id, now)
+        if next_id is None:
+            raise NoPlayableSongs
+
+        swapped = Room.objects.filter(pk=room_id, now_playing_id=current).update(now_playing_id=next_id)
+        if not swapped:
+            return PlayResult(current_song(room_id), advanced=False)
+        RoomSong.objects.filter(pk=next_id).update(played_at=now)
+        record_changes(room_id, [next_id])
+
+        room_song = RoomSong.objects.select_related("song").get(pk=next_id)
+        PlayHistory.objects.create(room_id=room_id, song_id=room_song.song_id, played_at=now)
+        broadcast(room_id, "now_playing", {
+            "room_song_id": room_song.id,
+            "video_id": room_song.song.video_id,
+            "title": room_song.song.title,
+            "played_at": room_song.played_at,
+            "duration": room_song.song.duration,
+        })
+        return PlayResult(room_song, advanced=True)
@@ -0,0 +1,227 @@
+"""
+Per-request profiling: SQL query count, DB time, serializer time and total
+latency, aggregated per URL name.
+
+ProfilingMiddleware records every request. With PROFILING["HEADERS"] on
+(the default when DEBUG is), responses carry X-Query-Count and a
+Server-Timing header that browser dev tools display. The aggregate, with a
+latency histogram per URL name, is served to admins at /api/debug/profile/.
+
+Queries are counted by an execute wrapper installed on every database
+connection as it opens, which reports to the profile of the request in
+the current context. That covers async views too, whose ORM calls run on
+sync_to_async threads with a copy of the request's context.
+
+Tests read the profile of a test-client response through
+QueryBudgetMixin.assertQueryBudget.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+_current = ContextVar("rock_profile", default=None)
+
+
+def config():
+    return {"ENABLED": True, "HEADERS": settings.DEBUG, **getattr(settings, "PROFILING", {})}
+
+
+class RequestProfile:
+    def __init__(self):
+        self.url_name = None
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.total_time = 0.0
+        self.statements = []
+        self.started = time.perf_counter()
+
+    def execute(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+            self.statements.append(sql)
+
+    def headers(self):
+        return {
+            "X-Query-Count": str(self.queries),
+            "Server-Timing": ", ".join([
+                f"db;dur={self.db_time * 1000:.2f}",
+                f"serializer;dur={self.serializer_time * 1000:.2f}",
+                f"total;dur={self.total_time * 1000:.2f}",
+            ]),
+        }
+
+
+def record_query(execute, sql, params, many, context):
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    return profile.execute(execute, sql, params, many, context)
+
+
+def install(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install)
+
+
+@contextmanager
+def serializer_timer():
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.serializer_time += time.perf_counter() - start
+
+
+class ProfiledDataMixin:
+    """Counts the time spent producing `serializer.data` as serializer time."""
+
+    @property
+    def data(self):
+        with serializer_timer():
+            return super().data
+
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.total_time = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, profile):
+        self.requests += 1
+        self.queries += profile.queries
+        self.max_queries = max(self.max_queries, profile.queries)
+        self.db_time += profile.db_time
+        self.serializer_time += profile.serializer_time
+        self.total_time += profile.total_time
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, profile.total_time * 1000)] += 1
+
+    def as_dict(self):
+        n = self.requests or 1
+        return {
+            "requests": self.requests,
+            "mean_queries": round(self.queries / n, 2),
+            "max_queries": self.max_queries,
+            "mean_db_ms": round(self.db_time / n * 1000, 3),
+            "mean_serializer_ms": round(self.serializer_time / n * 1000, 3),
+            "mean_total_ms": round(self.total_time / n * 1000, 3),
+            "latency_histogram_ms": {
+                (f"<={bound}" if i < len(LATENCY_BUCKETS_MS) else f">{LATENCY_BUCKETS_MS[-1]}"): count
+                for i, (bound, count) in enumerate(zip(LATENCY_BUCKETS_MS + (None,), self.histogram))
+            },
+        }
+
+
+class ProfileStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def add(self, profile):
+        with self._lock:
+            self._endpoints.setdefault(profile.url_name, EndpointStats()).add(profile)
+
+    def snapshot(self):
+        with self._lock:
+            return {name: stats.as_dict() for name, stats in sorted(self._endpoints.items())}
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+stats = ProfileStats()
+
+
+class ProfilingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        # Connections opened before this module was imported.
+        for connection in connections.all(initialized_only=True):
+            install(connection)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        options = config()
+        if not options["ENABLED"]:
+            return self.get_response(request)
+
+        profile, token = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, profile, options)
+
+    async def __acall__(self, request):
+        options = config()
+        if not options["ENABLED"]:
+            return await self.get_response(request)
+
+        profile, token = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, profile, options)
+
+    def start(self):
+        profile = RequestProfile()
+        return profile, _current.set(profile)
+
+    def finish(self, request, response, profile, options):
+        profile.total_time = time.perf_counter() - profile.started
+
+        match = request.resolver_match
+        profile.url_name = (match.url_name if match else None) or "unresolved"
+        stats.add(profile)
+
+        response.profile = profile
+        if options["HEADERS"]:
+            for name, value in profile.headers().items():
+                response.headers[name] = value
+        return response
+
+
+class QueryBudgetMixin:
+    """TestCase mixin asserting how many queries a request may run."""
+
+    def assertQueryBudget(self, response, budget):
+        profile = response.profile
+        if profile.queries > budget:
+            listing = "\n".join(f"  {sql}" for sql in profile.statements)
+            self.fail(
+                f"{profile.url_name} ran {profile.queries} queries, budget is {budget}:\n{listing}"
+            )
@@ -0,0 +1,97 @@
+"""
+The serialized queue, shared by every listener of a room.
+
+The ranked, serialized queue only depends on the room's version, so it is
+built once per version and kept in the room cache (roomcache.py), which
+also makes concurrent misses wait for a single build. It is built straight from
+a `.values()` row per entry rather than through RoomSongSerializer, whose
+output format it reproduces (see queue_row). The only per-listener
+field, has_voted, is filled in from the caller's voted set, which is one
+indexed query on Vote.user. aranked_queue and aqueue_for serve async views.
+"""
+from .models import RoomSong, Vote
+from .profiling import serializer_timer
+from .roomcache import get_room_cache
+
+
+QUEUE_COLUMNS = ("id", "song__title", "song__video_id", "song__thumbnail", "vote_count")
+
+
+def cache_name(room):
+    return f"queue:{room.version}"
+
+
+def ranked_queue(room):
+    """Serialized unplayed songs in play order, with has_voted unset."""
+    return get_room_cache().get_or_load(
+        room.id, cache_name(room), lambda: build_queue(list(queue_rows(room)))
+    )
+
+
+async def aranked_queue(room):
+    async def load():
+        return build_queue([row async for row in queue_rows(room)])
+
+    return await get_room_cache().aget_or_load(room.id, cache_name(room), load)
+
+
+def queue_rows(room):
+    return (
+        RoomSong.objects
+        .filter(room=room, played_at__isnull=True)
+        .order_by("-vote_count", "created_at")
+        .values_list(*QUEUE_COLUMNS)
+    )
+
+
+def build_queue(rows):
+    with serializer_timer():
+        return [queue_row(*row) for row in rows]
+
+
+def queue_row(id, title, video_id, thumbnail, vote_count, has_voted=False):
+    # Same keys, order and types as RoomSongSerializer.
+    return {
+        "id": id,
+        "title": title,
+        "video_id": video_id,
+        "thumbnail": thumbnail,
+        "vote_count": vote_count,
+        "has_voted": has_voted,
+    }
+
+
+def voted_query(room, user):
+    return (
+        Vote.objects
+        .filter(user=user, room_song__room=room, room_song__played_at__isnull=True)
+        .values_list("room_song_id", flat=True)
+    )
+
+
+def voted_ids(room, user):
+    return set(voted_query(room, user))
+
+
+def queue_for(room, user, only=None):
+    """
+    The room's queue as `user` sees it, optionally restricted to the ids in
+    `only`.
+    """
+    songs = ranked_queue(room)
+    if only is not None:
+        songs = [song for song in songs if song["id"] in only]
+    if not songs:
+        return []
+    return with_votes(songs, voted_ids(room, user))
+
+
+async def aqueue_for(room, user):
+    songs = await aranked_queue(room)
+    if not songs:
+        return []
+    return with_votes(songs, {room_song_id async for room_song_id in voted_query(room, user)})
+
+
+def with_votes(songs, voted):
+    return [{**song, "has_voted": song["id"] in voted} for song in songs]
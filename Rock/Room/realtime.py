@@ -0,0 +1,355 @@
+import asyncio
+import json
+import queue
+import threading
+import time
+from fnmatch import fnmatchcase
+from functools import lru_cache
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils.module_loading import import_string
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+
+EVENTS_PATH = "/api/room/events/"
+KEEPALIVE_SECONDS = 15
+SUBSCRIBER_BUFFER = 256
+
+
+# ------------------------
+# Backplanes
+# ------------------------
+
+class Subscription:
+    def __init__(self, backplane, room_id):
+        self.backplane = backplane
+        self.room_id = room_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_BUFFER)
+        self.overflowed = False
+
+    def deliver(self, message):
+        # Runs on the subscriber's loop. A listener that falls this far
+        # behind gets a single resync marker instead of a partial history.
+        if self.overflowed:
+            return
+        if self.queue.full():
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(json.dumps({"event": "resync", "data": None}))
+            return
+        self.queue.put_nowait(message)
+
+    async def get(self, timeout=None):
+        message = await asyncio.wait_for(self.queue.get(), timeout)
+        if self.overflowed and self.queue.empty():
+            self.overflowed = False
+        return message
+
+    def close(self):
+        self.backplane.unsubscribe(self)
+
+
+class InProcessBackplane:
+    """Fans room events out to the listeners of the current process."""
+
+    def __init__(self, **options):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def subscribe(self, room_id):
+        subscription = Subscription(self, room_id)
+        with self._lock:
+            self._subscriptions.setdefault(room_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            listeners = self._subscriptions.get(subscription.room_id)
+            if listeners is None:
+                return
+            listeners.discard(subscription)
+            if not listeners:
+                del self._subscriptions[subscription.room_id]
+
+    def subscriber_count(self, room_id):
+        with self._lock:
+            return len(self._subscriptions.get(room_id, ()))
+
+    def publish(self, room_id, message):
+        self.deliver_local(room_id, message)
+
+    def deliver_local(self, room_id, message):
+        with self._lock:
+            listeners = list(self._subscriptions.get(room_id, ()))
+        for subscription in listeners:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, message)
+            except RuntimeError:
+                # The listener's loop is gone; its stream is already closed.
+                self.unsubscribe(subscription)
+
+
+class RedisBackplane(InProcessBackplane):
+    """
+    Relays room events through Redis pub/sub so every worker process sees
+    them. Each process keeps one listener thread that re-delivers incoming
+    messages to its local subscribers.
+    """
+
+    channel_prefix = "rock:room:"
+
+    def __init__(self, url=None, client=None, **options):
+        super().__init__(**options)
+        if client is None:
+            try:
+                import redis
+            except ImportError as exc:
+                raise ImproperlyConfigured(
+                    "RedisBackplane needs the redis package (see requirements-dev.txt)"
+                ) from exc
+
+            client = redis.Redis.from_url(url or "redis://localhost:6379/0")
+        self.client = client
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+    def publish(self, room_id, message):
+        self.client.publish(f"{self.channel_prefix}{room_id}", message)
+
+    def subscribe(self, room_id):
+        self._ensure_listener()
+        return super().subscribe(room_id)
+
+    def _ensure_listener(self):
+        with self._listener_lock:
+            if self._listener is not None:
+                return
+            pubsub = self.client.pubsub()
+            pubsub.psubscribe(f"{self.channel_prefix}*")
+            self._listener = threading.Thread(
+                target=self._listen, args=(pubsub,), daemon=True
+            )
+            self._listener.start()
+
+    def _listen(self, pubsub):
+        for item in pubsub.listen():
+            if item.get("type") != "pmessage":
+                continue
+            channel = item["channel"]
+            data = item["data"]
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            if isinstance(data, bytes):
+                data = data.decode()
+            room_id = int(channel[len(self.channel_prefix):])
+            self.deliver_local(room_id, data)
+
+
+class LocalRedis:
+    """
+    In-process stand-in for the subset of the redis client used by
+    RedisBackplane and roomcache.RedisRoomCache, so multi-worker fan-out
+    and shared caching can be exercised in tests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pubsubs = []
+        self._values = {}
+
+    def get(self, key):
+        with self._lock:
+            value, expires = self._values.get(key, (None, None))
+            if expires is not None and expires <= time.monotonic():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value, px=None, nx=False):
+        expires = None if px is None else time.monotonic() + px / 1000
+        if nx and self.get(key) is not None:
+            return None
+        with self._lock:
+            if nx and key in self._values:
+                return None
+            self._values[key] = (value, expires)
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._values.pop(key, None) is not None for key in keys)
+
+    def scan_iter(self, match="*"):
+        with self._lock:
+            return [key for key in self._values if fnmatchcase(key, match)]
+
+    def publish(self, channel, message):
+        with self._lock:
+            pubsubs = list(self._pubsubs)
+        for pubsub in pubsubs:
+            pubsub.push(channel, message)
+        return len(pubsubs)
+
+    def pubsub(self):
+        pubsub = LocalPubSub(self)
+        with self._lock:
+            self._pubsubs.append(pubsub)
+        return pubsub
+
+
+class LocalPubSub:
+    def __init__(self, server):
+        self.server = server
+        self.patterns = []
+        self.messages = queue.Queue()
+
+    def psubscribe(self, pattern):
+        self.patterns.append(pattern)
+
+    def push(self, channel, message):
+        for pattern in self.patterns:
+            if channel.startswith(pattern.rstrip("*")):
+                self.messages.put({
+                    "type": "pmessage",
+                    "pattern": pattern,
+                    "channel": channel,
+                    "data": message,
+                })
+
+    def listen(self):
+        while True:
+            yield self.messages.get()
+
+
+@lru_cache(maxsize=None)
+def get_backplane():
+    config = getattr(settings, "ROOM_BACKPLANE", {})
+    backend = import_string(
+        config.get("BACKEND", "Room.realtime.InProcessBackplane")
+    )
+    return backend(**config.get("OPTIONS", {}))
+
+
+def broadcast(room_id, event, data=None):
+    """Publish a room event once the surrounding transaction commits."""
+    message = json.dumps({"event": event, "data": data}, default=str)
+    transaction.on_commit(lambda: get_backplane().publish(room_id, message))
+
+
+# ------------------------
+# Server-Sent Events endpoint
+# ------------------------
+
+def resolve_user_id(token):
+    try:
+        return AccessToken(token)[api_settings.USER_ID_CLAIM]
+    except (TokenError, KeyError):
+        return None
+
+
+async def send_error(send, status_code, detail):
+    body = json.dumps({"error": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [(b"content-type", b"application/json")],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def format_event(message):
+    payload = json.loads(message)
+    return f"event: {payload['event']}\ndata: {json.dumps(payload['data'])}\n\n".encode()
+
+
+async def wait_for_disconnect(receive):
+    # The server hands over the (empty) request body first; only
+    # http.disconnect means the client went away.
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return message
+
+
+async def room_events(scope, receive, send):
+    from .models import Membership
+
+    params = parse_qs(scope.get("query_string", b"").decode())
+    user_id = resolve_user_id(params.get("token", [""])[0])
+    if user_id is None:
+        return await send_error(send, 401, "Invalid token")
+
+    room_id = await (
+        Membership.objects
+        .filter(user_id=user_id)
+        .values_list("room_id", flat=True)
+        .afirst()
+    )
+    if room_id is None:
+        return await send_error(send, 400, "Not in a room")
+
+    subscription = get_backplane().subscribe(room_id)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        await send({
+            "type": "http.response.body",
+            "body": format_event(json.dumps({"event": "ready", "data": {"room_id": room_id}})),
+            "more_body": True,
+        })
+
+        while True:
+            pending = asyncio.ensure_future(subscription.get())
+            done, _ = await asyncio.wait(
+                {pending, disconnected},
+                timeout=KEEPALIVE_SECONDS,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if disconnected in done:
+                pending.cancel()
+                break
+            if pending not in done:
+                pending.cancel()
+                await send({"type": "http.response.body", "body": b": ping\n\n", "more_body": True})
+                continue
+
+            message = pending.result()
+            await send({"type": "http.response.body", "body": format_event(message), "more_body": True})
+
+            payload = json.loads(message)
+            closing = payload["event"] == "room.closed" or (
+                payload["event"] == "member.left"
+                and str(payload["data"]["user_id"]) == str(user_id)
+            )
+            if closing:
+                await send({"type": "http.response.body", "body": b""})
+                break
+    finally:
+        subscription.close()
+        disconnected.cancel()
+
+
+def with_room_events(django_application):
+    """Route the room event stream ahead of the regular Django application."""
+
+    async def application(scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == EVENTS_PATH:
+            return await room_events(scope, receive, send)
+        return await django_application(scope, receive, send)
+
+    return application
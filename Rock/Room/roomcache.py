@@ -0,0 +1,320 @@
+"""
+Room-scoped cache for what the read endpoints share across a room.
+
+Every member of a room polls the same ranked queue and now-playing song.
+RoomCache keeps those under the room's current generation:
+`rock:room:{id}:{generation}:{name}`. Callers also put the room's version
+in `name`, and read the version from the Room row, which is never
+cached (see membership.py). So even with the per-process default backend,
+where another worker's invalidation never arrives, a change can only be
+served stale until the next read of the row. invalidate() moves the
+room to a fresh generation, which orphans all of its entries at once;
+they then age out through the TTL. changes.record_changes() invalidates
+on every queue, vote or playback change, and deleting a room (the host
+leaving) invalidates through signals.py. Joining and leaving only change
+membership, which membership.py caches per user.
+
+A write invalidates twice: right away, so the rest of its transaction
+reads its own changes, and again on commit. That drops anything a
+concurrent reader cached from the pre-commit state in between.
+
+A miss is loaded once per key. Threads of one process wait on the first
+thread's load, and so do coroutines on one event loop. Other processes see its lease (an `add` with a short TTL)
+and wait for the value up to `lease_wait` seconds before loading it
+themselves. aget_or_load is the same read for async views: it takes a
+coroutine loader (the async ORM) and the async store methods, so a poll
+never leaves the event loop on a hit.
+
+The backend comes from settings.ROOM_CACHE:
+
+* DjangoRoomCache (the default) stores entries in one of Django's caches;
+  the project's default cache is local memory, one per process.
+* RedisRoomCache talks to Redis directly, so every worker process shares
+  the entries and the leases. realtime.LocalRedis stands in for it in
+  tests.
+"""
+import asyncio
+import pickle
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+
+class RoomCache:
+    """Generations, single flight and leases over a get/set/add/delete store."""
+
+    key_prefix = "rock:room"
+
+    def __init__(self, ttl=60, lease_ttl=5, lease_wait=1.0, poll_interval=0.01):
+        self.ttl = ttl
+        self.lease_ttl = lease_ttl
+        self.lease_wait = lease_wait
+        self.poll_interval = poll_interval
+        self._inflight = {}
+        self._ainflight = {}
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(
+            ("hits", "misses", "coalesced", "lease_waits", "invalidations"), 0
+        )
+
+    # ------------------------
+    # Store; subclasses implement these
+    # ------------------------
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def add(self, key, value, ttl):
+        """Set `key` only if it is missing. Returns whether it was set."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    # Async store. Backends without a native client run the sync one in a
+    # worker thread, off the thread the sync ORM is pinned to.
+
+    async def aget(self, key):
+        return await sync_to_async(self.get, thread_sensitive=False)(key)
+
+    async def aset(self, key, value, ttl):
+        await sync_to_async(self.set, thread_sensitive=False)(key, value, ttl)
+
+    async def aadd(self, key, value, ttl):
+        return await sync_to_async(self.add, thread_sensitive=False)(key, value, ttl)
+
+    async def adelete(self, key):
+        await sync_to_async(self.delete, thread_sensitive=False)(key)
+
+    # ------------------------
+    # Generations
+    # ------------------------
+
+    def generation(self, room_id):
+        key = f"{self.key_prefix}:{room_id}:gen"
+        generation = self.get(key)
+        if generation is None:
+            # A random start never lands on entries of an evicted generation.
+            self.add(key, uuid.uuid4().hex, None)
+            generation = self.get(key)
+        return generation
+
+    async def ageneration(self, room_id):
+        key = f"{self.key_prefix}:{room_id}:gen"
+        generation = await self.aget(key)
+        if generation is None:
+            await self.aadd(key, uuid.uuid4().hex, None)
+            generation = await self.aget(key)
+        return generation
+
+    def key(self, room_id, name):
+        return f"{self.key_prefix}:{room_id}:{self.generation(room_id)}:{name}"
+
+    async def akey(self, room_id, name):
+        return f"{self.key_prefix}:{room_id}:{await self.ageneration(room_id)}:{name}"
+
+    def invalidate(self, room_id):
+        self.set(f"{self.key_prefix}:{room_id}:gen", uuid.uuid4().hex, None)
+        self._count("invalidations")
+
+    def invalidate_on_commit(self, room_id):
+        self.invalidate(room_id)
+        transaction.on_commit(lambda: self.invalidate(room_id))
+
+    # ------------------------
+    # Reads
+    # ------------------------
+
+    def get_or_load(self, room_id, name, loader):
+        """
+        The room's cached `name`, or `loader()` stored under it. A None
+        result is returned but not cached.
+        """
+        key = self.key(room_id, name)
+        value = self.get(key)
+        if value is not None:
+            self._count("hits")
+            return value
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self._counters["coalesced"] += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            value = self._load(key, loader)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    async def aget_or_load(self, room_id, name, loader):
+        """get_or_load for async views; `loader` is a coroutine function."""
+        key = await self.akey(room_id, name)
+        value = await self.aget(key)
+        if value is not None:
+            self._count("hits")
+            return value
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            task = self._ainflight.get((loop, key))
+            if task is None:
+                task = self._ainflight[(loop, key)] = loop.create_task(self._aload(key, loader))
+                task.add_done_callback(lambda _: self._ainflight.pop((loop, key), None))
+            else:
+                self._counters["coalesced"] += 1
+        # One waiter being cancelled must not cancel the load for the rest.
+        return await asyncio.shield(task)
+
+    def _load(self, key, loader):
+        lease = f"{key}:lease"
+        if not self.add(lease, 1, self.lease_ttl):
+            # Another process is loading it.
+            self._count("lease_waits")
+            deadline = time.monotonic() + self.lease_wait
+            while time.monotonic() < deadline:
+                time.sleep(self.poll_interval)
+                value = self.get(key)
+                if value is not None:
+                    return value
+
+        self._count("misses")
+        try:
+            value = loader()
+            if value is not None:
+                self.set(key, value, self.ttl)
+            return value
+        finally:
+            self.delete(lease)
+
+    async def _aload(self, key, loader):
+        lease = f"{key}:lease"
+        if not await self.aadd(lease, 1, self.lease_ttl):
+            self._count("lease_waits")
+            deadline = time.monotonic() + self.lease_wait
+            while time.monotonic() < deadline:
+                await asyncio.sleep(self.poll_interval)
+                value = await self.aget(key)
+                if value is not None:
+                    return value
+
+        self._count("misses")
+        try:
+            value = await loader()
+            if value is not None:
+                await self.aset(key, value, self.ttl)
+            return value
+        finally:
+            await self.adelete(lease)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+class DjangoRoomCache(RoomCache):
+    def __init__(self, alias="default", **options):
+        super().__init__(**options)
+        self.cache = caches[alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    def add(self, key, value, ttl):
+        return self.cache.add(key, value, ttl)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+    async def aget(self, key):
+        return await self.cache.aget(key)
+
+    async def aset(self, key, value, ttl):
+        await self.cache.aset(key, value, ttl)
+
+    async def aadd(self, key, value, ttl):
+        return await self.cache.aadd(key, value, ttl)
+
+    async def adelete(self, key):
+        await self.cache.adelete(key)
+
+
+class RedisRoomCache(RoomCache):
+    def __init__(self, url=None, client=None, **options):
+        super().__init__(**options)
+        if client is None:
+            try:
+                import redis
+            except ImportError as exc:
+                raise ImproperlyConfigured(
+                    "RedisRoomCache needs the redis package (see requirements-dev.txt)"
+                ) from exc
+
+            client = redis.Redis.from_url(url or "redis://localhost:6379/0")
+        self.client = client
+
+    def get(self, key):
+        value = self.client.get(key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, ttl):
+        self.client.set(key, pickle.dumps(value), px=ttl_ms(ttl))
+
+    def add(self, key, value, ttl):
+        return bool(self.client.set(key, pickle.dumps(value), px=ttl_ms(ttl), nx=True))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(f"{self.key_prefix}:*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+def ttl_ms(ttl):
+    return None if ttl is None else int(ttl * 1000)
+
+
+@lru_cache(maxsize=None)
+def get_room_cache():
+    config = getattr(settings, "ROOM_CACHE", {})
+    backend = import_string(config.get("BACKEND", "Room.roomcache.DjangoRoomCache"))
+    return backend(**config.get("OPTIONS", {}))
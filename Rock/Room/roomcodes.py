@@ -0,0 +1,223 @@
+"""
+Room codes without probing the database.
+
+A code is a position of a global sequence, scrambled and spelled in the
+code alphabet. RoomCodeSequence holds the next unissued position. Each
+process reserves a block of BLOCK_SIZE positions with one UPDATE and
+hands them out from memory. Positions go through a keyed Feistel
+permutation of [0, 36**6), so consecutive rooms get unrelated codes that
+cannot be guessed without the key. The permutation is a bijection, so
+distinct positions never share a code. Positions left in a block when a
+process exits are skipped for good, which is cheap in a space of two
+billion codes.
+
+A reservation usually runs inside the caller's transaction (Room.save in
+CreateRoom's atomic block). The codes the caller needs come straight
+from the block. The spare ones stay pending, visible only to that
+transaction, until it commits: a rollback also undoes the sequence
+advance and the freed-code claims, and another process would then
+reserve the same codes. Later allocations in the same transaction draw
+on its pending codes first, so a batch of rooms created in one
+transaction still reserves one block per BLOCK_SIZE rooms. Pending codes
+move to the shared pool on commit and are dropped when the transaction,
+or the savepoint that reserved them, rolls back.
+
+A deleted room's code is recorded in FreedRoomCode. Once it has been
+free for QUARANTINE seconds, so that an old link no longer leads into a
+stranger's room, the next block reservation hands it out again before
+any fresh positions. Reservations update the sequence row first, so they
+run one at a time and never claim the same freed code twice.
+
+Codes issued before this allocator existed, or set by hand, can still
+collide, as can a key or alphabet change. Room.room_code stays unique in
+the schema, and Room.save() retries a collision with the next code.
+"""
+import hashlib
+import threading
+from collections import deque
+from datetime import timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import FreedRoomCode, RoomCodeSequence
+
+
+ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+CODE_LENGTH = 6
+ROUNDS = 6
+
+
+class RoomCodesExhausted(Exception):
+    pass
+
+
+class CodePermutation:
+    """
+    A keyed bijection of [0, size): a balanced Feistel network over the
+    smallest even number of bits that covers `size`, cycle-walked back
+    into range.
+    """
+
+    def __init__(self, key, size, rounds=ROUNDS):
+        self.key = hashlib.blake2b(key, digest_size=32).digest()
+        self.size = size
+        self.rounds = rounds
+        self.half_bits = ((size - 1).bit_length() + 1) // 2
+        self.mask = (1 << self.half_bits) - 1
+        self.half_bytes = (self.half_bits + 7) // 8
+
+    def __call__(self, n):
+        if not 0 <= n < self.size:
+            raise ValueError(f"{n} is outside [0, {self.size})")
+        # Inputs and outputs below size form whole cycles of the wider
+        # permutation, so walking until back in range stays a bijection.
+        n = self._feistel(n)
+        while n >= self.size:
+            n = self._feistel(n)
+        return n
+
+    def _feistel(self, n):
+        left, right = n >> self.half_bits, n & self.mask
+        for i in range(self.rounds):
+            left, right = right, left ^ self._round(i, right)
+        return (left << self.half_bits) | right
+
+    def _round(self, i, half):
+        digest = hashlib.blake2b(
+            half.to_bytes(self.half_bytes, "big") + bytes([i]),
+            key=self.key,
+            digest_size=self.half_bytes,
+        ).digest()
+        return int.from_bytes(digest, "big") & self.mask
+
+
+def encode(n, alphabet=ALPHABET, length=CODE_LENGTH):
+    chars = []
+    for _ in range(length):
+        n, digit = divmod(n, len(alphabet))
+        chars.append(alphabet[digit])
+    return "".join(reversed(chars))
+
+
+class RoomCodeAllocator:
+    def __init__(self, key, block_size=100, quarantine=24 * 60 * 60,
+                 alphabet=ALPHABET, length=CODE_LENGTH):
+        self.block_size = block_size
+        self.quarantine = timedelta(seconds=quarantine)
+        self.alphabet = alphabet
+        self.length = length
+        self.space = len(alphabet) ** length
+        self.permutation = CodePermutation(key, self.space)
+        self._codes = deque()
+        # Spare codes of reservations not yet committed, per thread (and
+        # so per connection): [(codes, the on_commit callback banking them)].
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        return self.take(1)[0]
+
+    def take(self, count):
+        """`count` codes no other allocator has issued or will issue."""
+        with self._lock:
+            codes = [self._codes.popleft() for _ in range(min(count, len(self._codes)))]
+        for pending, _ in self._pending():
+            while pending and len(codes) < count:
+                codes.append(pending.popleft())
+        while len(codes) < count:
+            block = self._reserve(max(self.block_size, count - len(codes)))
+            needed = count - len(codes)
+            codes += block[:needed]
+            self._bank(block[needed:])
+        return codes
+
+    def _pending(self):
+        """This transaction's pending spares, minus those rolled back."""
+        connection = transaction.get_connection()
+        pending = getattr(self._local, "pending", [])
+        if not connection.in_atomic_block:
+            pending = []
+        elif pending:
+            # A rollback, of the transaction or of the savepoint the codes
+            # were reserved in, discards the callback that would bank them.
+            live = {id(callback) for _, callback, _ in connection.run_on_commit}
+            pending = [(codes, bank) for codes, bank in pending if codes and id(bank) in live]
+        self._local.pending = pending
+        return pending
+
+    def _bank(self, codes):
+        if not transaction.get_connection().in_atomic_block:
+            with self._lock:
+                self._codes.extend(codes)
+            return
+
+        codes = deque(codes)
+
+        def bank():
+            with self._lock:
+                self._codes.extend(codes)
+            codes.clear()
+
+        self._pending().append((codes, bank))
+        transaction.on_commit(bank)
+
+    def code_at(self, position):
+        return encode(self.permutation(position), self.alphabet, self.length)
+
+    def _reserve(self, count):
+        with transaction.atomic():
+            # Touching the sequence row first holds it until commit, which
+            # keeps concurrent reservations from claiming the same codes.
+            self._advance(0)
+            recycled = self._claim_freed(count)
+            start = self._advance(count - len(recycled))
+            stop = min(start + count - len(recycled), self.space)
+            codes = recycled + [self.code_at(position) for position in range(start, stop)]
+        if not codes:
+            raise RoomCodesExhausted(f"All {self.space} room codes are in use or in quarantine")
+        return codes
+
+    def _advance(self, count):
+        sequence = RoomCodeSequence.objects.filter(pk=1)
+        if not sequence.update(next_value=F("next_value") + count):
+            RoomCodeSequence.objects.get_or_create(pk=1)
+            sequence.update(next_value=F("next_value") + count)
+        return sequence.values_list("next_value", flat=True).get() - count
+
+    def _claim_freed(self, count):
+        codes = list(
+            FreedRoomCode.objects
+            .filter(freed_at__lte=timezone.now() - self.quarantine)
+            .order_by("freed_at")
+            .values_list("code", flat=True)[:count]
+        )
+        if codes:
+            FreedRoomCode.objects.filter(code__in=codes).delete()
+        return codes
+
+
+def free_codes(codes):
+    """Put deleted rooms' codes into quarantine."""
+    now = timezone.now()
+    FreedRoomCode.objects.bulk_create(
+        (FreedRoomCode(code=code, freed_at=now) for code in codes),
+        ignore_conflicts=True,
+    )
+
+
+def build_allocator(config):
+    key = config.get("KEY") or settings.SECRET_KEY
+    return RoomCodeAllocator(
+        key.encode() if isinstance(key, str) else key,
+        block_size=config.get("BLOCK_SIZE", 100),
+        quarantine=config.get("QUARANTINE", 24 * 60 * 60),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_code_allocator():
+    return build_allocator(getattr(settings, "ROOM_CODES", {}))
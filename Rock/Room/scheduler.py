@@ -0,0 +1,165 @@
+"""
+Server-side playback: rooms advance when their song ends.
+
+The scheduler keeps a heap of room deadlines, each one the moment the
+current song ends (played_at + Song.duration + GRACE). When a deadline
+comes up it calls playback.play_next with the song it expected to be
+playing. That is the same compare-and-swap the host's play-next request
+uses, so a room advances exactly once per song. This holds even when the
+host's player, a second scheduler or a retry gets there too. The next
+song's deadline goes straight back on the heap.
+
+Every REFRESH_INTERVAL seconds the scheduler re-reads the deadline of
+each room with a song playing (one query). That picks up rooms that
+advanced elsewhere and rooms that just started playing. Heap entries made
+stale by that are skipped when popped. A room whose queue ran dry is
+retried after RETRY_INTERVAL seconds, or as soon as its version moves.
+
+Songs of unknown duration are left to the clients. They still send
+play-next when the video ends. Run the scheduler with
+`manage.py run_playback_scheduler`; PlaybackScheduler.run also works on
+a thread.
+"""
+import heapq
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import Room
+from .playback import NoPlayableSongs, play_next
+
+
+logger = logging.getLogger(__name__)
+
+
+class PlaybackScheduler:
+    def __init__(self, refresh_interval=5.0, retry_interval=30.0, grace=1.0, clock=timezone.now):
+        self.refresh_interval = refresh_interval
+        self.retry_interval = timedelta(seconds=retry_interval)
+        self.grace = timedelta(seconds=grace)
+        self.clock = clock
+        self._heap = []
+        # room_id -> (deadline, room_song_id); heap entries that disagree are stale.
+        self._deadlines = {}
+        # room_id -> version at which the queue ran dry.
+        self._stalled = {}
+        self._counters = dict.fromkeys(("advanced", "lost_race", "stalled", "refreshes"), 0)
+
+    def stats(self):
+        return {**self._counters, "rooms": len(self._deadlines)}
+
+    def schedule(self, room_id, room_song_id, deadline):
+        if self._deadlines.get(room_id) == (deadline, room_song_id):
+            return
+        self._deadlines[room_id] = (deadline, room_song_id)
+        heapq.heappush(self._heap, (deadline, room_id, room_song_id))
+
+    def schedule_song(self, room_id, room_song):
+        """Schedule the end of `room_song`, if its length is known."""
+        duration = room_song.song.duration if room_song else None
+        if duration is None or room_song.played_at is None:
+            self._deadlines.pop(room_id, None)
+            return
+        self.schedule(
+            room_id, room_song.pk, room_song.played_at + timedelta(seconds=duration) + self.grace
+        )
+
+    def refresh(self):
+        """Re-read every playing room's deadline."""
+        rows = (
+            Room.objects
+            .filter(now_playing__isnull=False, now_playing__song__duration__isnull=False)
+            .values_list(
+                "pk", "version", "now_playing_id",
+                "now_playing__played_at", "now_playing__song__duration",
+            )
+        )
+        now = self.clock()
+        playing = set()
+        for room_id, version, room_song_id, played_at, duration in rows.iterator():
+            playing.add(room_id)
+            if played_at is None:
+                continue
+            deadline = played_at + timedelta(seconds=duration) + self.grace
+            stalled = self._stalled.get(room_id)
+            if stalled is not None and deadline <= now:
+                if stalled == version:
+                    continue  # still nothing to play; the retry entry covers it
+                deadline = now
+            self._stalled.pop(room_id, None)
+            self.schedule(room_id, room_song_id, deadline)
+
+        for room_id in set(self._deadlines) - playing:
+            del self._deadlines[room_id]
+            self._stalled.pop(room_id, None)
+        self._counters["refreshes"] += 1
+
+    def run_due(self):
+        """Advance every room whose deadline has passed. Returns how many advanced."""
+        advanced = 0
+        now = self.clock()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, room_id, room_song_id = heapq.heappop(self._heap)
+            if self._deadlines.get(room_id) != (deadline, room_song_id):
+                continue
+            del self._deadlines[room_id]
+            advanced += self.advance(room_id, room_song_id)
+        return advanced
+
+    def advance(self, room_id, room_song_id):
+        try:
+            result = play_next(room_id, room_song_id)
+        except NoPlayableSongs:
+            self._counters["stalled"] += 1
+            self._stalled[room_id] = (
+                Room.objects.filter(pk=room_id).values_list("version", flat=True).first()
+            )
+            self.schedule(room_id, room_song_id, self.clock() + self.retry_interval)
+            return 0
+        except Room.DoesNotExist:
+            return 0
+
+        self._stalled.pop(room_id, None)
+        self._counters["advanced" if result.advanced else "lost_race"] += 1
+        self.schedule_song(room_id, result.room_song)
+        return int(result.advanced)
+
+    def next_wakeup(self):
+        """Seconds until the earliest deadline, or None."""
+        if not self._heap:
+            return None
+        return max((self._heap[0][0] - self.clock()).total_seconds(), 0.0)
+
+    def run(self, stop=None):
+        stop = stop or threading.Event()
+        next_refresh = 0.0
+        while not stop.is_set():
+            try:
+                if time.monotonic() >= next_refresh:
+                    self.refresh()
+                    next_refresh = time.monotonic() + self.refresh_interval
+                self.run_due()
+            except Exception:
+                logger.exception("Playback scheduler tick failed")
+            finally:
+                close_old_connections()
+            wait = self.next_wakeup()
+            until_refresh = max(next_refresh - time.monotonic(), 0.0)
+            stop.wait(until_refresh if wait is None else min(wait, until_refresh))
+
+
+def build_scheduler(config):
+    return PlaybackScheduler(
+        refresh_interval=config.get("REFRESH_INTERVAL", 5.0),
+        retry_interval=config.get("RETRY_INTERVAL", 30.0),
+        grace=config.get("GRACE", 1.0),
+    )
+
+
+def get_scheduler():
+    return build_scheduler(getattr(settings, "PLAYBACK_SCHEDULER", {}))
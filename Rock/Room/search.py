@@ -0,0 +1,404 @@
+"""
+Typeahead search over the Song catalog.
+
+Titles and queries are normalised: accents stripped, casefolded, and
+punctuation collapsed to single spaces. A song matches when every word
+of the query starts a word of its title, so "bohem rhap" finds "Bohemian
+Rhapsody". Results are ranked by how well the query lines up plus the
+song's popularity:
+
+    score = 2 * TIER_WEIGHT  if the title starts with the query
+            1 * TIER_WEIGHT  if the query starts a later word
+            0                if its words only match apart
+          + log1p(plays + votes + rooms queued in)
+
+title__icontains would scan the whole table, so the backend comes from
+settings.SONG_SEARCH:
+
+* MemorySongSearch (the default) keeps a word-prefix index in each
+  process. Normalised titles live in one bytearray, and songs are
+  numbered (slots) in popularity order at build time. Each word maps to
+  the slots of the titles containing it, and so does each 1- to
+  3-letter word prefix. A sorted vocabulary resolves longer prefixes to
+  the words they cover. A query walks the slots of its most selective
+  word, merging the lists of all the words that prefix covers. The
+  other words are confirmed with bytearray.find on the title. The walk
+  stops after CANDIDATES matches, which are the most popular ones, or
+  after MAX_SCAN slots.
+  The index is built on a background thread, started by the WSGI/ASGI
+  entry points (warm()) or else by the first search; until it is ready
+  searches return no results rather than wait for it. SongAdd, the importer and the ingest
+  workers add the songs they make ready straight away. Other processes
+  pick up new songs by id every REFRESH_INTERVAL seconds. A full rebuild
+  every REBUILD_INTERVAL seconds, run on a background thread, refreshes
+  popularity and the songs finished by other processes' ingest workers.
+* PostgresSongSearch finds titles containing every query word with
+  ILIKE, served by the pg_trgm GIN index from migration 0011. It then
+  confirms and ranks the first CANDIDATES of them the same way.
+"""
+import bisect
+import heapq
+import math
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Sum
+from django.utils.module_loading import import_string
+
+from .models import PlayHistory, RoomSong, Song
+
+
+NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize(title):
+    decomposed = unicodedata.normalize("NFKD", title)
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return NON_WORD.sub(" ", stripped.casefold()).strip()
+
+
+def matches(title, words):
+    """Whether every word starts a word of the normalised `title`."""
+    padded = f" {title}"
+    return all(f" {word}" in padded for word in words)
+
+
+def popularity(song_ids=None):
+    """{song id: plays + votes + rooms queued in}, for `song_ids` or every song."""
+    room_songs, plays = RoomSong.objects.all(), PlayHistory.objects.all()
+    if song_ids is not None:
+        room_songs, plays = room_songs.filter(song_id__in=song_ids), plays.filter(song_id__in=song_ids)
+    scores = {}
+    for song_id, rooms, votes in (
+        room_songs.values("song_id").annotate(rooms=Count("id"), votes=Sum("vote_count"))
+        .values_list("song_id", "rooms", "votes").iterator(chunk_size=10_000)
+    ):
+        scores[song_id] = rooms + (votes or 0)
+    for song_id, count in (
+        plays.values("song_id").annotate(plays=Count("id"))
+        .values_list("song_id", "plays").iterator(chunk_size=10_000)
+    ):
+        scores[song_id] = scores.get(song_id, 0) + count
+    return scores
+
+
+class SongSearch:
+    def __init__(self, candidates=200, tier_weight=3.0):
+        self.candidates = candidates
+        self.tier_weight = tier_weight
+
+    def search(self, query, limit=10):
+        """The best `limit` matches as [(song id, score)], best first."""
+        raise NotImplementedError
+
+    def add(self, song_id, title):
+        """Make a song that just became ready searchable."""
+
+    def warm(self):
+        """Start any preparation searches need, without waiting for it."""
+
+    def stats(self):
+        return {}
+
+    def score(self, title, query, popular):
+        if title.startswith(query):
+            tier = 2
+        elif f" {query}" in title:
+            tier = 1
+        else:
+            tier = 0
+        return self.tier_weight * tier + math.log1p(popular)
+
+
+class PrefixIndex:
+    """The data MemorySongSearch queries; built whole, then appended to."""
+
+    # Prefixes up to this long get their own slot lists.
+    SHORT = 3
+
+    def __init__(self):
+        self.titles = bytearray()
+        self.offsets = array("Q", [0])
+        self.song_ids = array("q")
+        self.popularity = array("Q")
+        self.words = {}
+        self.prefixes = {}
+        self.vocabulary = []
+
+    def __len__(self):
+        return len(self.song_ids)
+
+    def append(self, song_id, title, popular=0, sort=True):
+        """Index a song. Pass sort=False while building and call finish() after."""
+        normalized = normalize(title)
+        words = set(normalized.split())
+        slot = len(self.song_ids)
+        # Titles and offsets go first so a concurrent reader never finds
+        # a slot in a list before its title.
+        self.titles += f" {normalized}".encode()
+        self.offsets.append(len(self.titles))
+        self.song_ids.append(song_id)
+        self.popularity.append(popular)
+        for word in words:
+            slots = self.words.get(word)
+            if slots is None:
+                slots = self.words[word] = array("I")
+                if sort:
+                    bisect.insort(self.vocabulary, word)
+            slots.append(slot)
+        for prefix in {word[:n] for word in words for n in range(1, self.SHORT + 1)}:
+            slots = self.prefixes.get(prefix)
+            if slots is None:
+                slots = self.prefixes[prefix] = array("I")
+            slots.append(slot)
+
+    def finish(self):
+        self.vocabulary = sorted(self.words)
+
+    def lists(self, prefix):
+        """The slot lists of the words starting with `prefix`."""
+        if len(prefix) <= self.SHORT:
+            slots = self.prefixes.get(prefix)
+            return [slots] if slots else []
+        vocabulary = self.vocabulary
+        first = bisect.bisect_left(vocabulary, prefix)
+        last = bisect.bisect_left(vocabulary, prefix[:-1] + chr(ord(prefix[-1]) + 1), first)
+        return [self.words[word] for word in vocabulary[first:last]]
+
+
+class MemorySongSearch(SongSearch):
+    def __init__(self, candidates=200, max_scan=50_000, tier_weight=3.0,
+                 refresh_interval=5.0, rebuild_interval=3600.0):
+        super().__init__(candidates, tier_weight)
+        self.max_scan = max_scan
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self._index = None
+        self._lock = threading.Lock()
+        self._watermark = 0
+        self._added = set()
+        self._refreshed = self._built = 0.0
+        self._building = False
+        self._counters = dict.fromkeys(("queries", "unready", "scanned", "added", "builds"), 0)
+
+    # ------------------------
+    # Building
+    # ------------------------
+
+    def build(self):
+        """Index every ready song, the most popular first."""
+        popular = popularity()
+        rows = list(
+            Song.objects.filter(status=Song.Status.READY).values_list("pk", "title").iterator(chunk_size=10_000)
+        )
+        rows.sort(key=lambda row: (-popular.get(row[0], 0), row[0]))
+        index = PrefixIndex()
+        for song_id, title in rows:
+            index.append(song_id, title, popular.get(song_id, 0), sort=False)
+        index.finish()
+        with self._lock:
+            self._index = index
+            # Songs added while the table was read come back through _catch_up.
+            self._watermark = max((song_id for song_id, _ in rows), default=0)
+            self._added = set()
+            self._refreshed = self._built = time.monotonic()
+            self._counters["builds"] += 1
+        return index
+
+    def warm(self):
+        if self._index is None:
+            self._build_in_background()
+
+    def index(self):
+        """The current index, or None while the first build is running."""
+        index = self._index
+        if index is None:
+            self._build_in_background()
+            return None
+
+        now = time.monotonic()
+        if self.rebuild_interval is not None and now - self._built > self.rebuild_interval:
+            self._build_in_background()
+        if now - self._refreshed > self.refresh_interval:
+            self._catch_up(index)
+        return index
+
+    def _build_in_background(self):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+
+        def build():
+            try:
+                self.build()
+            finally:
+                self._building = False
+                connection.close()
+
+        threading.Thread(target=build, name="song-search-build", daemon=True).start()
+
+    def _catch_up(self, index):
+        """Index songs other processes created since the last look."""
+        self._refreshed = time.monotonic()
+        rows = list(
+            Song.objects.filter(pk__gt=self._watermark, status=Song.Status.READY)
+            .order_by("pk").values_list("pk", "title")
+        )
+        with self._lock:
+            if index is not self._index:
+                return  # rebuilt meanwhile
+            for song_id, title in rows:
+                # A concurrent catch-up may have got there first.
+                if song_id > self._watermark:
+                    if song_id not in self._added:
+                        index.append(song_id, title)
+                    self._watermark = song_id
+
+    def add(self, song_id, title):
+        with self._lock:
+            # Before the first build there is nothing to add to; the build
+            # will read the song.
+            if self._index is None or song_id in self._added:
+                return
+            self._index.append(song_id, title)
+            self._added.add(song_id)
+            self._counters["added"] += 1
+
+    # ------------------------
+    # Queries
+    # ------------------------
+
+    def search(self, query, limit=10):
+        query = normalize(query)
+        words = set(query.split())
+        if not words:
+            return []
+        index = self.index()
+        if index is None:
+            self._counters["unready"] += 1
+            return []  # still building
+
+        # Walk the slots of the word with the fewest; check the rest on the title.
+        cheapest = None
+        for word in words:
+            lists = index.lists(word)
+            if not lists:
+                return []
+            cost = sum(map(len, lists))
+            if cheapest is None or cost < cheapest[0]:
+                cheapest = (cost, word, lists)
+        _, walked, lists = cheapest
+        others = [f" {word}".encode() for word in words if word != walked]
+        slots = lists[0] if len(lists) == 1 else heapq.merge(*lists)
+
+        titles, offsets = index.titles, index.offsets
+        found, scanned, previous = [], 0, -1
+        for slot in slots:
+            if slot == previous:
+                continue  # two of its words start with the prefix
+            previous = slot
+            scanned += 1
+            start, end = offsets[slot], offsets[slot + 1]
+            for other in others:
+                if titles.find(other, start, end) == -1:
+                    break
+            else:
+                found.append(slot)
+                if len(found) >= self.candidates:
+                    break
+            if scanned >= self.max_scan:
+                break
+        self._counters["queries"] += 1
+        self._counters["scanned"] += scanned
+
+        scored = (
+            (self.score(titles[offsets[slot] + 1:offsets[slot + 1]].decode(), query, index.popularity[slot]),
+             -slot, index.song_ids[slot])
+            for slot in found
+        )
+        return [(song_id, score) for score, _, song_id in heapq.nlargest(limit, scored)]
+
+    def stats(self):
+        index = self._index or PrefixIndex()
+        return {
+            **self._counters,
+            "ready": self._index is not None,
+            "songs": len(index),
+            "words": len(index.words),
+            "prefixes": len(index.prefixes),
+            "title_bytes": len(index.titles),
+        }
+
+
+class PostgresSongSearch(SongSearch):
+    def __init__(self, candidates=200, tier_weight=3.0, **ignored):
+        # Takes MemorySongSearch's options too, so BACKEND alone switches.
+        super().__init__(candidates, tier_weight)
+
+    def search(self, query, limit=10):
+        query = normalize(query)
+        words = query.split()
+        if not words:
+            return []
+        # The words are normalised, so ILIKE can miss titles whose accents or
+        # punctuation differ; the pg_trgm GIN index serves it either way.
+        songs = Song.objects.filter(status=Song.Status.READY)
+        for word in words:
+            songs = songs.filter(title__icontains=word)
+        rows = [
+            (song_id, title)
+            for song_id, title in songs.values_list("pk", "title")[:self.candidates]
+            if matches(normalize(title), words)
+        ]
+        popular = popularity([song_id for song_id, _ in rows])
+        scored = (
+            (self.score(normalize(title), query, popular.get(song_id, 0)), -song_id, song_id)
+            for song_id, title in rows
+        )
+        return [(song_id, score) for score, _, song_id in heapq.nlargest(limit, scored)]
+
+
+def config():
+    return {
+        "BACKEND": "Room.search.MemorySongSearch",
+        "OPTIONS": {},
+        "LIMIT": 10,
+        **getattr(settings, "SONG_SEARCH", {}),
+    }
+
+
+@lru_cache(maxsize=None)
+def get_song_search():
+    options = config()
+    return import_string(options["BACKEND"])(**options["OPTIONS"])
+
+
+def index_songs(songs):
+    """Add freshly ready songs ((id, title) pairs) to this process's index."""
+    search = get_song_search()
+    for song_id, title in songs:
+        search.add(song_id, title)
+
+
+def search_songs(query, limit, search=None):
+    """Matches for `query` as response rows, best first."""
+    scored = (search or get_song_search()).search(query, limit)
+    songs = Song.objects.filter(pk__in=[song_id for song_id, _ in scored]).values("id", "video_id", "title", "thumbnail")
+    songs = {song["id"]: song for song in songs}
+    return [
+        {
+            "video_id": songs[song_id]["video_id"],
+            "title": songs[song_id]["title"],
+            "thumbnail": songs[song_id]["thumbnail"],
+            "score": round(score, 4),
+        }
+        for song_id, score in scored
+        if song_id in songs
+    ]
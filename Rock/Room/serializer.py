@@ -1,7 +1,12 @@
 from rest_framework import serializers
 from .models import User, Room, RoomSong
+from .profiling import ProfiledDataMixin
 import re
 
+
+class ProfiledListSerializer(ProfiledDataMixin, serializers.ListSerializer):
+    pass
+
 class RegistrationSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -13,13 +18,14 @@ class RegistrationSerializer(serializers.ModelSerializer):
         user.save()
         return user
 
-class RoomSerializer(serializers.ModelSerializer):
+class RoomSerializer(ProfiledDataMixin, serializers.ModelSerializer):
     host = serializers.CharField(source="host.username")
     is_host = serializers.SerializerMethodField()
 
     class Meta:
         model = Room
         fields = ["id", "room_code", "host", "is_host"]
+        list_serializer_class = ProfiledListSerializer
 
     def get_is_host(self, obj):
         return self.context["request"].user == obj.host
@@ -34,7 +40,7 @@ class RoomJoinSerializer(serializers.Serializer):
             raise serializers.ValidationError("Room not found")
         return data
 
-class RoomSongSerializer(serializers.ModelSerializer):
+class RoomSongSerializer(ProfiledDataMixin, serializers.ModelSerializer):
     title = serializers.CharField(source="song.title")
     video_id = serializers.CharField(source="song.video_id")
     thumbnail = serializers.URLField(source="song.thumbnail")
@@ -47,6 +53,7 @@ class RoomSongSerializer(serializers.ModelSerializer):
             "id", "title", "video_id", "thumbnail",
             "vote_count", "has_voted"
         ]
+        list_serializer_class = ProfiledListSerializer
 
 class UrlExtractSerializer(serializers.Serializer):
     url = serializers.CharField()
@@ -62,3 +69,27 @@ class UrlExtractSerializer(serializers.Serializer):
         self.video_id = match.group(1)
         return value
 
+
+class BulkImportSerializer(serializers.Serializer):
+    items = serializers.ListField(
+        child=serializers.CharField(),
+        allow_empty=False,
+        max_length=500
+    )
+
+    id_regex = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+    def validate_items(self, value):
+        # Accept full URLs or bare video ids; invalid entries are reported
+        # per item rather than failing the whole import.
+        self.video_ids = []
+        for item in value:
+            item = item.strip()
+            match = UrlExtractSerializer.yt_regex.search(item)
+            if match:
+                self.video_ids.append((item, match.group(1)))
+            elif self.id_regex.match(item):
+                self.video_ids.append((item, item))
+            else:
+                self.video_ids.append((item, None))
+        return value
@@ -0,0 +1,85 @@
+from django.db.models import F, QuerySet
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .authentication import forget_principals
+from .changes import is_unlogged, record_changes
+from .membership import forget_rooms
+from .models import Membership, Room, RoomSong, User, Vote
+from .roomcache import get_room_cache
+from .roomcodes import free_codes
+
+
+@receiver(post_save, sender=Vote)
+def increment_vote_count(sender, instance, created, **kwargs):
+    if created:
+        RoomSong.objects.filter(pk=instance.room_song_id).update(
+            vote_count=F("vote_count") + 1
+        )
+        record_changes(instance.room_song.room_id, [instance.room_song_id])
+
+
+@receiver(post_delete, sender=Vote)
+def decrement_vote_count(sender, instance, origin=None, **kwargs):
+    if unlogged_delete(origin):
+        return
+    RoomSong.objects.filter(pk=instance.room_song_id, vote_count__gt=0).update(
+        vote_count=F("vote_count") - 1
+    )
+    room_id = (
+        RoomSong.objects
+        .filter(pk=instance.room_song_id)
+        .values_list("room_id", flat=True)
+        .first()
+    )
+    if room_id:
+        record_changes(room_id, [instance.room_song_id])
+
+
+@receiver(post_save, sender=RoomSong)
+@receiver(post_delete, sender=RoomSong)
+def log_queue_change(sender, instance, origin=None, **kwargs):
+    if not unlogged_delete(origin):
+        record_changes(instance.room_id, [instance.pk])
+
+
+def unlogged_delete(origin):
+    # Nothing to log for a room that is going away; a change row written
+    # mid-cascade would also outlive the room it points at. Compaction
+    # (history.py) opts out the same way.
+    if is_unlogged():
+        return True
+    if isinstance(origin, QuerySet):
+        return origin.model is Room
+    return isinstance(origin, Room)
+
+
+@receiver(post_delete, sender=Room)
+def forget_room(sender, instance, **kwargs):
+    get_room_cache().invalidate_on_commit(instance.pk)
+    free_codes([instance.room_code])
+
+
+@receiver(m2m_changed, sender=Membership)
+def forget_changed_memberships(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if reverse:
+        user_ids = [instance.pk]
+    elif action == "pre_clear":
+        user_ids = list(instance.memberships.values_list("user_id", flat=True))
+    else:
+        user_ids = pk_set
+    forget_rooms(user_ids)
+
+
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+def forget_membership(sender, instance, **kwargs):
+    forget_rooms([instance.user_id])
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_principal(sender, instance, **kwargs):
+    forget_principals([instance.pk])
@@ -0,0 +1,501 @@
+"""
+Song suggestions from what rooms queue together.
+
+Two songs co-occur when they are queued in the same room. Each queue
+entry weighs 1 + its votes, and the pair counts
+C[a, b] = sum over rooms of w(a) * w(b) form a sparse song x song matrix.
+A room's suggestions are the songs closest (cosine over C) to its queue,
+weighted by the room's own votes, minus what it already has.
+
+build_model() reads RoomSong once and counts pairs with NumPy, a batch
+of rooms at a time. Rooms are capped at MAX_ROOM_SONGS entries (the
+heaviest), so one huge queue cannot blow the pair count up
+quadratically. The model file keeps every room's entries and version
+next to the counts. That makes refresh_model() incremental: it re-reads
+only rooms whose version moved (every queue and vote change bumps it,
+see changes.py) and rooms that were deleted, then subtracts their old
+pairs and adds the new ones. Counts are integers, so a refresh gives
+the same model as a full rebuild. Compaction (history.py) does not move
+versions, so compacted songs count until their room next changes.
+
+The file is a short header followed by raw arrays. It is written to a
+temporary file and renamed into place. Workers memory-map it, so they
+share one copy through the page cache and opening it costs nothing. Each
+worker checks the file at most every RELOAD_INTERVAL seconds and maps
+the new one after a rebuild.
+
+NumPy is optional. Without it the suggestions endpoint answers 503 and
+`manage.py build_song_suggestions` refuses to run.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Room, RoomSong, Song
+
+try:
+    import numpy as np
+except ImportError:  # optional; only needed for suggestions
+    np = None
+
+
+MAGIC = b"ROCKSUG1"
+ALIGN = 64
+# Room ids per IN (...) clause when re-reading changed rooms.
+ROOM_BATCH = 5000
+
+
+class SuggestionsUnavailable(Exception):
+    pass
+
+
+def config():
+    return {
+        "PATH": "song-suggestions.model",
+        "MAX_ROOM_SONGS": 200,
+        "BATCH_PAIRS": 4_000_000,
+        "RELOAD_INTERVAL": 5.0,
+        "LIMIT": 10,
+        **getattr(settings, "SONG_SUGGESTIONS", {}),
+    }
+
+
+def require_numpy():
+    if np is None:
+        raise SuggestionsUnavailable("Song suggestions need the numpy package (see requirements-dev.txt)")
+
+
+# ------------------------
+# Model file
+# ------------------------
+
+class SuggestionModel:
+    """
+    songs         sorted Song ids; a song's index is its position here
+    self_counts   C[a, a], for the cosine norms
+    indptr, neighbors, counts
+                  C as CSR: row a holds the songs it co-occurs with
+    rooms, versions
+                  sorted Room ids and their versions at build time
+    room_indptr, room_songs, room_weights
+                  each room's (capped) entries as Song ids and weights
+    """
+
+    arrays = (
+        "songs", "self_counts", "indptr", "neighbors", "counts",
+        "rooms", "versions", "room_indptr", "room_songs", "room_weights",
+    )
+
+    def __init__(self, meta, **arrays):
+        self.meta = meta
+        for name in self.arrays:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.songs)
+
+
+def write_model(path, model):
+    path = os.fspath(path)
+    layout, offset = {}, 0
+    for name in model.arrays:
+        array = np.ascontiguousarray(getattr(model, name))
+        layout[name] = {
+            "dtype": array.dtype.str, "shape": array.shape, "offset": offset, "nbytes": array.nbytes,
+        }
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+
+    header = json.dumps({"meta": model.meta, "arrays": layout}).encode()
+    # Pad so the arrays start on an ALIGN boundary.
+    header += b" " * (-(len(MAGIC) + 8 + len(header)) % ALIGN)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC + len(header).to_bytes(8, "little") + header)
+            for name in model.arrays:
+                array = np.ascontiguousarray(getattr(model, name))
+                f.write(array.tobytes())
+                f.write(b"\0" * (-array.nbytes % ALIGN))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def load_model(path):
+    """Memory-map a model file. Raises SuggestionsUnavailable if it is missing."""
+    require_numpy()
+    path = os.fspath(path)
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise SuggestionsUnavailable(f"{path} is not a suggestion model")
+            header = json.loads(f.read(int.from_bytes(f.read(8), "little")))
+            start = f.tell()
+    except FileNotFoundError:
+        raise SuggestionsUnavailable(
+            f"No suggestion model at {path}; run manage.py build_song_suggestions"
+        ) from None
+
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        begin = start + spec["offset"]
+        arrays[name] = (
+            buffer[begin:begin + spec["nbytes"]].view(np.dtype(spec["dtype"])).reshape(spec["shape"])
+        )
+    return SuggestionModel(header["meta"], **arrays)
+
+
+# ------------------------
+# Counting
+# ------------------------
+
+def reduce_pairs(keys, values):
+    """Sum `values` per key. Returns sorted unique keys and their sums."""
+    if not len(keys):
+        return keys.astype(np.int64), values.astype(np.int64)
+    order = np.argsort(keys, kind="stable")
+    keys, values = keys[order], values[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[starts], np.add.reduceat(values, starts)
+
+
+def expand(starts, lengths):
+    """The positions starts[i] ... starts[i] + lengths[i] - 1, for every i."""
+    total = int(lengths.sum())
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + np.arange(total, dtype=np.int64) - offsets
+
+
+def pair_counts(room_indptr, items, weights, size, batch_pairs):
+    """
+    Sum w(a) * w(b) over the ordered pairs a != b of every room. `items`
+    are song indices below `size`, grouped by room as `room_indptr` says.
+    Returns keys a * size + b (sorted) and their counts.
+    """
+    lengths = np.diff(room_indptr)
+    # Split the rooms so that no batch materialises more than batch_pairs pairs.
+    work = np.cumsum(lengths.astype(np.int64) ** 2)
+    bounds = [0]
+    while bounds[-1] < len(lengths):
+        done = work[bounds[-1] - 1] if bounds[-1] else 0
+        bounds.append(max(int(np.searchsorted(work, done + batch_pairs, side="right")), bounds[-1] + 1))
+
+    keys, values = [], []
+    for first, last in zip(bounds, bounds[1:]):
+        starts, batch_lengths = room_indptr[first:last], lengths[first:last]
+        # Every entry pairs with each entry of its own room.
+        entries = expand(starts, batch_lengths)
+        partners = np.repeat(batch_lengths, batch_lengths)
+        left = np.repeat(entries, partners)
+        right = expand(np.repeat(starts, batch_lengths), partners)
+        distinct = left != right
+        left, right = left[distinct], right[distinct]
+        batch = reduce_pairs(
+            items[left].astype(np.int64) * size + items[right], weights[left] * weights[right]
+        )
+        keys.append(batch[0])
+        values.append(batch[1])
+    if not keys:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    return reduce_pairs(np.concatenate(keys), np.concatenate(values))
+
+
+def read_entries(queryset, max_room_songs):
+    """
+    (room ids, song ids, weights) of `queryset`'s RoomSongs, grouped by
+    room, keeping each room's heaviest max_room_songs entries.
+    """
+    rows = np.array(
+        list(queryset.values_list("room_id", "song_id", "vote_count").iterator(chunk_size=10_000)),
+        dtype=np.int64,
+    ).reshape(-1, 3)
+    room_ids, song_ids, weights = rows[:, 0], rows[:, 1], rows[:, 2] + 1
+    order = np.lexsort((song_ids, -weights, room_ids))
+    room_ids, song_ids, weights = room_ids[order], song_ids[order], weights[order]
+
+    starts = np.flatnonzero(np.r_[True, room_ids[1:] != room_ids[:-1]]) if len(room_ids) else room_ids
+    lengths = np.diff(np.r_[starts, len(room_ids)])
+    rank = np.arange(len(room_ids)) - np.repeat(starts, lengths)
+    keep = rank < max_room_songs
+    return room_ids[keep], song_ids[keep], weights[keep]
+
+
+def room_versions():
+    rows = Room.objects.order_by("pk").values_list("pk", "version")
+    rows = np.array(list(rows.iterator(chunk_size=10_000)), dtype=np.int64).reshape(-1, 2)
+    return rows[:, 0], rows[:, 1]
+
+
+def assemble(meta, songs, self_counts, keys, counts, rooms, versions, owners, room_songs, room_weights):
+    """A SuggestionModel from pair keys and room entries sorted by owner."""
+    size = len(songs)
+    rows = keys // size if size else keys
+    return SuggestionModel(
+        meta,
+        songs=songs,
+        self_counts=self_counts,
+        indptr=np.searchsorted(rows, np.arange(size + 1)).astype(np.int64),
+        neighbors=(keys - rows * size).astype(np.int32),
+        counts=counts,
+        rooms=rooms,
+        versions=versions,
+        room_indptr=np.r_[np.searchsorted(owners, rooms), len(owners)].astype(np.int64),
+        room_songs=room_songs,
+        room_weights=room_weights,
+    )
+
+
+def describe(model, mode, started):
+    model.meta.update({
+        "mode": mode,
+        "built_at": timezone.now().isoformat(),
+        "songs": len(model.songs),
+        "rooms": len(model.rooms),
+        "pairs": len(model.counts),
+        "seconds": round(time.perf_counter() - started, 3),
+    })
+    return model
+
+
+# ------------------------
+# Building
+# ------------------------
+
+def build_model(path=None, options=None):
+    """Count every room from scratch and write the model. Returns its meta."""
+    require_numpy()
+    options = {**config(), **(options or {})}
+    started = time.perf_counter()
+
+    # Versions first: a room that changes while its songs are read is
+    # stored with an older version and re-read by the next refresh.
+    rooms, versions = room_versions()
+    owners, song_ids, weights = read_entries(RoomSong.objects.all(), options["MAX_ROOM_SONGS"])
+    known = np.isin(owners, rooms)
+    owners, song_ids, weights = owners[known], song_ids[known], weights[known]
+
+    songs = np.unique(song_ids)
+    items = np.searchsorted(songs, song_ids)
+    keys, counts = pair_counts(
+        np.r_[np.searchsorted(owners, rooms), len(owners)].astype(np.int64),
+        items, weights, len(songs), options["BATCH_PAIRS"],
+    )
+
+    model = assemble(
+        {"max_room_songs": options["MAX_ROOM_SONGS"]},
+        songs,
+        np.bincount(items, weights=weights ** 2, minlength=len(songs)).astype(np.int64),
+        keys, counts, rooms, versions, owners, song_ids, weights,
+    )
+    write_model(path or options["PATH"], describe(model, "full", started))
+    return model.meta
+
+
+def refresh_model(path=None, options=None):
+    """
+    Bring the model up to date by re-counting only rooms that changed
+    since it was built. Builds it if there is none yet, or if
+    MAX_ROOM_SONGS changed. Returns the meta.
+    """
+    require_numpy()
+    options = {**config(), **(options or {})}
+    path = path or options["PATH"]
+    try:
+        old = load_model(path)
+    except SuggestionsUnavailable:
+        return build_model(path, options)
+    if old.meta.get("max_room_songs") != options["MAX_ROOM_SONGS"]:
+        return build_model(path, options)
+    started = time.perf_counter()
+
+    rooms, versions = room_versions()
+    position = np.minimum(np.searchsorted(old.rooms, rooms), max(len(old.rooms) - 1, 0))
+    same = (
+        (old.rooms[position] == rooms) & (old.versions[position] == versions)
+        if len(old.rooms) else np.zeros(len(rooms), bool)
+    )
+    changed = rooms[~same]
+    stale = np.union1d(changed, np.setdiff1d(old.rooms, rooms))
+    if not len(stale):
+        return old.meta
+
+    # What the stale rooms contributed at the last build...
+    old_owners = np.repeat(old.rooms, np.diff(old.room_indptr))
+    dropped = np.isin(old_owners, stale)
+    gone_owners = old_owners[dropped]
+    gone_songs, gone_weights = old.room_songs[dropped], old.room_weights[dropped]
+    # ...and what the changed ones hold now.
+    parts = [
+        read_entries(RoomSong.objects.filter(room_id__in=changed[i:i + ROOM_BATCH].tolist()),
+                     options["MAX_ROOM_SONGS"])
+        for i in range(0, len(changed), ROOM_BATCH)
+    ]
+    new_owners, new_songs, new_weights = (
+        np.concatenate([part[i] for part in parts]) if parts else np.zeros(0, np.int64)
+        for i in range(3)
+    )
+    known = np.isin(new_owners, rooms)
+    new_owners, new_songs, new_weights = new_owners[known], new_songs[known], new_weights[known]
+
+    songs = np.union1d(old.songs, new_songs)
+    size = len(songs)
+    remap = np.searchsorted(songs, old.songs)
+
+    def counted(owners, song_ids, weights, sign):
+        order = np.argsort(owners, kind="stable")
+        owners, song_ids, weights = owners[order], song_ids[order], weights[order]
+        indptr = np.r_[np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]]) if len(owners) else [],
+                       len(owners)].astype(np.int64)
+        keys, counts = pair_counts(
+            indptr, np.searchsorted(songs, song_ids), weights, size, options["BATCH_PAIRS"]
+        )
+        return keys, sign * counts
+
+    delta_keys, delta_counts = reduce_pairs(*(
+        np.concatenate(parts) for parts in zip(
+            counted(new_owners, new_songs, new_weights, 1),
+            counted(gone_owners, gone_songs, gone_weights, -1),
+        )
+    ))
+
+    # The old keys stay sorted under the (monotone) remap, so the delta
+    # merges in with a search instead of a sort.
+    old_rows = np.repeat(np.arange(len(old.songs)), np.diff(old.indptr))
+    keys = remap[old_rows] * size + remap[old.neighbors]
+    counts = np.array(old.counts)
+    at = np.searchsorted(keys, delta_keys)
+    found = at < len(keys)
+    found[found] = keys[at[found]] == delta_keys[found]
+    np.add.at(counts, at[found], delta_counts[found])
+    keys = np.insert(keys, at[~found], delta_keys[~found])
+    counts = np.insert(counts, at[~found], delta_counts[~found])
+    nonzero = counts != 0
+    keys, counts = keys[nonzero], counts[nonzero]
+
+    self_counts = np.zeros(size, np.int64)
+    self_counts[remap] = old.self_counts
+    np.add.at(self_counts, np.searchsorted(songs, new_songs), new_weights ** 2)
+    np.subtract.at(self_counts, np.searchsorted(songs, gone_songs), gone_weights ** 2)
+
+    present = self_counts > 0
+    if not present.all():
+        # Songs no room holds any more drop out, as in a rebuild.
+        index = np.cumsum(present) - 1
+        rows, columns = keys // size, keys % size
+        size = int(present.sum())
+        keys = index[rows] * size + index[columns]
+        songs, self_counts = songs[present], self_counts[present]
+
+    owners = np.concatenate([old_owners[~dropped], new_owners])
+    order = np.argsort(owners, kind="stable")
+    model = assemble(
+        dict(old.meta),
+        songs, self_counts, keys, counts, rooms, versions,
+        owners[order],
+        np.concatenate([old.room_songs[~dropped], new_songs])[order],
+        np.concatenate([old.room_weights[~dropped], new_weights])[order],
+    )
+    model.meta["refreshed_rooms"] = len(stale)
+    write_model(path, describe(model, "incremental", started))
+    return model.meta
+
+
+# ------------------------
+# Serving
+# ------------------------
+
+class Suggester:
+    """Top-k suggestions from the memory-mapped model at `path`."""
+
+    def __init__(self, path, reload_interval=5.0, max_room_songs=200):
+        self.path = os.fspath(path)
+        self.reload_interval = reload_interval
+        self.max_room_songs = max_room_songs
+        self._model = None
+        self._identity = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def model(self):
+        require_numpy()
+        now = time.monotonic()
+        if self._model is not None and now - self._checked < self.reload_interval:
+            return self._model
+        with self._lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                stat = None
+            identity = stat and (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if identity is None or identity != self._identity:
+                self._model = load_model(self.path)
+                self._identity = identity
+            self._checked = now
+            return self._model
+
+    def suggest(self, queue, limit):
+        """
+        The `limit` songs closest to `queue`, a list of (song id, votes),
+        as (song id, score) pairs, best first. Songs in `queue` are left out.
+        """
+        model = self.model()
+        if not queue or not len(model) or limit <= 0:
+            return []
+        queued = np.array(queue, dtype=np.int64).reshape(-1, 2)
+        queued = queued[np.argsort(-queued[:, 1], kind="stable")][:self.max_room_songs]
+        position = np.minimum(np.searchsorted(model.songs, queued[:, 0]), len(model) - 1)
+        known = model.songs[position] == queued[:, 0]
+        items = position[known]
+        if not len(items):
+            return []
+
+        norms = np.sqrt(model.self_counts[items].astype(np.float64))
+        scale = (queued[known, 1] + 1) / np.where(norms > 0, norms, 1)
+        lengths = model.indptr[items + 1] - model.indptr[items]
+        at = expand(model.indptr[items], lengths)
+        candidates, inverse = np.unique(model.neighbors[at], return_inverse=True)
+        scores = np.bincount(inverse, weights=model.counts[at] * np.repeat(scale, lengths))
+        norms = np.sqrt(model.self_counts[candidates].astype(np.float64))
+        scores = scores / np.where(norms > 0, norms, 1)
+        scores[np.isin(candidates, items)] = 0
+
+        # Ties go to the older song.
+        best = np.lexsort((candidates, -scores))[:min(limit, int(np.count_nonzero(scores > 0)))]
+        return list(zip(model.songs[candidates[best]].tolist(), scores[best].tolist()))
+
+
+@lru_cache(maxsize=None)
+def get_suggester():
+    options = config()
+    return Suggester(options["PATH"], options["RELOAD_INTERVAL"], options["MAX_ROOM_SONGS"])
+
+
+def suggestions_for(room, limit):
+    """The room's suggestions as response rows."""
+    queue = list(RoomSong.objects.filter(room=room).values_list("song_id", "vote_count"))
+    scored = get_suggester().suggest(queue, limit)
+    songs = Song.objects.filter(pk__in=[song_id for song_id, _ in scored], status=Song.Status.READY)
+    songs = {song["id"]: song for song in songs.values("id", "video_id", "title", "thumbnail")}
+    return [
+        {
+            "video_id": songs[song_id]["video_id"],
+            "title": songs[song_id]["title"],
+            "thumbnail": songs[song_id]["thumbnail"],
+            "score": round(score, 4),
+        }
+        for song_id, score in scored
+        if song_id in songs
+    ]
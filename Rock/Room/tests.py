@@ -1,3 +1,1759 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipIf
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from datetime import timedelta
+from pathlib import Path
+
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Exists, F, OuterRef
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from Rock.database import database_from_env
+
+from . import async_views, profiling
+from .benchmarks import drop_scale, seed_scale, video_id
+from .changes import PRUNE_EVERY
+from .history import compact_queue, prune_history
+from .importer import add_votes
+from .ingest import ImmediateExecutor, IngestJob, IngestQueue
+from .metadata import (
+    AsyncOEmbedTransport,
+    MetadataResolver,
+    MetadataUnavailable,
+    OEmbedTransport,
+    VideoMetadata,
+    VideoNotFound,
+    get_resolver,
+    parse_duration,
+)
+from .models import FreedRoomCode, PlayHistory, QueueChange, Room, RoomCodeSequence, Song, RoomSong, User, Vote
+from .playback import play_next
+from .profiling import QueryBudgetMixin
+from .ranking import queue_for
+from .realtime import (
+    InProcessBackplane,
+    LocalRedis,
+    RedisBackplane,
+    get_backplane,
+    room_events,
+)
+from .roomcache import DjangoRoomCache, RedisRoomCache, get_room_cache
+from .roomcodes import ALPHABET, CodePermutation, build_allocator, get_code_allocator
+from .scheduler import PlaybackScheduler
+from .search import MemorySongSearch, get_song_search
+from .serializer import RoomSongSerializer
+from .suggestions import (
+    SuggestionModel,
+    Suggester,
+    build_model,
+    get_suggester,
+    load_model,
+    np,
+    refresh_model,
+)
+from .votebuffer import VoteBuffer, fcntl
+
+
+def make_user(username):
+    return User.objects.create_user(username=username, password="pass12345")
+
+
+def make_room(host, *members):
+    room = Room.objects.create(host=host)
+    room.members.add(host, *members)
+    return room
+
+
+def make_room_song(room, video_id, added_by=None):
+    song, _ = Song.objects.get_or_create(
+        video_id=video_id,
+        defaults={"title": f"Song {video_id}", "thumbnail": "https://i.ytimg.com/x.jpg"},
+    )
+    return RoomSong.objects.create(room=room, song=song, added_by=added_by or room.host)
+
+
+class RoomTestCase(TestCase):
+    def setUp(self):
+        # The process-wide cache outlives each test's rolled back transaction.
+        cache.clear()
+
+
+class BackplaneTests(TestCase):
+    def test_in_process_delivery(self):
+        backplane = InProcessBackplane()
+
+        async def scenario():
+            subscription = backplane.subscribe(7)
+            backplane.publish(7, "hello")
+            backplane.publish(8, "other room")
+            try:
+                return await subscription.get(timeout=1)
+            finally:
+                subscription.close()
+
+        self.assertEqual(async_to_sync(scenario)(), "hello")
+        self.assertEqual(backplane.subscriber_count(7), 0)
+
+    def test_redis_fan_out_between_workers(self):
+        server = LocalRedis()
+        worker_a = RedisBackplane(client=server)
+        worker_b = RedisBackplane(client=server)
+
+        async def scenario():
+            subscription = worker_b.subscribe(3)
+            worker_a.publish(3, "vote")
+            try:
+                return await subscription.get(timeout=1)
+            finally:
+                subscription.close()
+
+        self.assertEqual(async_to_sync(scenario)(), "vote")
+
+    def test_missing_optional_packages_are_named(self):
+        with mock.patch.dict("sys.modules", {"redis": None}):
+            with self.assertRaisesMessage(ImproperlyConfigured, "RedisBackplane needs the redis package"):
+                RedisBackplane()
+            with self.assertRaisesMessage(ImproperlyConfigured, "RedisRoomCache needs the redis package"):
+                RedisRoomCache()
+        with mock.patch("Room.metadata.httpx", None):
+            with self.assertRaisesMessage(ImproperlyConfigured, "needs the httpx package"):
+                AsyncOEmbedTransport()
+
+
+class RoomEventBroadcastTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.host = make_user("host")
+        self.guest = make_user("guest")
+        self.room = make_room(self.host, self.guest)
+        self.room_song = make_room_song(self.room, "aaaaaaaaaaa")
+        self.client = APIClient()
+        self.client.force_authenticate(self.guest)
+
+    def capture(self, callable_):
+        published = []
+        backplane = get_backplane()
+        original = backplane.publish
+        backplane.publish = lambda room_id, message: published.append((room_id, json.loads(message)))
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                callable_()
+        finally:
+            backplane.publish = original
+        return published
+
+    def test_vote_is_broadcast(self):
+        published = self.capture(
+            lambda: self.client.post(f"/api/songs/{self.room_song.id}/vote/")
+        )
+        self.assertEqual(published, [(self.room.id, {
+            "event": "queue.vote",
+            "data": {"room_song_id": self.room_song.id, "vote_count": 1},
+        })])
+
+    def test_play_next_is_broadcast(self):
+        self.client.force_authenticate(self.host)
+        published = self.capture(lambda: self.client.post("/api/songs/play-next/"))
+        self.assertEqual(published[0][1]["event"], "now_playing")
+        self.assertEqual(published[0][1]["data"]["room_song_id"], self.room_song.id)
+
+    def test_leave_is_broadcast(self):
+        published = self.capture(lambda: self.client.post("/api/room/leave/"))
+        self.assertEqual(published, [(self.room.id, {
+            "event": "member.left", "data": {"user_id": self.guest.id},
+        })])
+
+
+class RoomEventStreamTests(TransactionTestCase):
+    def test_stream_delivers_room_events(self):
+        host = make_user("host")
+        room = make_room(host)
+        token = str(AccessToken.for_user(host))
+
+        async def scenario():
+            sent = []
+            disconnect = asyncio.Event()
+            messages = [{"type": "http.request", "body": b"", "more_body": False}]
+
+            async def receive():
+                # Like a real server: the request body first, then the disconnect.
+                if messages:
+                    return messages.pop(0)
+                await disconnect.wait()
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                sent.append(message)
+
+            scope = {"type": "http", "path": "/api/room/events/",
+                     "query_string": f"token={token}".encode()}
+            stream = asyncio.ensure_future(room_events(scope, receive, send))
+            while get_backplane().subscriber_count(room.id) == 0 and not stream.done():
+                await asyncio.sleep(0.01)
+            get_backplane().publish(room.id, json.dumps({"event": "queue.vote", "data": {"vote_count": 2}}))
+            while len(sent) < 3 and not stream.done():
+                await asyncio.sleep(0.01)
+            subscribed = get_backplane().subscriber_count(room.id)
+            disconnect.set()
+            await stream
+            return sent, subscribed
+
+        sent, subscribed = async_to_sync(scenario)()
+        self.assertEqual(subscribed, 1)
+        self.assertEqual(get_backplane().subscriber_count(room.id), 0)
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertIn(b"event: ready", sent[1]["body"])
+        self.assertEqual(sent[2]["body"], b'event: queue.vote\ndata: {"vote_count": 2}\n\n')
+
+    def test_stream_rejects_bad_token(self):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "path": "/api/room/events/", "query_string": b"token=nope"}
+        async_to_sync(room_events)(scope, None, send)
+        self.assertEqual(sent[0]["status"], 401)
+
+
+class VoteCounterTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.host = make_user("host")
+        self.guest = make_user("guest")
+        self.room = make_room(self.host, self.guest)
+        self.first = make_room_song(self.room, "aaaaaaaaaaa")
+        self.second = make_room_song(self.room, "bbbbbbbbbbb")
+        self.client = APIClient()
+        self.client.force_authenticate(self.guest)
+
+    def test_toggle_maintains_counter(self):
+        response = self.client.post(f"/api/songs/{self.second.id}/vote/")
+        self.assertEqual(response.data, {"action": "added", "vote_count": 1})
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        self.assertEqual((self.first.vote_count, self.second.vote_count), (0, 1))
+
+        response = self.client.post(f"/api/songs/{self.second.id}/vote/")
+        self.assertEqual(response.data, {"action": "removed", "vote_count": 0})
+
+    def test_queue_ranked_by_stored_count(self):
+        self.client.post(f"/api/songs/{self.second.id}/vote/")
+        response = self.client.get("/api/songs/queue/")
+        self.assertEqual([row["id"] for row in response.data], [self.second.id, self.first.id])
+        self.assertEqual(response.data[0]["vote_count"], 1)
+        self.assertTrue(response.data[0]["has_voted"])
+
+    def test_reconcile_repairs_drift(self):
+        Vote.objects.create(room_song=self.first, user=self.guest)
+        RoomSong.objects.filter(pk=self.first.pk).update(vote_count=5)
+        RoomSong.objects.filter(pk=self.second.pk).update(vote_count=2)
+
+        call_command("reconcile_vote_counts", stdout=io.StringIO())
+
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        self.assertEqual((self.first.vote_count, self.second.vote_count), (1, 0))
+
+
+class VoteToggleTests(RoomTestCase):
+    def assertVoteQueries(self, members):
+        host = make_user(f"host{members}")
+        room = make_room(host, *User.objects.bulk_create(
+            User(username=f"m{members}-{i}") for i in range(members)
+        ))
+        room_song = make_room_song(room, f"{members:011d}")
+        client = APIClient()
+        client.force_authenticate(host)
+
+        # One savepoint (the test's transaction makes toggle_vote's atomic
+        # one); the rest is the vote, the counter and the change log.
+        for action, queries in (("added", 10), ("removed", 11)):
+            with self.assertNumQueries(queries):
+                response = client.post(f"/api/songs/{room_song.id}/vote/")
+            self.assertEqual(response.data["action"], action)
+        self.assertEqual(RoomSong.objects.get(pk=room_song.pk).vote_count, 0)
+
+    def test_query_count_does_not_grow_with_room_size(self):
+        self.assertVoteQueries(2)
+        self.assertVoteQueries(200)
+
+    def test_missing_and_foreign_songs(self):
+        host = make_user("host")
+        make_room(host)
+        other = make_room_song(make_room(make_user("other")), "aaaaaaaaaaa")
+        client = APIClient()
+        client.force_authenticate(host)
+
+        self.assertEqual(client.post("/api/songs/999999/vote/").status_code, 404)
+        self.assertEqual(client.post(f"/api/songs/{other.id}/vote/").status_code, 403)
+        self.assertFalse(Vote.objects.exists())
+
+
+class PlayNextSongTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.host = make_user("host")
+        self.room = make_room(self.host)
+        self.client = APIClient()
+        self.client.force_authenticate(self.host)
+
+    def test_skips_songs_in_cooldown(self):
+        recent = make_room_song(self.room, "aaaaaaaaaaa")
+        RoomSong.objects.filter(pk=recent.pk).update(vote_count=3, played_at=timezone.now())
+        fresh = make_room_song(self.room, "bbbbbbbbbbb")
+
+        response = self.client.post("/api/songs/play-next/")
+        self.assertEqual(response.data["room_song_id"], fresh.id)
+
+        response = self.client.post("/api/songs/play-next/")
+        self.assertEqual(response.status_code, 400)
+
+    def test_follows_votes(self):
+        first = make_room_song(self.room, "aaaaaaaaaaa")
+        second = make_room_song(self.room, "bbbbbbbbbbb")
+
+        self.client.post(f"/api/songs/{second.id}/vote/")
+        self.assertEqual(self.client.post("/api/songs/play-next/").data["room_song_id"], second.id)
+        self.assertEqual(self.client.post("/api/songs/play-next/").data["room_song_id"], first.id)
+
+    def test_expected_song_token_makes_next_idempotent(self):
+        first = make_room_song(self.room, "aaaaaaaaaaa")
+        second = make_room_song(self.room, "bbbbbbbbbbb")
+        self.client.post("/api/songs/play-next/")
+
+        for _ in range(2):
+            response = self.client.post(
+                "/api/songs/play-next/", {"expected_room_song_id": first.id}, format="json"
+            )
+            self.assertEqual(response.data["room_song_id"], second.id)
+
+        self.assertFalse(response.data["advanced"])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.now_playing_id, second.id)
+        response = self.client.get("/api/songs/now-playing/")
+        self.assertEqual(response.data["room_song_id"], second.id)
+
+    def test_replayable_song_competes_on_votes(self):
+        old = make_room_song(self.room, "aaaaaaaaaaa")
+        RoomSong.objects.filter(pk=old.pk).update(
+            vote_count=3, played_at=timezone.now() - timedelta(hours=1)
+        )
+        fresh = make_room_song(self.room, "bbbbbbbbbbb")
+
+        self.assertEqual(self.client.post("/api/songs/play-next/").data["room_song_id"], old.id)
+        self.assertEqual(self.client.post("/api/songs/play-next/").data["room_song_id"], fresh.id)
+
+    def test_plays_are_recorded(self):
+        first = make_room_song(self.room, "aaaaaaaaaaa")
+        make_room_song(self.room, "bbbbbbbbbbb")
+        self.client.post("/api/songs/play-next/")
+        self.client.post("/api/songs/play-next/")
+
+        self.assertEqual(PlayHistory.objects.filter(room=self.room).count(), 2)
+        history = self.client.get("/api/songs/history/").data
+        self.assertEqual([play["video_id"] for play in history], ["bbbbbbbbbbb", "aaaaaaaaaaa"])
+        self.assertEqual(history[1]["played_at"], RoomSong.objects.get(pk=first.pk).played_at)
+
+    def test_only_host_can_advance(self):
+        guest = make_user("guest")
+        self.room.members.add(guest)
+        self.client.force_authenticate(guest)
+        self.assertEqual(self.client.post("/api/songs/play-next/").status_code, 403)
+
+
+class ConditionalGetTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.host = make_user("host")
+        self.room = make_room(self.host)
+        self.song = make_room_song(self.room, "aaaaaaaaaaa")
+        self.client = APIClient()
+        self.client.force_authenticate(self.host)
+
+    def revalidate(self, url, etag):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_queue_is_a_single_read(self):
+        etag = self.client.get("/api/songs/queue/")["ETag"]
+
+        with self.assertNumQueries(1):
+            response = self.revalidate("/api/songs/queue/", etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_mutations_change_the_etag(self):
+        seen = {self.client.get("/api/songs/queue/")["ETag"]}
+
+        def changed():
+            response = self.revalidate("/api/songs/queue/", ",".join(seen))
+            self.assertEqual(response.status_code, 200)
+            seen.add(response["ETag"])
+
+        self.client.post(f"/api/songs/{self.song.id}/vote/")
+        changed()
+        self.client.post(f"/api/songs/{self.song.id}/vote/")
+        changed()
+        make_room_song(self.room, "bbbbbbbbbbb")
+        changed()
+        self.client.post("/api/songs/play-next/")
+        changed()
+
+    def test_now_playing_revalidates(self):
+        etag = self.client.get("/api/songs/now-playing/")["ETag"]
+        self.assertEqual(self.revalidate("/api/songs/now-playing/", etag).status_code, 304)
+
+        self.client.post("/api/songs/play-next/")
+        response = self.revalidate("/api/songs/now-playing/", etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["room_song_id"], self.song.id)
+
+
+class SharedQueueTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.host = make_user("host")
+        self.guest = make_user("guest")
+        self.room = make_room(self.host, self.guest)
+        self.songs = [make_room_song(self.room, f"{i:011d}") for i in range(20)]
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        client.get("/api/room/detail/")
+        return client
+
+    def test_ranking_is_shared_between_listeners(self):
+        host, guest = self.client_for(self.host), self.client_for(self.guest)
+        host.post(f"/api/songs/{self.songs[5].id}/vote/")
+
+        # Room read, ranking, and the caller's voted set; the guest reuses
+        # the ranking.
+        with self.assertNumQueries(3):
+            host_view = host.get("/api/songs/queue/").data
+        with self.assertNumQueries(2):
+            guest_view = guest.get("/api/songs/queue/").data
+
+        self.assertEqual(host_view[0]["id"], self.songs[5].id)
+        self.assertEqual([song["id"] for song in guest_view], [song["id"] for song in host_view])
+        self.assertEqual(list(host_view[0]), ["id", "title", "video_id", "thumbnail", "vote_count", "has_voted"])
+        self.assertTrue(host_view[0]["has_voted"])
+        self.assertFalse(guest_view[0]["has_voted"])
+
+        guest.post(f"/api/songs/{self.songs[7].id}/vote/")
+        guest_view = guest.get("/api/songs/queue/").data
+        self.assertEqual([song["id"] for song in guest_view][:2], [self.songs[5].id, self.songs[7].id])
+        self.assertEqual([song["has_voted"] for song in guest_view][:2], [False, True])
+
+
+    def test_lean_rows_match_the_serializer(self):
+        self.client_for(self.host).post(f"/api/songs/{self.songs[2].id}/vote/")
+        qs = (
+            RoomSong.objects
+            .filter(room=self.room, played_at__isnull=True)
+            .select_related("song")
+            .annotate(has_voted=Exists(Vote.objects.filter(room_song=OuterRef("pk"), user=self.host)))
+            .order_by("-vote_count", "created_at")
+        )
+        expected = json.loads(JSONRenderer().render(RoomSongSerializer(qs, many=True).data))
+        lean = json.loads(JSONRenderer().render(queue_for(self.room, self.host)))
+        self.assertEqual(lean, expected)
+        self.assertEqual([list(row) for row in lean], [list(row) for row in expected])
+
+
+class QueueChangesTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.host = make_user("host")
+        self.room = make_room(self.host)
+        self.first = make_room_song(self.room, "aaaaaaaaaaa")
+        self.second = make_room_song(self.room, "bbbbbbbbbbb")
+        self.client = APIClient()
+        self.client.force_authenticate(self.host)
+
+    def changes(self, since=None):
+        url = "/api/songs/queue/changes/"
+        return self.client.get(url if since is None else f"{url}?since={since}").data
+
+    def test_snapshot_then_deltas(self):
+        snapshot = self.changes()
+        self.assertTrue(snapshot["full"])
+        self.assertEqual([song["id"] for song in snapshot["songs"]], [self.first.id, self.second.id])
+
+        self.client.post(f"/api/songs/{self.second.id}/vote/")
+        delta = self.changes(snapshot["cursor"])
+        self.assertFalse(delta["full"])
+        self.assertEqual([(s["id"], s["vote_count"], s["has_voted"]) for s in delta["changed"]],
+                         [(self.second.id, 1, True)])
+        self.assertEqual(delta["removed"], [])
+
+        self.client.post("/api/songs/play-next/")
+        third = make_room_song(self.room, "ccccccccccc")
+        delta = self.changes(delta["cursor"])
+        self.assertEqual([song["id"] for song in delta["changed"]], [third.id])
+        self.assertEqual(delta["removed"], [self.second.id])
+
+        self.assertEqual(self.changes(delta["cursor"]), {
+            "cursor": delta["cursor"], "full": False, "changed": [], "removed": [],
+        })
+
+    def test_pruned_or_unknown_cursor_gets_snapshot(self):
+        cursor = self.changes()["cursor"]
+        with self.settings(QUEUE_CHANGE_RETENTION=2):
+            for _ in range(PRUNE_EVERY):
+                self.client.post(f"/api/songs/{self.first.id}/vote/")
+        self.assertTrue(self.changes(cursor)["full"])
+        self.assertTrue(self.changes(10 ** 9)["full"])
+        self.assertTrue(self.changes("soon")["full"])
+
+    def test_closing_room_drops_its_log(self):
+        self.client.post(f"/api/songs/{self.first.id}/vote/")
+        self.client.post("/api/room/leave/")
+        self.assertFalse(QueueChange.objects.exists())
+
+
+class VoteBufferTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.host = make_user("host")
+        self.guest = make_user("guest")
+        self.room = make_room(self.host, self.guest)
+        self.song = make_room_song(self.room, "aaaaaaaaaaa")
+        journal_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(journal_dir.cleanup)
+        self.journal = Path(journal_dir.name) / "votes.log"
+        self.buffer = VoteBuffer(flush_interval=None, journal=self.journal)
+        patcher = mock.patch("Room.views.get_vote_buffer", return_value=self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def vote(self, user, room_song_id=None):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post(f"/api/songs/{room_song_id or self.song.id}/vote/")
+
+    def test_toggles_are_answered_from_memory_and_flushed_in_batches(self):
+        self.assertEqual(self.vote(self.host).data, {"action": "added", "vote_count": 1})
+        self.assertEqual(self.vote(self.guest).data, {"action": "added", "vote_count": 2})
+        self.assertEqual(self.vote(self.guest).data, {"action": "removed", "vote_count": 1})
+        self.assertFalse(Vote.objects.exists())
+
+        version = Room.objects.get(pk=self.room.pk).version
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.buffer.flush(), 2)
+
+        self.assertEqual(list(Vote.objects.values_list("user_id", flat=True)), [self.host.id])
+        self.song.refresh_from_db()
+        self.assertEqual(self.song.vote_count, 1)
+        self.assertEqual(Room.objects.get(pk=self.room.pk).version, version + 1)
+        # Only this process's lock is left.
+        self.assertEqual(
+            [path.name for path in self.journal.parent.iterdir()],
+            [f"votes-{os.getpid()}.lock"] if fcntl else [],
+        )
+
+        self.assertEqual(self.vote(self.host).data, {"action": "removed", "vote_count": 0})
+        self.buffer.flush()
+        self.assertFalse(Vote.objects.exists())
+
+    def test_unflushed_journal_is_replayed(self):
+        self.vote(self.host)
+        self.vote(self.guest)
+        self.vote(self.guest)
+
+        restarted = VoteBuffer(flush_interval=None, journal=self.journal)
+        self.assertEqual(restarted.replay(), 2)
+        self.assertEqual(list(Vote.objects.values_list("user_id", flat=True)), [self.host.id])
+        self.assertEqual(restarted.replay(), 0)
+
+    @skipIf(fcntl is None, "needs fcntl")
+    def test_takes_over_journals_of_exited_processes_only(self):
+        def journal(pid, user, locked):
+            path = self.journal.with_name(f"votes-{pid}.log")
+            path.write_text(json.dumps([self.song.id, user.id, True]) + "\n")
+            lock = open(path.with_suffix(".lock"), "a")
+            self.addCleanup(lock.close)
+            if locked:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            else:
+                lock.close()
+            return path
+
+        exited = journal(1_000_001, self.host, locked=False)
+        alive = journal(1_000_002, self.guest, locked=True)
+
+        self.assertEqual(self.buffer.replay(), 1)
+        self.assertEqual(list(Vote.objects.values_list("user_id", flat=True)), [self.host.id])
+        self.assertFalse(exited.exists() or exited.with_suffix(".lock").exists())
+        self.assertTrue(alive.exists())
+
+    def test_rejects_outsiders_and_unknown_songs(self):
+        self.assertEqual(self.vote(make_user("outsider")).status_code, 403)
+        self.assertEqual(self.vote(self.host, room_song_id=10 ** 6).status_code, 404)
+        self.assertEqual(self.buffer.stats()["pending"], 0)
+
+
+class QueryBudgetTests(QueryBudgetMixin, RoomTestCase):
+    # Hot polling and voting paths; none of them may grow with the queue
+    # or the room.
+    budgets = {
+        "room_detail": 1,
+        "room_songs": 3,
+        "queue_changes": 3,
+        "now_playing": 2,
+        "vote_toggle": 11,
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.host = make_user("host")
+        self.room = make_room(self.host)
+        self.songs = [make_room_song(self.room, f"{i:011d}") for i in range(30)]
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.host)}")
+        self.client.get("/api/room/detail/")
+        self.client.post("/api/songs/play-next/")
+
+    def test_hot_endpoints_stay_within_budget(self):
+        responses = [
+            self.client.get("/api/room/detail/"),
+            self.client.get("/api/songs/queue/"),
+            self.client.get("/api/songs/queue/changes/"),
+            self.client.get("/api/songs/now-playing/"),
+            self.client.post(f"/api/songs/{self.songs[3].id}/vote/"),
+        ]
+        self.assertEqual(sorted(r.profile.url_name for r in responses), sorted(self.budgets))
+        for response in responses:
+            self.assertEqual(response.status_code, 200)
+            self.assertQueryBudget(response, self.budgets[response.profile.url_name])
+
+    def test_debug_headers_and_aggregate(self):
+        profiling.stats.reset()
+        with self.settings(PROFILING={"HEADERS": True}):
+            response = self.client.get("/api/songs/queue/")
+        self.assertEqual(response["X-Query-Count"], str(response.profile.queries))
+        self.assertIn("serializer;dur=", response["Server-Timing"])
+        self.assertGreater(response.profile.serializer_time, 0)
+
+        with self.settings(PROFILING={"HEADERS": False}):
+            self.assertNotIn("X-Query-Count", self.client.get("/api/songs/queue/"))
+
+        admin = User.objects.create_superuser("admin", password="pass12345")
+        self.client.force_authenticate(admin)
+        summary = self.client.get("/api/debug/profile/").data["room_songs"]
+        self.assertEqual(summary["requests"], 2)
+        self.assertEqual(sum(summary["latency_histogram_ms"].values()), 2)
+
+
+class FakeOEmbedServer:
+    """Local stand-in for the YouTube oEmbed endpoint."""
+
+    def __init__(self, videos, delay=0):
+        self.videos = videos
+        self.delay = delay
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                video_id = query["url"][0].rsplit("v=", 1)[-1]
+                fake.requests.append(video_id)
+                time.sleep(fake.delay)
+                if video_id not in fake.videos:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = json.dumps({
+                    "title": fake.videos[video_id],
+                    "thumbnail_url": f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg",
+                }).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/oembed"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def resolver(self, **kwargs):
+        return MetadataResolver(transport=OEmbedTransport(url=self.url, timeout=2), **kwargs)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetadataResolverTests(TestCase):
+    def setUp(self):
+        self.upstream = FakeOEmbedServer({"aaaaaaaaaaa": "First", "bbbbbbbbbbb": "Second"})
+        self.addCleanup(self.upstream.close)
+
+    def test_caches_hits_and_misses(self):
+        resolver = self.upstream.resolver()
+        self.assertEqual(resolver.resolve("aaaaaaaaaaa").title, "First")
+        self.assertEqual(resolver.resolve("aaaaaaaaaaa").title, "First")
+        for _ in range(2):
+            with self.assertRaises(VideoNotFound):
+                resolver.resolve("zzzzzzzzzzz")
+
+        self.assertEqual(self.upstream.requests, ["aaaaaaaaaaa", "zzzzzzzzzzz"])
+        stats = resolver.stats()
+        self.assertEqual((stats["cache_hits"], stats["negative_hits"], stats["misses"]), (1, 1, 2))
+
+    def test_known_songs_skip_upstream(self):
+        Song.objects.create(title="Stored", video_id="ccccccccccc", thumbnail="https://i.ytimg.com/c.jpg")
+        resolver = self.upstream.resolver()
+        self.assertEqual(resolver.resolve("ccccccccccc").title, "Stored")
+        self.assertEqual(self.upstream.requests, [])
+
+    def test_concurrent_lookups_share_one_request(self):
+        self.upstream.delay = 0.2
+        resolver = self.upstream.resolver()
+        results = resolver.resolve_many(["aaaaaaaaaaa", "bbbbbbbbbbb", "zzzzzzzzzzz"])
+        self.assertEqual(results["bbbbbbbbbbb"].title, "Second")
+        self.assertIsInstance(results["zzzzzzzzzzz"], VideoNotFound)
+
+        resolver = self.upstream.resolver()
+        self.upstream.requests.clear()
+        threads = [
+            threading.Thread(target=resolver._fetch, args=("aaaaaaaaaaa",))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.upstream.requests, ["aaaaaaaaaaa"])
+        self.assertEqual(resolver.stats()["coalesced"], 4)
+
+    def test_durations_come_from_the_data_api(self):
+        durations = mock.Mock(side_effect=[253, MetadataUnavailable("quota")])
+        resolver = self.upstream.resolver(durations=durations)
+        self.assertEqual(resolver.resolve("aaaaaaaaaaa").duration, 253)
+        self.assertIsNone(resolver.resolve("bbbbbbbbbbb").duration)
+        self.assertEqual(resolver.stats()["duration_errors"], 1)
+
+        self.assertEqual(parse_duration("PT4M13S"), 253)
+        self.assertEqual(parse_duration("PT1H"), 3600)
+        self.assertEqual(parse_duration("P1DT2S"), 86402)
+        self.assertIsNone(parse_duration("P0D garbage"))
+
+    def test_song_add_uses_resolver(self):
+        user = make_user("host")
+        make_room(user)
+        client = APIClient()
+        client.force_authenticate(user)
+
+        with mock.patch("Room.views.get_resolver", return_value=self.upstream.resolver()):
+            response = client.post("/api/songs/add/", {"url": "https://youtu.be/aaaaaaaaaaa"}, format="json")
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.data["title"], "First")
+
+            response = client.post("/api/songs/add/", {"url": "https://youtu.be/zzzzzzzzzzz"}, format="json")
+            self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(self.upstream.requests, ["aaaaaaaaaaa", "zzzzzzzzzzz"])
+
+
+class FlakyResolver:
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+
+    def resolve(self, video_id):
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return VideoMetadata(video_id, outcome, f"https://i.ytimg.com/vi/{video_id}/0.jpg")
+
+
+class AsyncIngestTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("host")
+        self.room = make_room(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.sleeps = []
+
+    def add_song(self, resolver):
+        ingest = IngestQueue(
+            resolver=resolver, executor=ImmediateExecutor(), sleep=self.sleeps.append
+        )
+        with mock.patch("Room.views.get_ingest_queue", return_value=ingest):
+            response = self.client.post(
+                "/api/songs/add/",
+                {"url": "https://youtu.be/aaaaaaaaaaa", "async": True},
+                format="json",
+            )
+        return ingest, response
+
+    def test_placeholder_filled_in_after_retries(self):
+        ingest, response = self.add_song(FlakyResolver([
+            MetadataUnavailable("down"), MetadataUnavailable("down"), "Resolved",
+        ]))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data["title"], "aaaaaaaaaaa")
+
+        job = ingest.get(response.data["job_id"])
+        self.assertEqual((job.status, job.attempts), ("ready", 3))
+        self.assertEqual(self.sleeps, [1.0, 2.0])
+        song = Song.objects.get(video_id="aaaaaaaaaaa")
+        self.assertEqual((song.title, song.status), ("Resolved", Song.Status.READY))
+
+    def test_failure_removes_placeholder(self):
+        ingest, response = self.add_song(FlakyResolver([VideoNotFound("aaaaaaaaaaa")]))
+
+        job = ingest.get(response.data["job_id"])
+        self.assertEqual((job.status, job.error), ("failed", "Invalid YouTube video"))
+        self.assertFalse(RoomSong.objects.filter(room=self.room).exists())
+        self.assertEqual(Song.objects.get(video_id="aaaaaaaaaaa").status, Song.Status.FAILED)
+
+    def test_recovers_placeholders_whose_job_was_lost(self):
+        abandoned, recent = [
+            make_room_song(self.room, video_id) for video_id in ("bbbbbbbbbbb", "ccccccccccc")
+        ]
+        Song.objects.update(status=Song.Status.PENDING)
+        RoomSong.objects.filter(pk=abandoned.pk).update(created_at=timezone.now() - timedelta(hours=1))
+        changes = QueueChange.objects.filter(room_song_id=abandoned.pk)
+        logged = changes.count()
+
+        with mock.patch("Room.ingest.get_resolver", return_value=FlakyResolver(["Recovered"])):
+            out = io.StringIO()
+            call_command("recover_ingest", stdout=out)
+        self.assertIn("Recovered 1 pending song(s): 1 ready", out.getvalue())
+        self.assertEqual(
+            list(Song.objects.order_by("video_id").values_list("title", "status")),
+            [("Recovered", Song.Status.READY), ("Song ccccccccccc", Song.Status.PENDING)],
+        )
+        self.assertEqual(changes.count(), logged + 1)
+
+        # A job this process is running is left to finish.
+        ingest = IngestQueue(resolver=FlakyResolver(["Late"]), executor=ImmediateExecutor())
+        ingest._active["ccccccccccc"] = IngestJob("ccccccccccc")
+        self.assertEqual(ingest.recover(), [])
+        del ingest._active["ccccccccccc"]
+        self.assertEqual([job.room_ids for job in ingest.recover()], [[self.room.id]])
+        self.assertEqual(Song.objects.get(pk=recent.song_id).status, Song.Status.READY)
+
+
+class SongImportTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("host")
+        self.room = make_room(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.upstream = FakeOEmbedServer({"nnnnnnnnnnn": "New"})
+        self.addCleanup(self.upstream.close)
+
+    def import_items(self, items):
+        with mock.patch("Room.importer.get_resolver", return_value=self.upstream.resolver()):
+            return self.client.post("/api/songs/import/", {"items": items}, format="json")
+
+    def test_applies_song_add_rules_per_item(self):
+        queued = make_room_song(self.room, "qqqqqqqqqqq")
+        cooling = make_room_song(self.room, "ccccccccccc")
+        old = make_room_song(self.room, "ooooooooooo")
+        RoomSong.objects.filter(pk=cooling.pk).update(played_at=timezone.now())
+        RoomSong.objects.filter(pk=old.pk).update(played_at=timezone.now() - timedelta(hours=1))
+        Song.objects.create(title="Known", video_id="kkkkkkkkkkk", thumbnail="https://i.ytimg.com/k.jpg")
+
+        response = self.import_items([
+            "https://youtu.be/kkkkkkkkkkk",
+            "https://www.youtube.com/watch?v=qqqqqqqqqqq",
+            "ccccccccccc",
+            "ooooooooooo",
+            "nnnnnnnnnnn",
+            "zzzzzzzzzzz",
+            "not a video",
+            "kkkkkkkkkkk",
+        ])
+
+        statuses = [(r["video_id"], r["status"]) for r in response.data["results"]]
+        self.assertEqual(statuses, [
+            ("kkkkkkkkkkk", "added"),
+            ("qqqqqqqqqqq", "voted"),
+            ("ccccccccccc", "cooldown"),
+            ("ooooooooooo", "requeued"),
+            ("nnnnnnnnnnn", "added"),
+            ("zzzzzzzzzzz", "error"),
+            (None, "invalid"),
+            ("kkkkkkkkkkk", "duplicate"),
+        ])
+        queued.refresh_from_db()
+        old.refresh_from_db()
+        self.assertEqual(queued.vote_count, 1)
+        self.assertIsNone(old.played_at)
+        self.assertEqual(Song.objects.get(video_id="nnnnnnnnnnn").title, "New")
+
+    def test_fetches_outside_the_transaction_and_reports_outages_as_retryable(self):
+        depth = len(connection.savepoint_ids)
+        seen = []
+
+        def resolve_many(video_ids):
+            seen.append(len(connection.savepoint_ids))
+            return {video_id: MetadataUnavailable("down") for video_id in video_ids}
+
+        resolver = mock.Mock(resolve_many=resolve_many)
+        with mock.patch("Room.importer.get_resolver", return_value=resolver):
+            response = self.client.post("/api/songs/import/", {"items": ["uuuuuuuuuuu"]}, format="json")
+
+        self.assertEqual(seen, [depth])
+        self.assertEqual(response.data["results"][0]["status"], "error")
+        self.assertTrue(response.data["results"][0]["retryable"])
+        self.assertFalse(Song.objects.filter(video_id="uuuuuuuuuuu").exists())
+
+    def test_votes_already_cast_are_not_counted_again(self):
+        voted, fresh = make_room_song(self.room, "vvvvvvvvvvv"), make_room_song(self.room, "fffffffffff")
+        Vote.objects.create(room_song=voted, user=self.user)
+
+        # As if the vote had landed after the import read the user's votes.
+        self.assertEqual(add_votes([voted, fresh], self.user), [fresh])
+        voted.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual((voted.vote_count, fresh.vote_count), (1, 1))
+
+    def test_query_count_independent_of_batch_size(self):
+        def count(prefix, size):
+            songs = Song.objects.bulk_create(
+                Song(title="t", video_id=f"{prefix}{i:010d}", thumbnail="https://i.ytimg.com/t.jpg")
+                for i in range(size)
+            )
+            with CaptureQueriesContext(connection) as ctx:
+                self.import_items([song.video_id for song in songs])
+            return len(ctx.captured_queries)
+
+        count("w", 1)  # warm the membership cache
+        self.assertEqual(count("a", 3), count("b", 60))
+
+
+class MembershipTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.host = make_user("host")
+        self.guest = make_user("guest")
+        self.room = make_room(self.host)
+        self.client = APIClient()
+        self.client.force_authenticate(self.guest)
+
+    def join(self, room):
+        return self.client.post("/api/room/join/", {"room_code": room.room_code}, format="json")
+
+    def test_one_room_per_user_in_schema(self):
+        other = make_room(make_user("other"))
+        self.room.members.add(self.guest)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                other.members.add(self.guest)
+
+    def test_room_lookup_is_cached_and_invalidated(self):
+        self.assertEqual(self.join(self.room).status_code, 200)
+
+        self.client.get("/api/room/detail/")
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/room/detail/")
+        self.assertEqual(response.data["room_code"], self.room.room_code)
+
+        self.client.post("/api/room/leave/")
+        self.assertEqual(self.client.get("/api/room/detail/").status_code, 400)
+
+        other = make_room(make_user("other"))
+        self.assertEqual(self.join(other).status_code, 200)
+        self.assertEqual(self.join(self.room).status_code, 400)
+        self.assertEqual(self.client.get("/api/room/detail/").data["room_code"], other.room_code)
+
+    def test_writes_check_membership_in_the_database(self):
+        self.assertEqual(self.join(self.room).status_code, 200)
+        self.assertEqual(self.client.get("/api/room/detail/").status_code, 200)
+
+        # Left through another worker, whose invalidation never reaches
+        # this process's cache.
+        with mock.patch("Room.signals.forget_rooms"):
+            self.room.members.remove(self.guest)
+        song = make_room_song(self.room, "aaaaaaaaaaa")
+        response = self.client.post("/api/songs/add/", {"url": "https://youtu.be/aaaaaaaaaaa"}, format="json")
+        self.assertEqual(response.data, {"error": "Not in a room"})
+        self.assertEqual(self.client.post(f"/api/songs/{song.id}/vote/").status_code, 403)
+
+        other = make_room(make_user("other"))
+        self.assertEqual(self.join(other).status_code, 200)
+        self.assertEqual(self.client.get("/api/room/detail/").data["room_code"], other.room_code)
+
+    def test_host_leaving_closes_room_for_members(self):
+        self.join(self.room)
+        self.client.get("/api/room/detail/")
+
+        host_client = APIClient()
+        host_client.force_authenticate(self.host)
+        host_client.post("/api/room/leave/")
+
+        self.assertEqual(self.client.get("/api/room/detail/").status_code, 400)
+
+
+class PlayNextConcurrencyTests(TransactionTestCase):
+    def test_parallel_requests_advance_once(self):
+        host = make_user("host")
+        room = make_room(host)
+        songs = [make_room_song(room, f"{i:011d}") for i in range(5)]
+        barrier = threading.Barrier(8)
+        responses = []
+
+        def fire():
+            client = APIClient()
+            client.force_authenticate(host)
+            barrier.wait()
+            responses.append(
+                client.post("/api/songs/play-next/", {"expected_room_song_id": None}, format="json")
+            )
+            connection.close()
+
+        threads = [threading.Thread(target=fire) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([r.status_code for r in responses], [200] * 8)
+        self.assertEqual(sum(r.data["advanced"] for r in responses), 1)
+        self.assertEqual({r.data["room_song_id"] for r in responses}, {songs[0].id})
+        self.assertEqual(RoomSong.objects.filter(played_at__isnull=False).count(), 1)
+
+
+class DatabaseSettingsTests(TestCase):
+    base_dir = Path("/srv/rock")
+
+    def test_sqlite_defaults_to_wal_profile(self):
+        config = database_from_env({}, self.base_dir)
+        self.assertEqual(config["NAME"], self.base_dir / "db.sqlite3")
+        self.assertIn("PRAGMA journal_mode=WAL", config["OPTIONS"]["init_command"])
+        self.assertIn("PRAGMA synchronous=NORMAL", config["OPTIONS"]["init_command"])
+        self.assertEqual(config["OPTIONS"]["transaction_mode"], "IMMEDIATE")
+
+        plain = database_from_env(
+            {"DATABASE_URL": "sqlite:////var/rock.db", "SQLITE_PROFILE": "default"}, self.base_dir
+        )
+        self.assertEqual(plain["NAME"], "/var/rock.db")
+        self.assertNotIn("OPTIONS", plain)
+
+    def test_postgres_url_with_pool(self):
+        config = database_from_env({
+            "DATABASE_URL": "postgres://rock:s%40cret@db:5433/rock?sslmode=require",
+            "DATABASE_POOL_MAX_SIZE": "20",
+        }, self.base_dir)
+        self.assertEqual(config["ENGINE"], "django.db.backends.postgresql")
+        self.assertEqual(
+            (config["NAME"], config["USER"], config["PASSWORD"], config["HOST"], config["PORT"]),
+            ("rock", "rock", "s@cret", "db", "5433"),
+        )
+        self.assertEqual(config["OPTIONS"]["sslmode"], "require")
+        self.assertEqual(config["OPTIONS"]["pool"]["max_size"], 20)
+        self.assertEqual(config["CONN_MAX_AGE"], 0)
+
+        persistent = database_from_env({"DATABASE_URL": "postgres://db/rock"}, self.base_dir)
+        self.assertEqual(persistent["CONN_MAX_AGE"], 60)
+        self.assertNotIn("pool", persistent["OPTIONS"])
+
+    def test_wal_profile_applied_on_connect(self):
+        if connection.vendor != "sqlite" or "init_command" not in connection.settings_dict["OPTIONS"]:
+            self.skipTest("WAL profile not in use")
+        with connection.cursor() as cursor:
+            self.assertEqual(cursor.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            self.assertEqual(cursor.execute("PRAGMA synchronous").fetchone()[0], 1)
+
+
+class LoadHarnessTests(RoomTestCase):
+    def test_seed_and_drop_scale(self):
+        layout = seed_scale(rooms=2, members=3, songs=4, votes_per_member=2, prefix="lt")
+        self.assertEqual(len(layout), 2)
+        for room_id, room in layout.items():
+            self.assertEqual(Room.objects.get(pk=room_id).host_id, room["host"])
+            self.assertEqual(len(room["members"]), 3)
+            self.assertEqual(
+                sorted(RoomSong.objects.filter(room_id=room_id).values_list("pk", flat=True)),
+                sorted(room["songs"]),
+            )
+            self.assertEqual(Vote.objects.filter(room_song__room_id=room_id).count(), 6)
+        mismatched = [
+            room_song for room_song in RoomSong.objects.filter(room_id__in=layout)
+            if room_song.vote_count != room_song.votes.count()
+        ]
+        self.assertEqual(mismatched, [])
+
+        # The prefix is matched literally, not as a pattern.
+        drop_scale("l.")
+        self.assertEqual(Song.objects.filter(video_id__startswith="lt").count(), 4)
+        self.assertEqual(Room.objects.filter(pk__in=layout).count(), 2)
+
+        drop_scale("lt")
+        self.assertFalse(Room.objects.filter(pk__in=layout).exists())
+        self.assertFalse(User.objects.filter(username__startswith="lt-").exists())
+        self.assertFalse(Song.objects.filter(video_id__startswith="lt").exists())
+
+    def test_song_add_with_stub_transport(self):
+        user = make_user("host")
+        make_room(user)
+        client = APIClient()
+        client.force_authenticate(user)
+        config = {"TRANSPORT": "Room.benchmarks.StubOEmbedTransport"}
+        with self.settings(YOUTUBE_OEMBED=config):
+            get_resolver.cache_clear()
+            self.addCleanup(get_resolver.cache_clear)
+            response = client.post(
+                "/api/songs/add/", {"url": f"https://youtu.be/{video_id('st', 7)}"}, format="json"
+            )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["title"], "Stub video st000000007")
+
+
+class AsyncOEmbedStub:
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.requests = []
+
+    async def __call__(self, video_id):
+        self.requests.append(video_id)
+        await asyncio.sleep(self.delay)
+        if video_id == "zzzzzzzzzzz":
+            raise VideoNotFound(video_id)
+        return {"title": f"Async {video_id}", "thumbnail_url": "https://i.ytimg.com/a.jpg"}
+
+
+class AsyncViewTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.host = make_user("host")
+        self.guest = make_user("guest")
+        self.room = make_room(self.host, self.guest)
+        self.room_song = make_room_song(self.room, "aaaaaaaaaaa")
+        self.factory = AsyncRequestFactory()
+
+    def call(self, view, method, path, data=None, user=None, headers=None, **kwargs):
+        headers = dict(headers or {})
+        if user is not False:
+            headers["Authorization"] = f"Bearer {AccessToken.for_user(user or self.guest)}"
+        if method == "post":
+            request = self.factory.post(path, data, content_type="application/json", headers=headers)
+        else:
+            request = self.factory.get(path, headers=headers)
+        return async_to_sync(view.as_view())(request, **kwargs)
+
+    def test_reads_match_the_sync_views(self):
+        client = APIClient()
+        client.force_authenticate(self.guest)
+        for view, path in [
+            (async_views.RoomSongs, "/api/songs/queue/"),
+            (async_views.NowPlaying, "/api/songs/now-playing/"),
+            (async_views.DetailRoom, "/api/room/detail/"),
+        ]:
+            expected = client.get(path)
+            response = self.call(view, "get", path)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, expected.content)
+            self.assertEqual(response.get("ETag"), expected.get("ETag"))
+
+        response = self.call(
+            async_views.RoomSongs, "get", "/api/songs/queue/",
+            headers={"If-None-Match": expected_etag(self.room)},
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_authentication_errors(self):
+        response = self.call(async_views.RoomSongs, "get", "/api/songs/queue/", user=False)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response["WWW-Authenticate"], 'Bearer realm="api"')
+        self.assertEqual(
+            json.loads(response.content), {"detail": "Authentication credentials were not provided."}
+        )
+
+        response = self.call(
+            async_views.RoomSongs, "get", "/api/songs/queue/", user=False,
+            headers={"Authorization": "Bearer nonsense"},
+        )
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(json.loads(response.content)["code"], "token_not_valid")
+
+    def test_vote_toggle(self):
+        path = f"/api/songs/{self.room_song.pk}/vote/"
+        response = self.call(async_views.VoteToggle, "post", path, room_song_id=self.room_song.pk)
+        self.assertEqual(json.loads(response.content), {"action": "added", "vote_count": 1})
+        response = self.call(async_views.VoteToggle, "post", path, room_song_id=self.room_song.pk)
+        self.assertEqual(json.loads(response.content), {"action": "removed", "vote_count": 0})
+
+        outsider = make_user("outsider")
+        response = self.call(
+            async_views.VoteToggle, "post", path, user=outsider, room_song_id=self.room_song.pk
+        )
+        self.assertEqual(response.status_code, 403)
+        response = self.call(async_views.VoteToggle, "post", "/api/songs/0/vote/", room_song_id=0)
+        self.assertEqual(response.status_code, 404)
+
+    def test_song_add_awaits_the_async_transport(self):
+        stub = AsyncOEmbedStub()
+        resolver = MetadataResolver(transport=mock.Mock(side_effect=AssertionError), async_transport=stub)
+        self.patch("Room.async_views.get_resolver", return_value=resolver)
+
+        response = self.call(
+            async_views.SongAdd, "post", "/api/songs/add/", {"url": "https://youtu.be/bbbbbbbbbbb"}
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.content)["title"], "Async bbbbbbbbbbb")
+        self.assertEqual(Song.objects.get(video_id="bbbbbbbbbbb").status, Song.Status.READY)
+
+        response = self.call(
+            async_views.SongAdd, "post", "/api/songs/add/", {"url": "https://youtu.be/zzzzzzzzzzz"}
+        )
+        self.assertEqual(response.status_code, 400)
+
+        response = self.call(async_views.SongAdd, "post", "/api/songs/add/", {"url": "nope"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("url", json.loads(response.content))
+
+    def test_concurrent_async_lookups_share_one_request(self):
+        stub = AsyncOEmbedStub()
+        resolver = MetadataResolver(async_transport=stub)
+
+        async def scenario():
+            return await asyncio.gather(*(resolver._afetch("ccccccccccc") for _ in range(5)))
+
+        results = async_to_sync(scenario)()
+        self.assertEqual({meta.title for meta in results}, {"Async ccccccccccc"})
+        self.assertEqual(stub.requests, ["ccccccccccc"])
+        self.assertEqual(resolver.stats()["coalesced"], 4)
+
+    def patch(self, target, **kwargs):
+        patcher = mock.patch(target, **kwargs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+def expected_etag(room):
+    room.refresh_from_db(fields=["version"])
+    return f'"{room.id}-{room.version}"'
+
+
+class CachedAuthenticationTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("listener")
+        make_room(self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+
+    def test_principal_is_cached(self):
+        first = self.client.get("/api/room/detail/")
+        second = self.client.get("/api/room/detail/")
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(second.profile.queries, first.profile.queries - 2)  # user and membership
+        self.assertEqual(second.profile.queries, 1)
+
+    def test_deactivation_and_deletion_take_effect_at_once(self):
+        self.assertEqual(self.client.get("/api/songs/queue/").status_code, 200)
+
+        self.user.is_active = False
+        self.user.save(update_fields=["is_active"])
+        response = self.client.get("/api/songs/queue/")
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.data["code"], "user_inactive")
+
+        self.user.is_active = True
+        self.user.save(update_fields=["is_active"])
+        self.assertEqual(self.client.get("/api/songs/queue/").status_code, 200)
+
+        self.user.delete()
+        self.assertEqual(self.client.get("/api/songs/queue/").data["code"], "user_not_found")
+
+    def test_writes_see_changes_that_skip_the_signals(self):
+        song = make_room_song(Room.objects.get(host=self.user), "aaaaaaaaaaa")
+        self.assertEqual(self.client.get("/api/room/detail/").status_code, 200)
+
+        # A bulk update, or a save in another worker: this process's
+        # cached principal is never dropped.
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        response = self.client.post(f"/api/songs/{song.id}/vote/")
+        self.assertEqual((response.status_code, response.data["code"]), (401, "user_inactive"))
+
+        request = AsyncRequestFactory().post(
+            f"/api/songs/{song.id}/vote/", headers={"Authorization": f"Bearer {AccessToken.for_user(self.user)}"}
+        )
+        response = async_to_sync(async_views.VoteToggle.as_view())(request, room_song_id=song.id)
+        self.assertEqual(json.loads(response.content)["code"], "user_inactive")
+
+    def test_async_views_share_the_cache(self):
+        self.client.get("/api/room/detail/")
+        request = AsyncRequestFactory().get(
+            "/api/room/detail/", headers={"Authorization": f"Bearer {AccessToken.for_user(self.user)}"}
+        )
+        with CaptureQueriesContext(connection) as queries:
+            response = async_to_sync(async_views.DetailRoom.as_view())(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 1)  # the room row
+
+
+class RoomCacheTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.host = make_user("host")
+        self.guest = make_user("guest")
+        self.room = make_room(self.host, self.guest)
+        self.song = make_room_song(self.room, "aaaaaaaaaaa")
+        self.host_client, self.guest_client = APIClient(), APIClient()
+        self.host_client.force_authenticate(self.host)
+        self.guest_client.force_authenticate(self.guest)
+
+    def test_mutations_reach_every_member(self):
+        self.assertEqual(self.guest_client.get("/api/songs/now-playing/").data, {"video_id": None})
+        self.host_client.post("/api/songs/play-next/")
+        self.assertEqual(self.guest_client.get("/api/songs/now-playing/").data["video_id"], "aaaaaaaaaaa")
+
+        Song.objects.create(video_id="bbbbbbbbbbb", title="Known", thumbnail="https://i.ytimg.com/b.jpg")
+        self.host_client.post("/api/songs/add/", {"url": "https://youtu.be/bbbbbbbbbbb"}, format="json")
+        self.assertEqual(
+            [song["video_id"] for song in self.guest_client.get("/api/songs/queue/").data],
+            ["bbbbbbbbbbb"],
+        )
+
+    def test_commit_and_room_deletion_invalidate(self):
+        room_cache = get_room_cache()
+        generation = room_cache.generation(self.room.id)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.guest_client.post(f"/api/songs/{self.song.id}/vote/")
+        self.assertTrue(callbacks)
+        self.assertNotEqual(room_cache.generation(self.room.id), generation)
+
+        self.guest_client.get("/api/room/detail/")
+        self.host_client.post("/api/room/leave/")
+        self.assertEqual(self.guest_client.get("/api/room/detail/").status_code, 400)
+
+    def test_writes_from_other_workers_are_seen(self):
+        # Another process's write: the version moves but this process's
+        # cache is never told.
+        etag = self.guest_client.get("/api/songs/queue/")["ETag"]
+        with mock.patch.object(get_room_cache(), "invalidate"):
+            song = make_room_song(self.room, "bbbbbbbbbbb")
+            Room.objects.filter(pk=self.room.pk).update(version=F("version") + 1)
+            response = self.guest_client.get("/api/songs/queue/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(song.id, [row["id"] for row in response.data])
+
+    def test_concurrent_misses_load_once(self):
+        room_cache = DjangoRoomCache()
+        loads = []
+
+        def loader():
+            loads.append(1)
+            time.sleep(0.05)
+            return ["ranked"]
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(room_cache.get_or_load(1, "queue", loader)))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(loads, [1])
+        self.assertEqual(results, [["ranked"]] * 8)
+        self.assertEqual(room_cache.stats()["coalesced"], 7)
+
+    def test_async_misses_load_once_on_the_loop(self):
+        room_cache = DjangoRoomCache()
+        loads = []
+
+        async def loader():
+            loads.append(threading.current_thread())
+            await asyncio.sleep(0.05)
+            return ["ranked"]
+
+        async def scenario():
+            results = await asyncio.gather(*(room_cache.aget_or_load(1, "queue", loader) for _ in range(8)))
+            return results, threading.current_thread()
+
+        results, loop_thread = async_to_sync(scenario)()
+        self.assertEqual(loads, [loop_thread])
+        self.assertEqual(results, [["ranked"]] * 8)
+        self.assertEqual(room_cache.stats()["coalesced"], 7)
+        self.assertEqual(async_to_sync(room_cache.aget_or_load)(1, "queue", loader), ["ranked"])
+        self.assertEqual(len(loads), 1)
+
+    def test_processes_wait_for_the_lease_holder(self):
+        server = LocalRedis()
+        loading, waiting = RedisRoomCache(client=server), RedisRoomCache(client=server)
+        key = loading.key(1, "queue")
+        self.assertEqual(waiting.key(1, "queue"), key)
+        self.assertTrue(loading.add(f"{key}:lease", 1, 5))
+        threading.Timer(0.05, loading.set, (key, ["ranked"], 60)).start()
+
+        self.assertEqual(waiting.get_or_load(1, "queue", lambda: ["reloaded"]), ["ranked"])
+        self.assertEqual(waiting.stats()["lease_waits"], 1)
+
+        loading.invalidate(1)
+        self.assertEqual(waiting.get_or_load(1, "queue", lambda: ["reloaded"]), ["reloaded"])
+
+
+class RoomCodeTests(TestCase):
+    def test_permutation_is_a_bijection(self):
+        permutation = CodePermutation(b"key", 1000)
+        self.assertEqual(sorted(map(permutation, range(1000))), list(range(1000)))
+        self.assertNotEqual([permutation(n) for n in range(10)], list(range(10)))
+        self.assertNotEqual(
+            [CodePermutation(b"other", 1000)(n) for n in range(10)],
+            [permutation(n) for n in range(10)],
+        )
+
+    def test_codes_come_from_reserved_blocks(self):
+        allocator = build_allocator({"KEY": "test", "BLOCK_SIZE": 10})
+        with self.captureOnCommitCallbacks(execute=True):
+            first = allocator.allocate()
+        with self.assertNumQueries(0):
+            rest = allocator.take(9)
+        codes = [first, *rest, *allocator.take(25)]
+        self.assertEqual(len(set(codes)), 35)
+        self.assertTrue(all(len(code) == 6 and set(code) <= set(ALPHABET) for code in codes))
+
+    def test_rolled_back_reservations_are_not_kept(self):
+        allocator = build_allocator({"KEY": "test", "BLOCK_SIZE": 10})
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                allocator.allocate()
+                Room.objects.create(host=make_user("host"), room_code="DUPLI1")
+                Room.objects.create(host=make_user("other"), room_code="DUPLI1")
+        self.assertEqual(callbacks, [])
+        self.assertEqual(len(allocator._codes), 0)
+        # The rolled back block is reserved again, by whichever process.
+        self.assertEqual(build_allocator({"KEY": "test"}).take(1), [allocator.code_at(0)])
+
+    def test_one_transaction_reuses_its_pending_block(self):
+        allocator = build_allocator({"KEY": "test", "BLOCK_SIZE": 10})
+        with self.captureOnCommitCallbacks() as callbacks:
+            codes = [allocator.allocate()]
+            with self.assertNumQueries(0):
+                codes += [allocator.allocate() for _ in range(4)]
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                # The rest of the block, then a second block whose
+                # reservation the savepoint rolls back.
+                self.assertEqual(allocator.take(6)[-1], allocator.code_at(10))
+                Room.objects.create(host=make_user("host"), room_code="DUPLI1")
+                Room.objects.create(host=make_user("other"), room_code="DUPLI1")
+            codes.append(allocator.allocate())
+        self.assertEqual(len(set(codes)), 6)
+        self.assertEqual(codes[-1], allocator.code_at(10))
+        self.assertEqual(RoomCodeSequence.objects.get().next_value, 20)
+
+        self.assertEqual(len(allocator._codes), 0)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(len(allocator._codes), 9)
+        self.assertNotIn(codes[-1], allocator._codes)
+
+    def test_freed_codes_are_reused_after_quarantine(self):
+        room = make_room(make_user("host"))
+        code = room.room_code
+        room.delete()
+        self.assertTrue(FreedRoomCode.objects.filter(code=code).exists())
+
+        self.assertNotIn(code, build_allocator({"BLOCK_SIZE": 5}).take(5))
+        self.assertIn(code, build_allocator({"BLOCK_SIZE": 5, "QUARANTINE": 0}).take(5))
+        self.assertFalse(FreedRoomCode.objects.filter(code=code).exists())
+
+    def test_save_skips_codes_taken_before_the_allocator(self):
+        existing = Room.objects.create(host=make_user("old"), room_code="LEGACY")
+        with mock.patch.object(get_code_allocator(), "allocate", side_effect=["LEGACY", "FRESH1"]):
+            room = Room.objects.create(host=make_user("new"))
+        self.assertEqual(room.room_code, "FRESH1")
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Room.objects.create(host=existing.host)
+
+
+class PlayHistoryCompactionTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.host = make_user("host")
+        self.room = make_room(self.host)
+        self.now = timezone.now()
+
+    def played(self, video_id, hours_ago):
+        room_song = make_room_song(self.room, video_id)
+        Vote.objects.create(room_song=room_song, user=self.host)
+        RoomSong.objects.filter(pk=room_song.pk).update(
+            played_at=self.now - timedelta(hours=hours_ago)
+        )
+        return room_song
+
+    def test_old_played_songs_leave_the_queue_table(self):
+        stale = [self.played(f"{i:011d}", hours_ago=10) for i in range(5)]
+        recent = self.played("recentrecen", hours_ago=1)
+        current = self.played("currentcurr", hours_ago=12)
+        Room.objects.filter(pk=self.room.pk).update(now_playing=current)
+        live = make_room_song(self.room, "liveliveliv")
+        version = Room.objects.get(pk=self.room.pk).version
+
+        batches = list(compact_queue(6 * 60 * 60, batch_size=2, now=self.now))
+
+        self.assertEqual(batches, [2, 2, 1])
+        self.assertFalse(RoomSong.objects.filter(pk__in=[rs.pk for rs in stale]).exists())
+        self.assertFalse(Vote.objects.filter(room_song_id__in=[rs.pk for rs in stale]).exists())
+        self.assertEqual(
+            set(RoomSong.objects.filter(room=self.room).values_list("pk", flat=True)),
+            {recent.pk, current.pk, live.pk},
+        )
+        # Nobody could see those rows any more; nothing to tell clients.
+        self.assertEqual(Room.objects.get(pk=self.room.pk).version, version)
+
+    def test_compacted_song_can_be_added_again(self):
+        song = self.played("aaaaaaaaaaa", hours_ago=10).song
+        list(compact_queue(6 * 60 * 60, batch_size=100, now=self.now))
+
+        client = APIClient()
+        client.force_authenticate(self.host)
+        response = client.post("/api/songs/add/", {"url": f"https://youtu.be/{song.video_id}"}, format="json")
+        self.assertEqual(response.status_code, 201)
+
+    def test_history_retention(self):
+        song = make_room_song(self.room, "aaaaaaaaaaa").song
+        PlayHistory.objects.bulk_create(
+            PlayHistory(room=self.room, song=song, played_at=self.now - timedelta(days=days))
+            for days in (1, 40, 50)
+        )
+        self.assertEqual(sum(prune_history(30 * 24 * 60 * 60, batch_size=1, now=self.now)), 2)
+        self.assertEqual(PlayHistory.objects.count(), 1)
+
+        call_command("compact_play_history", stdout=io.StringIO())
+
+
+class PlaybackSchedulerTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.host = make_user("host")
+        self.room = make_room(self.host)
+        self.songs = [make_room_song(self.room, f"{i:011d}") for i in range(2)]
+        Song.objects.update(duration=180)
+        self.now = timezone.now()
+        self.clock = lambda: self.now
+
+    def start(self, minutes_ago):
+        result = play_next(self.room.id, None)
+        RoomSong.objects.filter(pk=result.room_song.pk).update(
+            played_at=self.now - timedelta(minutes=minutes_ago)
+        )
+        return result.room_song
+
+    def test_advances_each_song_once(self):
+        first = self.start(minutes_ago=5)
+        schedulers = [PlaybackScheduler(clock=self.clock) for _ in range(2)]
+        for scheduler in schedulers:
+            scheduler.refresh()
+        self.assertEqual(schedulers[0].run_due(), 1)
+        self.assertEqual(schedulers[1].run_due(), 0)
+        self.assertEqual(schedulers[1].stats()["lost_race"], 1)
+
+        self.room.refresh_from_db()
+        self.assertNotEqual(self.room.now_playing_id, first.id)
+        # The next song just started; nothing is due until it ends.
+        for scheduler in schedulers:
+            scheduler.refresh()
+            self.assertEqual(scheduler.run_due(), 0)
+        make_room_song(self.room, "ccccccccccc")
+        self.now += timedelta(minutes=4)
+        self.assertEqual(schedulers[1].run_due(), 1)
+
+    def test_leaves_songs_of_unknown_length_to_clients(self):
+        Song.objects.update(duration=None)
+        self.start(minutes_ago=5)
+        scheduler = PlaybackScheduler(clock=self.clock)
+        scheduler.refresh()
+        self.assertEqual(scheduler.run_due(), 0)
+        self.assertEqual(scheduler.stats()["rooms"], 0)
+
+    def test_resumes_a_stalled_room_when_songs_arrive(self):
+        RoomSong.objects.filter(pk=self.songs[1].pk).delete()
+        self.start(minutes_ago=5)
+        scheduler = PlaybackScheduler(clock=self.clock)
+        scheduler.refresh()
+        self.assertEqual(scheduler.run_due(), 0)
+        self.assertEqual(scheduler.stats()["stalled"], 1)
+
+        scheduler.refresh()
+        self.assertEqual(scheduler.run_due(), 0)
+        self.assertEqual(scheduler.stats()["stalled"], 1)
+
+        make_room_song(self.room, "ccccccccccc")
+        scheduler.refresh()
+        self.assertEqual(scheduler.run_due(), 1)
+
+    def test_now_playing_reports_start_and_duration(self):
+        # Clients derive their position from played_at; a 304 must not be
+        # able to freeze it.
+        self.start(minutes_ago=1)
+        client = APIClient()
+        client.force_authenticate(self.host)
+        response = client.get("/api/songs/now-playing/")
+        self.assertEqual(response.data["duration"], 180)
+        self.assertNotIn("offset", response.data)
+        self.assertAlmostEqual(
+            (timezone.now() - response.data["played_at"]).total_seconds(), 60, delta=5
+        )
+        again = client.get("/api/songs/now-playing/", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(again.status_code, 304)
+
+
+@skipIf(np is None, "song suggestions need NumPy")
+class SongSuggestionTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        model_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(model_dir.cleanup)
+        self.path = Path(model_dir.name) / "suggestions.model"
+        self.rooms = []
+        for n, queue in enumerate([("a", "b", "c"), ("a", "b", "d"), ("e", "f")]):
+            room = make_room(make_user(f"host{n}"))
+            for letter in queue:
+                make_room_song(room, letter * 11)
+            self.rooms.append(room)
+
+    def suggested(self, *letters):
+        queue = [(Song.objects.get(video_id=letter * 11).pk, 0) for letter in letters]
+        suggester = Suggester(self.path, reload_interval=0)
+        return [Song.objects.get(pk=pk).video_id[0] for pk, _ in suggester.suggest(queue, 5)]
+
+    def test_suggests_songs_queued_alongside(self):
+        build_model(self.path)
+        self.assertEqual(self.suggested("a"), ["b", "c", "d"])
+        self.assertEqual(self.suggested("e"), ["f"])
+
+    def test_incremental_refresh_matches_a_full_build(self):
+        build_model(self.path)
+        Vote.objects.create(
+            room_song=RoomSong.objects.get(room=self.rooms[0], song__video_id="c" * 11),
+            user=self.rooms[0].host,
+        )
+        make_room_song(self.rooms[2], "a" * 11)
+        make_room_song(self.rooms[2], "g" * 11)
+        self.rooms[1].delete()
+        room = make_room(make_user("host3"))
+        make_room_song(room, "b" * 11)
+
+        meta = refresh_model(self.path)
+        self.assertEqual((meta["mode"], meta["refreshed_rooms"]), ("incremental", 4))
+        build_model(self.path.with_name("full.model"))
+        refreshed, rebuilt = load_model(self.path), load_model(self.path.with_name("full.model"))
+        for name in SuggestionModel.arrays:
+            np.testing.assert_array_equal(getattr(refreshed, name), getattr(rebuilt, name), name)
+
+    def test_endpoint_leaves_out_the_rooms_own_songs(self):
+        client = APIClient()
+        client.force_authenticate(self.rooms[2].host)
+        with self.settings(SONG_SUGGESTIONS={"PATH": self.path, "RELOAD_INTERVAL": 0}):
+            get_suggester.cache_clear()
+            self.addCleanup(get_suggester.cache_clear)
+            self.assertEqual(client.get("/api/songs/suggestions/").status_code, 503)
+
+            make_room_song(self.rooms[2], "a" * 11)
+            build_model()
+            response = client.get("/api/songs/suggestions/?limit=2")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row["video_id"][0] for row in response.data], ["b", "c"])
+
+
+class SongSearchTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        get_song_search.cache_clear()
+        self.addCleanup(get_song_search.cache_clear)
+        self.host = make_user("host")
+        self.room = make_room(self.host)
+        for video_id, title in [
+            ("aaaaaaaaaaa", "Bohemian Rhapsody"),
+            ("bbbbbbbbbbb", "Rhapsody in Blue"),
+            ("ccccccccccc", "Hungarian Rhapsody No. 2"),
+            ("ddddddddddd", "Beyoncé - Halo"),
+        ]:
+            Song.objects.create(video_id=video_id, title=title, thumbnail="https://i.ytimg.com/x.jpg")
+        self.client = APIClient()
+        self.client.force_authenticate(self.host)
+
+    def search(self, query):
+        # The server builds in the background; the test data is only
+        # visible to this thread's connection.
+        if get_song_search()._index is None:
+            get_song_search().build()
+        response = self.client.get("/api/songs/search/", {"q": query})
+        self.assertEqual(response.status_code, 200)
+        return [row["title"] for row in response.data]
+
+    def test_ranks_title_prefixes_before_word_prefixes(self):
+        self.assertEqual(
+            self.search("rhaps"), ["Rhapsody in Blue", "Bohemian Rhapsody", "Hungarian Rhapsody No. 2"]
+        )
+        self.assertEqual(self.search("beyonce halo"), ["Beyoncé - Halo"])
+        self.assertEqual(self.search("B"), ["Bohemian Rhapsody", "Beyoncé - Halo", "Rhapsody in Blue"])
+        # Every query word must start a title word, in any order.
+        self.assertEqual(self.search("rhap boh"), ["Bohemian Rhapsody"])
+        self.assertEqual(self.search("lo"), [])
+        self.assertEqual(self.search("hal"), ["Beyoncé - Halo"])
+        self.assertEqual(self.search("alo"), [])
+        self.assertEqual(self.search(" !"), [])
+
+    def test_popularity_lifts_songs_within_a_tier(self):
+        room_song = make_room_song(self.room, "ccccccccccc")
+        Vote.objects.create(room_song=room_song, user=self.host)
+        self.assertEqual(self.search("rhaps")[:2], ["Rhapsody in Blue", "Hungarian Rhapsody No. 2"])
+
+    def test_song_add_makes_new_songs_searchable(self):
+        self.assertEqual(self.search("halo"), ["Beyoncé - Halo"])
+        meta = VideoMetadata("eeeeeeeeeee", "Halo Theme", "https://i.ytimg.com/x.jpg")
+        with mock.patch("Room.views.get_resolver") as resolver:
+            resolver.return_value.resolve.return_value = meta
+            response = self.client.post("/api/songs/add/", {"url": "https://youtu.be/eeeeeeeeeee"}, format="json")
+        self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(self.search("halo"), ["Halo Theme", "Beyoncé - Halo"])
+        self.assertEqual(get_song_search().stats()["added"], 1)
+
+    def test_answers_empty_until_the_background_build_is_done(self):
+        search = MemorySongSearch()
+        with mock.patch("Room.search.threading.Thread") as thread:
+            self.assertEqual(search.search("halo"), [])
+            self.assertEqual(search.search("halo"), [])
+        thread.assert_called_once()
+        self.assertEqual(search.stats()["unready"], 2)
+        self.assertFalse(search.stats()["ready"])
+
+        # Run the build here: a thread would not see this test's rows.
+        with mock.patch("Room.search.connection"):
+            thread.call_args.kwargs["target"]()
+        self.assertEqual(search.search("halo"), [(Song.objects.get(title="Beyoncé - Halo").pk, 3.0)])
+        self.assertTrue(search.stats()["ready"])
+
+    def test_picks_up_songs_created_elsewhere_by_id(self):
+        search = MemorySongSearch(refresh_interval=0)
+        search.build()
+        self.assertEqual(search.search("reprise"), [])
+        song = Song.objects.create(video_id="fffffffffff", title="Halo (Reprise)", thumbnail="https://i.ytimg.com/x.jpg")
+        self.assertEqual(search.search("reprise"), [(song.pk, 3.0)])
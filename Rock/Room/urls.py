@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 from .views import (
@@ -7,16 +8,36 @@ from .views import (
     LeaveRoom,
     DetailRoom,
     SongAdd,
+    SongImport,
     RoomSongs,
+    QueueChanges,
     VoteToggle,
     PlayNextSong,
-    NowPlaying
+    NowPlaying,
+    PlayHistoryList,
+    SongSearch,
+    SongSuggestions,
+    IngestJobDetail,
+    MetadataStats,
+    ProfileStats,
+    RoomCacheStats,
+    SongSearchStats,
+    VoteBufferStats
 )
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
 )
 
+if settings.ASYNC_VIEWS:
+    from .async_views import (  # noqa: F811
+        DetailRoom,
+        NowPlaying,
+        RoomSongs,
+        SongAdd,
+        VoteToggle
+    )
+
 urlpatterns = [
     # ------------------------
     # UI Pages
@@ -44,9 +65,15 @@ urlpatterns = [
     # Songs / Queue
     # ------------------------
     path("api/songs/add/", SongAdd.as_view(), name="add_song"),
+    path("api/songs/import/", SongImport.as_view(), name="import_songs"),
     path("api/songs/queue/", RoomSongs.as_view(), name="room_songs"),
+    path("api/songs/queue/changes/", QueueChanges.as_view(), name="queue_changes"),
     path("api/songs/play-next/", PlayNextSong.as_view(), name="play_next"),
-    path("api/songs/now-playing/", NowPlaying.as_view()),
+    path("api/songs/now-playing/", NowPlaying.as_view(), name="now_playing"),
+    path("api/songs/history/", PlayHistoryList.as_view(), name="play_history"),
+    path("api/songs/search/", SongSearch.as_view(), name="song_search"),
+    path("api/songs/suggestions/", SongSuggestions.as_view(), name="song_suggestions"),
+    path("api/songs/ingest/<str:job_id>/", IngestJobDetail.as_view(), name="ingest_job"),
 
     # ------------------------
     # Votes
@@ -56,4 +83,13 @@ urlpatterns = [
         VoteToggle.as_view(),
         name="vote_toggle",
     ),
+
+    # ------------------------
+    # Diagnostics
+    # ------------------------
+    path("api/debug/metadata/", MetadataStats.as_view(), name="metadata_stats"),
+    path("api/debug/votes/", VoteBufferStats.as_view(), name="vote_buffer_stats"),
+    path("api/debug/room-cache/", RoomCacheStats.as_view(), name="room_cache_stats"),
+    path("api/debug/search/", SongSearchStats.as_view(), name="song_search_stats"),
+    path("api/debug/profile/", ProfileStats.as_view(), name="profile_stats"),
 ]
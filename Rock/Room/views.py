@@ -1,20 +1,34 @@
-import requests
+from django.conf import settings
 from django.db import transaction, IntegrityError
-from django.db.models import Count, Exists, OuterRef
 from django.shortcuts import render
-from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
 from rest_framework.views import APIView
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 
+from .changes import changed_since
+from . import profiling
+from .history import recent_plays
+from .importer import import_songs
+from .ingest import get_ingest_queue, placeholder_defaults
+from .membership import get_room_id, get_user_room, remember_room
+from .metadata import MetadataUnavailable, VideoNotFound, get_resolver
+from .playback import NoPlayableSongs, play_next
+from .ranking import queue_for
+from .roomcache import get_room_cache
+from .search import config as search_config, get_song_search, index_songs, search_songs
+from .suggestions import SuggestionsUnavailable, config as suggestion_config, suggestions_for
 from .models import Room, Song, RoomSong, Vote
+from .realtime import broadcast
+from .votebuffer import get_vote_buffer
 from .serializer import (
     RegistrationSerializer,
     RoomJoinSerializer,
     RoomSerializer,
     UrlExtractSerializer,
-    RoomSongSerializer
+    RoomSongSerializer,
+    BulkImportSerializer
 )
 
 from django.shortcuts import render
@@ -31,6 +45,27 @@ def home(request):
 def room(request):
     return render(request, "room.html")
 
+
+def room_etag(room):
+    return f'"{room.id}-{room.version}"'
+
+
+def not_modified(request, etag):
+    """A 304 when the client already holds `etag`, otherwise None."""
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        response.headers["ETag"] = etag
+    return response
+
+
+def with_etag(response, etag):
+    # Bodies depend on the caller (has_voted), so caches must revalidate
+    # and keep one copy per credential.
+    response.headers["ETag"] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ["Authorization"])
+    return response
+
 class Registration(APIView):
     def post(self, request):
         serializer = RegistrationSerializer(data=request.data)
@@ -44,7 +79,7 @@ class CreateRoom(APIView):
     def post(self, request):
         user = request.user
 
-        if Room.objects.filter(members=user).exists():
+        if get_room_id(request):
             return Response({"error": "User already in a room"}, status=400)
 
         try:
@@ -52,8 +87,10 @@ class CreateRoom(APIView):
                 room = Room.objects.create(host=user)
                 room.members.add(user)
         except IntegrityError:
-            return Response({"error": "User already hosts a room"}, status=400)
+            # Lost a race with another create/join for the same user.
+            return Response({"error": "User already in a room"}, status=400)
 
+        remember_room(request, room)
         return Response(RoomSerializer(room, context={"request": request}).data, status=201)
 
 class JoinRoom(APIView):
@@ -66,10 +103,17 @@ class JoinRoom(APIView):
         room = serializer.validated_data["room"]
         user = request.user
 
-        if Room.objects.filter(members=user).exists():
+        if get_room_id(request):
+            return Response({"error": "Already in another room"}, status=400)
+
+        try:
+            with transaction.atomic():
+                room.members.add(user)
+        except IntegrityError:
             return Response({"error": "Already in another room"}, status=400)
 
-        room.members.add(user)
+        remember_room(request, room)
+        broadcast(room.id, "member.joined", {"user_id": user.id, "username": user.username})
         return Response(RoomSerializer(room, context={"request": request}).data)
 
 
@@ -78,17 +122,20 @@ class LeaveRoom(APIView):
 
     def post(self, request):
         user = request.user
-        room = Room.objects.filter(members=user).first()
+        room = get_user_room(request)
 
         if not room:
             return Response({"error": "Not in any room"}, status=400)
 
         with transaction.atomic():
-            if room.host == user:
+            if room.host_id == user.id:
+                room_id = room.id
                 room.delete()
+                broadcast(room_id, "room.closed")
                 return Response({"message": "Room closed (host left)"})
 
             room.members.remove(user)
+            broadcast(room.id, "member.left", {"user_id": user.id})
 
         return Response({"message": "Left room"})
 
@@ -96,7 +143,7 @@ class DetailRoom(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        room = Room.objects.filter(members=request.user).first()
+        room = get_user_room(request)
         if not room:
             return Response({"error": "Not in a room"}, status=400)
 
@@ -111,166 +158,413 @@ class SongAdd(APIView):
         serializer.is_valid(raise_exception=True)
         video_id = serializer.video_id
 
-        room = Room.objects.filter(members=request.user).first()
+        room = get_user_room(request)
         if not room:
             return Response({"error": "Not in a room"}, status=400)
 
-    
-        try:
-            resp = requests.get(
-                f"https://www.youtube.com/oembed?url=https://www.youtube.com/watch?v={video_id}&format=json",
-                timeout=5
-            )
-            resp.raise_for_status()
-            meta = resp.json()
-        except Exception:
-            return Response({"error": "Invalid YouTube video"}, status=400)
-
-        song, _ = Song.objects.get_or_create(
-            video_id=video_id,
-            defaults={
-                "title": meta["title"],
-                "thumbnail": meta["thumbnail_url"]
-            }
-        )
+        song = Song.objects.filter(video_id=video_id).first()
+        if song is None or song.status == Song.Status.FAILED:
+            if self.ingest_async(request):
+                # Queue a placeholder now; the ingest workers fill it in.
+                song, _ = Song.objects.update_or_create(
+                    video_id=video_id,
+                    defaults=placeholder_defaults(video_id)
+                )
+            else:
+                try:
+                    meta = get_resolver().resolve(video_id)
+                except VideoNotFound:
+                    return Response({"error": "Invalid YouTube video"}, status=400)
+                except MetadataUnavailable:
+                    return Response({"error": "YouTube is unavailable, try again"}, status=503)
+
+                song, _ = Song.objects.update_or_create(
+                    video_id=video_id,
+                    defaults=ready_defaults(meta)
+                )
+                index_songs([(song.pk, song.title)])
 
-        room_song = RoomSong.objects.filter(room=room, song=song).first()
+        data, status_code = enqueue_song(room, song, request.user)
+        return Response(data, status=status_code)
 
-        
-        if room_song and room_song.played_at is None:
-            Vote.objects.get_or_create(room_song=room_song, user=request.user)
-            return Response({"message": "Vote registered"}, status=200)
+    def ingest_async(self, request):
+        return wants_async_ingest(request.data)
 
-        
-        if room_song and not room_song.can_play_again(minutes=10):
-            return Response({"error": "Song cooldown active (10 min)"}, status=400)
 
-        
+def wants_async_ingest(data):
+    if str(data.get("async", "")).lower() in ("1", "true"):
+        return True
+    return getattr(settings, "SONG_INGEST", {}).get("ASYNC", False)
+
+
+def ready_defaults(meta):
+    return {
+        "title": meta.title,
+        "thumbnail": meta.thumbnail,
+        "duration": meta.duration,
+        "status": Song.Status.READY
+    }
+
+
+def enqueue_song(room, song, user):
+    """
+    Put `song` in the room's queue, or count it as the user's vote when it
+    is already queued. Returns (body, status).
+    """
+    room_song = RoomSong.objects.filter(room=room, song=song).first()
+
+    if room_song and room_song.played_at is None:
+        Vote.objects.get_or_create(room_song=room_song, user=user)
+        room_song.refresh_from_db(fields=["vote_count"])
+        broadcast(room.id, "queue.vote", {
+            "room_song_id": room_song.id,
+            "vote_count": room_song.vote_count,
+        })
+        return {"message": "Vote registered"}, 200
+
+    if room_song and not room_song.can_play_again(minutes=10):
+        return {"error": "Song cooldown active (10 min)"}, 400
+
+    if room_song:
+        # Played before and out of cooldown: put it back in the queue.
+        room_song.played_at = None
+        room_song.save(update_fields=["played_at"])
+        new_song = room_song
+    else:
         new_song = RoomSong.objects.create(
             room=room,
             song=song,
-            added_by=request.user
+            added_by=user
         )
 
-        return Response(RoomSongSerializer(new_song).data, status=201)
+    data = RoomSongSerializer(new_song).data
+    broadcast(room.id, "queue.added", data)
+
+    if song.status == Song.Status.PENDING:
+        job = get_ingest_queue().submit(song.video_id, room.id)
+        return {**data, "job_id": job.id}, 202
+    return data, 201
+
+
+class SongImport(SongAdd):
+    def post(self, request):
+        serializer = BulkImportSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        room = get_user_room(request)
+        if not room:
+            return Response({"error": "Not in a room"}, status=400)
+
+        results = import_songs(
+            room,
+            request.user,
+            serializer.video_ids,
+            ingest_async=self.ingest_async(request)
+        )
+        return Response({"results": results})
 
 class RoomSongs(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        room = Room.objects.filter(members=request.user).first()
+        room = get_user_room(request)
         if not room:
             return Response({"error": "Not in room"}, status=400)
 
-        qs = (
-            RoomSong.objects
-            .filter(room=room, played_at__isnull=True)
-            .annotate(
-                vote_count=Count("votes"),
-                has_voted=Exists(
-                    Vote.objects.filter(
-                        room_song=OuterRef("pk"),
-                        user=request.user
-                    )
-                )
-            )
-            .order_by("-vote_count", "created_at")
-        )
+        etag = room_etag(room)
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
 
-        return Response(RoomSongSerializer(qs, many=True).data)
+        return with_etag(Response(queue_for(room, request.user)), etag)
+
+
+class QueueChanges(APIView):
+    """
+    Queue entries changed since the `since` cursor: `changed` holds their
+    current state, `removed` the ids that left the queue (played or
+    deleted). Without a usable cursor the whole queue comes back as
+    `songs` with `full` set.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        room = get_user_room(request)
+        if not room:
+            return Response({"error": "Not in room"}, status=400)
+
+        try:
+            changed = changed_since(room, int(request.query_params["since"]))
+        except (KeyError, ValueError):
+            changed = None
+
+        if changed is None:
+            return Response({
+                "cursor": room.version,
+                "full": True,
+                "songs": queue_for(room, request.user),
+            })
+
+        songs = queue_for(room, request.user, only=changed) if changed else []
+        return Response({
+            "cursor": room.version,
+            "full": False,
+            "changed": songs,
+            "removed": sorted(changed - {song["id"] for song in songs}),
+        })
 
 class VoteToggle(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, room_song_id):
-        room_song = RoomSong.objects.get(id=room_song_id)
+        buffer = get_vote_buffer()
+        if buffer is not None:
+            return self.buffered(request, buffer, room_song_id)
+
+        # One indexed lookup: the song, joined to the caller's membership.
+        room_id = voter_room_id(room_song_id, request.user).first()
+        if room_id is None:
+            if RoomSong.objects.filter(pk=room_song_id).exists():
+                return Response({"error": "Forbidden"}, status=403)
+            return Response({"error": "Song not found"}, status=404)
+
+        action, vote_count = toggle_vote(room_song_id, room_id, request.user)
+        return Response({
+            "action": action,
+            "vote_count": vote_count
+        })
 
-        if request.user not in room_song.room.members.all():
+    def buffered(self, request, buffer, room_song_id):
+        # Answered from the write-behind buffer (votebuffer.py); the Vote
+        # rows and the queue.vote event follow with the next flush.
+        room_id = buffer.room_of(room_song_id)
+        if room_id is None:
+            return Response({"error": "Song not found"}, status=404)
+        if room_id != get_room_id(request):
             return Response({"error": "Forbidden"}, status=403)
 
-        vote = Vote.objects.filter(room_song=room_song, user=request.user).first()
-
-        if vote:
-            vote.delete()
-            action = "removed"
-        else:
-            Vote.objects.create(room_song=room_song, user=request.user)
-            action = "added"
-
+        action, vote_count = buffer.toggle(room_song_id, request.user.pk)
         return Response({
             "action": action,
-            "vote_count": room_song.votes.count()
+            "vote_count": vote_count
         })
 
+
+def voter_room_id(room_song_id, user):
+    return (
+        RoomSong.objects
+        .filter(pk=room_song_id, room__memberships__user=user)
+        .values_list("room_id", flat=True)
+    )
+
+
+def toggle_vote(room_song_id, room_id, user):
+    """Flip the user's vote on a song of their room. Returns (action, vote_count)."""
+    try:
+        with transaction.atomic():
+            # Delete first and insert only if there was nothing to delete;
+            # the Vote signals keep vote_count and the change log.
+            removed, _ = Vote.objects.filter(room_song_id=room_song_id, user=user).delete()
+            if not removed:
+                # The known room_id spares the Vote signals a lookup.
+                Vote.objects.create(room_song=RoomSong(pk=room_song_id, room_id=room_id), user=user)
+            vote_count = RoomSong.objects.filter(pk=room_song_id).values_list("vote_count", flat=True).get()
+            broadcast(room_id, "queue.vote", {
+                "room_song_id": room_song_id,
+                "vote_count": vote_count,
+            })
+    except IntegrityError:
+        # A concurrent request from the same user inserted it, and
+        # announces it.
+        removed = 0
+        vote_count = RoomSong.objects.filter(pk=room_song_id).values_list("vote_count", flat=True).get()
+    return ("removed" if removed else "added"), vote_count
+
+
 class PlayNextSong(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        try:
-            room = Room.objects.get(host=request.user)
-        except Room.DoesNotExist:
+        room = get_user_room(request)
+        if not room or room.host_id != request.user.id:
             return Response(
                 {"detail": "Only host can play next"},
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        candidates = (
-            RoomSong.objects
-            .filter(room=room)
-            .annotate(vote_count=Count("votes"))
-            .order_by("-vote_count", "created_at")
-        )
-
-        next_song = None
-        for rs in candidates:
-            if rs.can_play_again(10):
-                next_song = rs
-                break
+        # Clients send the song they saw playing so a repeated or racing
+        # "next" cannot skip twice; without it, the current song is assumed.
+        expected = request.data.get("expected_room_song_id", room.now_playing_id)
+        try:
+            expected = int(expected) if expected is not None else None
+        except (TypeError, ValueError):
+            return Response(
+                {"detail": "Invalid expected_room_song_id"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        if not next_song:
+        try:
+            result = play_next(room.id, expected)
+        except NoPlayableSongs:
             return Response(
                 {"detail": "No playable songs"},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        next_song.mark_played()
+        return Response(result.as_dict())
 
-        return Response({
-            "room_song_id": next_song.id,
-            "video_id": next_song.song.video_id,
-            "title": next_song.song.title,
-        })
-    
 
 class NowPlaying(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        try:
-            room = Room.objects.get(members=request.user)
-        except Room.DoesNotExist:
+        room = get_user_room(request)
+        if not room:
             return Response(
                 {"detail": "User not in a room"},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        room_song = (
-            RoomSong.objects
-            .filter(room=room, played_at__isnull=False)
-            .select_related("song")
-            .order_by("-played_at")
-            .first()
-        )
+        etag = room_etag(room)
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
 
-        if not room_song:
-            return Response(
-                {"video_id": None},
-                status=status.HTTP_200_OK
+        return with_etag(Response(now_playing(room)), etag)
+
+
+NOW_PLAYING_FIELDS = ("room_song_id", "video_id", "title", "played_at", "duration")
+
+
+def now_playing_rows(room):
+    return (
+        RoomSong.objects
+        .filter(pk=room.now_playing_id)
+        .values_list("id", "song__video_id", "song__title", "played_at", "song__duration")
+    )
+
+
+def now_playing_body(row):
+    if not row:
+        return {"video_id": None}
+    return dict(zip(NOW_PLAYING_FIELDS, row))
+
+
+def now_playing(room):
+    """
+    The now-playing body, built once per room version (roomcache.py).
+    Clients work out how far into the song the room is from played_at: an
+    offset in the body would go stale behind the version ETag.
+    """
+    def load():
+        return now_playing_body(now_playing_rows(room).first() if room.now_playing_id else None)
+
+    return get_room_cache().get_or_load(room.id, f"now_playing:{room.version}", load)
+
+
+async def anow_playing(room):
+    async def load():
+        return now_playing_body(await now_playing_rows(room).afirst() if room.now_playing_id else None)
+
+    return await get_room_cache().aget_or_load(room.id, f"now_playing:{room.version}", load)
+
+
+class PlayHistoryList(APIView):
+    """The room's most recent plays, newest first."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        room = get_user_room(request)
+        if not room:
+            return Response({"error": "Not in a room"}, status=400)
+
+        return Response([
+            {"video_id": video_id, "title": title, "played_at": played_at}
+            for video_id, title, played_at in recent_plays(room)
+        ])
+
+
+class SongSearch(APIView):
+    """Typeahead over the songs already known, most popular first."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        try:
+            limit = int(request.query_params.get("limit", search_config()["LIMIT"]))
+        except ValueError:
+            return Response({"error": "limit must be a number"}, status=400)
+        limit = max(1, min(limit, 50))
+        return Response(search_songs(request.query_params.get("q", ""), limit))
+
+
+class SongSuggestions(APIView):
+    """Songs other rooms queue alongside this room's queue."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        room = get_user_room(request)
+        if not room:
+            return Response({"error": "Not in a room"}, status=400)
+        try:
+            limit = int(request.query_params.get("limit", suggestion_config()["LIMIT"]))
+        except ValueError:
+            return Response({"error": "limit must be a number"}, status=400)
+        limit = max(1, min(limit, 50))
+
+        try:
+            suggestions = get_room_cache().get_or_load(
+                room.id, f"suggestions:{room.version}:{limit}", lambda: suggestions_for(room, limit)
             )
+        except SuggestionsUnavailable:
+            return Response({"error": "Suggestions are unavailable"}, status=503)
+        return Response(suggestions)
 
-        return Response({
-            "room_song_id": room_song.id,
-            "video_id": room_song.song.video_id,
-            "title": room_song.song.title,
-            "played_at": room_song.played_at,
-        })
\ No newline at end of file
+
+class IngestJobDetail(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id):
+        job = get_ingest_queue().get(job_id)
+        if job is None:
+            return Response({"error": "Unknown job"}, status=404)
+        return Response(job.as_dict())
+
+
+class MetadataStats(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(get_resolver().stats())
+
+
+class ProfileStats(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(profiling.stats.snapshot())
+
+    def delete(self, request):
+        profiling.stats.reset()
+        return Response(status=204)
+
+
+class VoteBufferStats(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        buffer = get_vote_buffer()
+        return Response(buffer.stats() if buffer else {"enabled": False})
+
+
+class SongSearchStats(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(get_song_search().stats())
+
+
+class RoomCacheStats(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(get_room_cache().stats())
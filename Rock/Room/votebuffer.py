@@ -0,0 +1,387 @@
+"""
+Write-behind vote buffering.
+
+With VOTE_BUFFER["ENABLED"], VoteToggle applies each toggle to an in-memory
+voter set per RoomSong and answers from it. The accumulated changes are
+written to the Vote table in batches, every FLUSH_INTERVAL seconds or once
+FLUSH_SIZE toggles are pending. A batch is one transaction that inserts the
+new votes with bulk_create, deletes the withdrawn ones, recomputes
+vote_count for the touched songs and logs one queue change per room.
+
+Every toggle is also appended to a journal file before it is acknowledged.
+Each process journals to its own file, `<JOURNAL stem>-<pid><suffix>`, and
+holds a lock on `<stem>-<pid>.lock` while it lives. A flush moves the
+current journal aside as a numbered segment and deletes the segments once
+the batch has committed. What a crash leaves behind is replayed the next
+time a buffer starts (or by `manage.py flush_votes`): the segments of its
+own pid, and the journals of any process whose lock is free, i.e. that
+has exited. Taking over other processes' journals needs fcntl; elsewhere
+only a restart under the same pid replays them. Entries record the
+resulting state ("user voted" or "user did not vote"), not the toggle, so
+replaying an entry that did reach the database is harmless.
+
+Consistency:
+
+- The caller's own toggle is visible to them at once: the response
+  carries the new vote count.
+- Everyone else, including the queue, the ETag/changes cursor and the
+  queue.vote events, sees a toggle once its batch is flushed. That takes
+  at most FLUSH_INTERVAL plus one flush.
+- A process crash loses nothing that was acknowledged, because journal
+  lines are flushed to the OS before the response goes out. They are not
+  fsynced, so a power loss can drop the last toggles.
+- Voter sets are per process. A set is dropped after its batch is
+  flushed and then reloaded from the database, so separate workers agree
+  again within one flush interval. Toggles for the same song on different
+  workers inside that window can conflict. Route a room to a single
+  worker, or leave buffering off, if that matters.
+"""
+import json
+import os
+import threading
+from collections import defaultdict
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class VoteState:
+    __slots__ = ("room_id", "voters")
+
+    def __init__(self, room_id, voters):
+        self.room_id = room_id
+        self.voters = voters
+
+
+def process_journal(base, pid):
+    return base.with_name(f"{base.stem}-{pid}{base.suffix}")
+
+
+def try_lock(path):
+    """An open handle holding an exclusive lock on `path`, or None when someone else holds it."""
+    handle = open(path, "a")
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return None
+    return handle
+
+
+_held_locks = {}
+_held_locks_lock = threading.Lock()
+
+
+def hold_lock(path):
+    # Held until the process exits, however many buffers it builds.
+    with _held_locks_lock:
+        if path not in _held_locks:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            _held_locks[path] = try_lock(path)
+
+
+class VoteBuffer:
+    def __init__(self, flush_interval=0.5, flush_size=500, journal=None):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.base = Path(journal) if journal else None
+        self.journal = process_journal(self.base, os.getpid()) if journal else None
+        if self.journal is not None and fcntl is not None:
+            hold_lock(self.journal.with_suffix(".lock"))
+        self._states = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._journal_file = None
+        self._segment = 0
+        self._wakeup = threading.Event()
+        self._flusher = None
+        self.toggles = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.failures = 0
+        # Continue the numbering of segments a previous process left behind.
+        self._segment = max((int(path.suffix[1:]) for path in self._segments()), default=0)
+
+    # ------------------------
+    # Toggles
+    # ------------------------
+
+    def room_of(self, room_song_id):
+        """Room id of the RoomSong, or None when it does not exist."""
+        state = self._state(room_song_id)
+        return state.room_id if state else None
+
+    def toggle(self, room_song_id, user_id):
+        """Flip the user's vote. Returns (action, vote_count)."""
+        while True:
+            state = self._state(room_song_id)
+            if state is None:
+                raise LookupError(room_song_id)
+            with self._lock:
+                if self._states.get(room_song_id) is not state:
+                    continue  # dropped by a flush in the meantime
+                voted = user_id not in state.voters
+                if voted:
+                    state.voters.add(user_id)
+                else:
+                    state.voters.discard(user_id)
+                self._pending[(room_song_id, user_id)] = voted
+                self._append(room_song_id, user_id, voted)
+                self.toggles += 1
+                vote_count = len(state.voters)
+                full = len(self._pending) >= self.flush_size
+                break
+
+        self._start_flusher()
+        if full:
+            self._wakeup.set()
+        return ("added" if voted else "removed"), vote_count
+
+    def _state(self, room_song_id):
+        state = self._states.get(room_song_id)
+        if state is None:
+            state = self._load(room_song_id)
+            if state is not None:
+                with self._lock:
+                    state = self._states.setdefault(room_song_id, state)
+        return state
+
+    def _load(self, room_song_id):
+        from .models import RoomSong, Vote
+
+        room_id = RoomSong.objects.filter(pk=room_song_id).values_list("room_id", flat=True).first()
+        if room_id is None:
+            return None
+        voters = set(Vote.objects.filter(room_song_id=room_song_id).values_list("user_id", flat=True))
+        return VoteState(room_id, voters)
+
+    # ------------------------
+    # Journal
+    # ------------------------
+
+    def _append(self, room_song_id, user_id, voted):
+        if self.journal is None:
+            return
+        if self._journal_file is None:
+            self.journal.parent.mkdir(parents=True, exist_ok=True)
+            self._journal_file = open(self.journal, "a", encoding="utf-8")
+        self._journal_file.write(json.dumps([room_song_id, user_id, voted]) + "\n")
+        self._journal_file.flush()
+
+    def _segments(self, journal=None):
+        journal = journal or self.journal
+        if journal is None:
+            return []
+        return sorted(
+            journal.parent.glob(f"{journal.name}.*"),
+            key=lambda path: int(path.suffix[1:]),
+        )
+
+    def _orphans(self):
+        """(journal, lock handle) of every process that exited without flushing."""
+        if fcntl is None:
+            return []
+        orphans = []
+        for lock_path in self.base.parent.glob(f"{self.base.stem}-*.lock"):
+            journal = lock_path.with_suffix(self.base.suffix)
+            if journal == self.journal:
+                continue
+            handle = try_lock(lock_path)
+            if handle is not None:
+                orphans.append((journal, handle))
+        return orphans
+
+    def _rotate(self):
+        # Called with self._lock held.
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+        if self.journal is not None and self.journal.exists():
+            self._segment += 1
+            self.journal.rename(f"{self.journal}.{self._segment}")
+
+    def _drop_segments(self, upto):
+        for path in self._segments():
+            if int(path.suffix[1:]) <= upto:
+                path.unlink()
+
+    def replay(self):
+        """Write whatever earlier processes journaled but never flushed."""
+        if self.journal is None:
+            return 0
+        with self._flush_lock:
+            with self._lock:
+                self._rotate()
+            orphans = self._orphans()
+            try:
+                paths = self._segments()
+                for journal, _ in orphans:
+                    # Its live journal holds its newest entries.
+                    paths += [*self._segments(journal), journal]
+
+                batch = {}
+                for path in paths:
+                    if not path.exists():
+                        continue
+                    with open(path, encoding="utf-8") as journal:
+                        for line in journal:
+                            try:
+                                room_song_id, user_id, voted = json.loads(line)
+                            except ValueError:
+                                continue  # torn final line
+                            batch[(room_song_id, user_id)] = voted
+                self._write(batch)
+
+                self._drop_segments(self._segment)
+                for journal, _ in orphans:
+                    for path in [*self._segments(journal), journal, journal.with_suffix(".lock")]:
+                        path.unlink(missing_ok=True)
+            finally:
+                for _, handle in orphans:
+                    handle.close()
+            return len(batch)
+
+    # ------------------------
+    # Flushing
+    # ------------------------
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._rotate()
+                segment = self._segment
+            if not batch:
+                return 0
+
+            try:
+                self._write(batch)
+            except Exception:
+                with self._lock:
+                    # Newer toggles win over the failed batch.
+                    self._pending = {**batch, **self._pending}
+                raise
+
+            # Covers segments of earlier failed flushes too; their
+            # entries were merged into this batch.
+            self._drop_segments(segment)
+            with self._lock:
+                pending = {room_song_id for room_song_id, _ in self._pending}
+                for room_song_id in {room_song_id for room_song_id, _ in batch}:
+                    if room_song_id not in pending:
+                        self._states.pop(room_song_id, None)
+                self.flushes += 1
+                self.flushed += len(batch)
+            return len(batch)
+
+    def _write(self, batch):
+        from .changes import record_changes, unlogged
+        from .models import RoomSong, User, Vote, actual_vote_count
+        from .realtime import broadcast
+
+        if not batch:
+            return
+        room_song_ids = {room_song_id for room_song_id, _ in batch}
+        added = [key for key, voted in batch.items() if voted]
+        removed = defaultdict(list)
+        for (room_song_id, user_id), voted in batch.items():
+            if not voted:
+                removed[room_song_id].append(user_id)
+
+        with transaction.atomic():
+            live = set(RoomSong.objects.filter(pk__in=room_song_ids).values_list("pk", flat=True))
+            users = set(
+                User.objects
+                .filter(pk__in={user_id for _, user_id in added})
+                .values_list("pk", flat=True)
+            )
+            Vote.objects.bulk_create(
+                [
+                    Vote(room_song_id=room_song_id, user_id=user_id)
+                    for room_song_id, user_id in added
+                    if room_song_id in live and user_id in users
+                ],
+                ignore_conflicts=True,
+            )
+            if removed:
+                withdrawn = Q()
+                for room_song_id, user_ids in removed.items():
+                    withdrawn |= Q(room_song_id=room_song_id, user_id__in=user_ids)
+                # The Vote signals stand down; the counters are recomputed
+                # and the changes logged below, once per song.
+                with unlogged():
+                    Vote.objects.filter(withdrawn).delete()
+
+            RoomSong.objects.filter(pk__in=live).update(vote_count=actual_vote_count())
+            rows = RoomSong.objects.filter(pk__in=live).values_list("pk", "room_id", "vote_count")
+            by_room = defaultdict(list)
+            for room_song_id, room_id, vote_count in rows:
+                by_room[room_id].append(room_song_id)
+                broadcast(room_id, "queue.vote", {
+                    "room_song_id": room_song_id,
+                    "vote_count": vote_count,
+                })
+            for room_id, ids in by_room.items():
+                record_changes(room_id, ids)
+
+    def _start_flusher(self):
+        if self.flush_interval is None or self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(
+                target=self._run_flusher, name="vote-flush", daemon=True
+            )
+            self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # The batch stays pending and journaled for the next round.
+                self.failures += 1
+            finally:
+                close_old_connections()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "songs": len(self._states),
+                "toggles": self.toggles,
+                "flushes": self.flushes,
+                "flushed": self.flushed,
+                "failures": self.failures,
+            }
+
+
+def build_vote_buffer(config):
+    return VoteBuffer(
+        flush_interval=config.get("FLUSH_INTERVAL", 0.5),
+        flush_size=config.get("FLUSH_SIZE", 500),
+        journal=config.get("JOURNAL"),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_vote_buffer():
+    """The process-wide VoteBuffer, or None when buffering is off."""
+    config = getattr(settings, "VOTE_BUFFER", {})
+    if not config.get("ENABLED"):
+        return None
+    buffer = build_vote_buffer(config)
+    buffer.replay()
+    return buffer